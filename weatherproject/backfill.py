@@ -0,0 +1,140 @@
+'''
+backfill.py
+Queues ncdc windows for station(s) and date ranges in mongo and runs
+worker processes on the queue until it is empty.
+Enter "python backfill.py -v" for usage with examples.
+
+The queue survives crashes: run it again (with or without -i) and
+only the windows that aren't done are fetched.
+'''
+from utils.date_util import Dates
+import utils.mongodb as db
+import utils.jobs as jobs
+from get_weather import check_date, check_station_ids
+import datetime
+
+def show_usage():
+    '''Long-winded / detailed usage'''
+    print('backfill.py usage'.center(80,'*'))
+    print('Description: Long running MIN / MAX backfills from ncdc into mongo using a job queue.\n')
+    print('{:21s}=> Optional: Station id(s) to queue, comma delimited with no spaces.'.format('[-i|--id]'))
+    print('\t\t\tWithout it, the windows already queued are worked on.')
+    print('{:21s}=> Required with -i. The start date. Format = yyyy[-mm-dd]'.format('[-s|--start]'))
+    print('{:21s}=> Optional. The end date. Format = yyyy[-mm-dd]. Default is today.'.format('[-e|--end]'))
+    print('{:21s}=> Required unless --status. The ncdc token to use.'.format('[-t|--token]'))
+    print('{:21s}=> Optional. Number of worker processes. Default is 4.'.format('[-p|--processes]'))
+    print('\t\t\tAll of them share the ncdc limits of 5 requests per second and')
+    print('\t\t\t10,000 per day.')
+    print('{:21s}=> Optional. Only queue the dates missing from the coverage ledger.'.format('[--sync]'))
+    print('{:21s}=> Optional. Seconds a worker holds a window. If a worker dies its'.format('[--lease]'))
+    print('\t\t\twindows are picked up again after this. Default is 300.')
+    print('{:21s}=> Optional. Use a different data url, like a local utils.stub_server.'.format('[--url]'))
+    print('{:21s}=> Optional. Keep ncdc responses on disk (see get_weather.py -v).'.format('[--http-cache]'))
+    print('{:21s}=> Optional. Queue the failed windows again before starting.'.format('[--retry-failed]'))
+    print('{:21s}=> Optional. Remove the finished windows from the queue and exit.'.format('[--clear-done]'))
+    print('{:21s}=> Show the queue counts and failed windows and exit.'.format('[--status]'))
+    print('\nExamples:\n# Backfill 1900 through today for two stations with 8 processes.')
+    print('\tpython ./backfill.py -i STATIONID_1,STATIONID_2 -s 1900 -t MYTOKEN -p 8')
+    print('\n# Pick up after a crash or a spent daily quota.')
+    print('\tpython ./backfill.py -t MYTOKEN')
+    print('\n# Try the failed windows again.')
+    print('\tpython ./backfill.py -t MYTOKEN --retry-failed')
+    print('*' * 80)
+    exit(0)
+
+
+
+def give_hint_and_exit():
+    '''One of the options is missing or incorrect. Show how to get
+    detailed usage.'''
+    print('Enter python backfill.py -v for detailed usage and examples')
+    exit(1)
+
+
+def show_status(queue):
+    '''Print the queue counts and the failed windows.'''
+    counts = queue.counts()
+    print('Pending: {}\tClaimed: {}\tDone: {}\tFailed: {}\tRecords: {}'.format(
+        counts.get(jobs.PENDING), counts.get(jobs.CLAIMED), counts.get(jobs.DONE),
+        counts.get(jobs.FAILED), counts.get('records')))
+    print('ncdc requests today: {}'.format(queue.requests_today()))
+    for rec in queue.failed():
+        print('\t{} {} - {}: {}'.format(rec.get('station'), rec.get('start'), rec.get('end'), rec.get('error')))
+    return counts
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('-i', '--id', help='Station id(s) to queue, comma delimited with no spaces.')
+    parser.add_argument('-s', '--start', help='The start date for the queued windows.')
+    parser.add_argument('-e', '--end', help='The end date for the queued windows. Default is today.')
+    parser.add_argument('-t', '--token', help='The token for the ncdc site.')
+    parser.add_argument('-p', '--processes', type=int, default=4, help='Number of worker processes. Default is 4.')
+    parser.add_argument('--sync', action='store_true', help='Only queue dates missing from the coverage ledger.')
+    parser.add_argument('--lease', type=int, default=300, help='Seconds a worker holds a window.')
+    parser.add_argument('--url', help='Use a different data url. For example a local utils.stub_server.')
+    parser.add_argument('--http-cache', action='store_true', help='Keep ncdc responses on disk.')
+    parser.add_argument('--retry-failed', action='store_true', help='Queue the failed windows again.')
+    parser.add_argument('--clear-done', action='store_true', help='Remove finished windows and exit.')
+    parser.add_argument('--status', action='store_true', help='Show the queue and exit.')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show detailed usage.')
+    args = parser.parse_args()
+
+    if args.verbose:
+        show_usage()
+
+    try:
+        db_conn = db.WeatherDb()
+        queue = jobs.JobQueue(db_conn, lease=args.lease)
+        if args.status:
+            show_status(queue)
+            exit(0)
+        if args.clear_done:
+            print('{} finished windows removed.'.format(queue.clear_done()))
+            exit(0)
+    except db.MongoDBException as e:
+        print(e.__str__())
+        exit(1)
+
+    if not args.token:
+        print('> A token is required.')
+        give_hint_and_exit()
+
+    if args.id:
+        if not args.start or not check_date(args.start) or (args.end and not check_date(args.end)):
+            print('> A valid start date is required with -i.')
+            give_hint_and_exit()
+        d = Dates()
+        start_date = d.get_full_date(args.start, 0)
+        end_date = d.get_full_date(args.end, 1) if args.end else datetime.date.today().isoformat()
+        station_list = args.id.split(',')
+        if not check_station_ids(station_list):
+            exit(1)
+        try:
+            if args.sync:
+                coverage = db.Coverage(db_conn)
+                ledgers = coverage.get_many(station_list)
+                ranges = [(station_id, r) for station_id in station_list
+                          for r in coverage.missing(station_id, start_date, end_date, ledgers.get(station_id))]
+            else:
+                ranges = [(station_id, (start_date, end_date)) for station_id in station_list]
+            windows = [(station_id, s, e) for station_id, (first, last) in ranges
+                       for s, e in d.plan_windows(first, last)]
+            added = queue.enqueue(windows)
+            print('{} windows queued, {} were already in the queue.'.format(added, len(windows) - added))
+        except db.MongoDBException as e:
+            print(e.__str__())
+            exit(1)
+
+    if args.retry_failed:
+        print('{} failed windows queued again.'.format(queue.retry_failed()))
+
+    jobs.run_workers(args.token, processes=args.processes, url=args.url,
+                     http_cache=args.http_cache, lease=args.lease)
+
+    counts = show_status(queue)
+    if counts.get(jobs.FAILED) or counts.get(jobs.PENDING) or counts.get(jobs.CLAIMED):
+        exit(1)
+    exit(0)
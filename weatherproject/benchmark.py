@@ -0,0 +1,392 @@
+'''
+benchmark.py
+Times the hot paths against a scratch database seeded with nome_ak_Jan.json
+and synthetic GHCND shaped data at several scales.
+Enter "python benchmark.py -v" for usage with examples.
+
+Uses the local mongo if it answers, otherwise mongomock (if installed).
+mongomock scans for every upsert and unique index check, so with it the
+station indexes are skipped and ingest is timed on a sample of the
+records (--ingest-limit). Its numbers are only good for comparing runs
+on mongomock.
+The data goes in its own database (weather_benchmark by default), which
+is dropped at the start of every run. Results are written as json so
+runs can be compared across changes.
+'''
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import numpy as np
+import pymongo
+import utils.mongodb as db
+import utils.weather as weather
+from utils.date_util import Dates
+from utils.fetch import FetchEngine
+from utils.ncdc import NcdcWeather
+from utils.stub_server import StubNcdcServer, load_records
+
+NOME_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nome_ak_Jan.json')
+# synthetic data always ends here so every run builds the same records
+LAST_YEAR = 2017
+METHODS = ('rollup', 'aggregate', 'numpy', 'python')
+# most milliseconds importing each CLI may take, and what it shouldn't load
+IMPORT_BUDGET_MS = {'get_weather': 250, 'plot_weather': 250, 'backfill': 250, 'migrate': 250}
+HEAVY_MODULES = ('pandas', 'numpy', 'matplotlib', 'requests', 'pyarrow')
+# run in a fresh interpreter: seconds to import the module and the heavy ones it loaded
+IMPORT_SCRIPT = ('import sys, time\n'
+                 'start = time.perf_counter()\n'
+                 'import {module}\n'
+                 'seconds = time.perf_counter() - start\n'
+                 'print(seconds, *[m for m in {heavy!r} if m in sys.modules])\n')
+
+def show_usage():
+    print('benchmark.py usage'.center(80,'*'))
+    print('Description: Times fetch, ingest, query and averaging and writes the results as json.\n')
+    print('{:21s}=> Optional: Comma delimited years of daily data per scale. Default 10,50,100.'.format('[--years]'))
+    print('\t\t\tThe nome_ak_Jan.json records are always run as the "nome" scale.')
+    print('{:21s}=> Optional: Times each benchmark is run. The min, median and mean'.format('[-r|--repeat]'))
+    print('\t\t\tare reported. Default 3.')
+    print('{:21s}=> Optional: Only run benchmarks whose name starts with one of these,'.format('[-b|--bench]'))
+    print('\t\t\tcomma delimited. ingest, query, averages, locations, fetch, imports.')
+    print('\t\t\timports times a fresh python importing each CLI and flags any over its')
+    print('\t\t\tIMPORT_BUDGET_MS or loading pandas, numpy, matplotlib, requests or pyarrow.')
+    print('{:21s}=> Optional: Number of stations for the location search. Default 10000.'.format('[--stations]'))
+    print('{:21s}=> Optional: mongo, mongomock or auto (default). auto uses mongo if it'.format('[--backend]'))
+    print('\t\t\tanswers within 2 seconds.')
+    print('{:21s}=> Optional: Most records timed for ingest per scale. Default is all'.format('[--ingest-limit]'))
+    print('\t\t\tof them on mongo and 1000 on mongomock.')
+    print('{:21s}=> Optional: Database to use. Default weather_benchmark. It is dropped!'.format('[--database]'))
+    print('{:21s}=> Optional: Write the json here instead of stdout.'.format('[-o|--output]'))
+    print('\nExamples:\n# Everything at the default scales.')
+    print('\tpython ./benchmark.py -o results.json')
+    print('\n# Just the averaging, 100 years, 5 runs each.')
+    print('\tpython ./benchmark.py --years 100 -b averages -r 5')
+    print('*' * 80)
+    exit(0)
+
+
+
+def connect(backend, database):
+    '''Points utils.mongodb at the benchmark database. Returns the backend used.'''
+    db.configure(database=database, timeout_ms=2000)
+    if backend in ('auto', 'mongo'):
+        try:
+            db.get_client().server_info()
+            return 'mongo'
+        except (db.MongoDBException, pymongo.errors.PyMongoError) as e:
+            if backend == 'mongo':
+                raise db.MongoDBException('Could not connect to mongo: {}'.format(e))
+    try:
+        import mongomock
+    except ImportError:
+        raise db.MongoDBException('No mongo answering and mongomock is not installed.')
+    # every connection utils.mongodb makes from here on is to mongomock
+    db._clients.clear()
+    pymongo.MongoClient = mongomock.MongoClient
+    return 'mongomock'
+
+
+
+def nome_stats(records):
+    '''Mean and standard deviation of the January TMIN / TMAX in records.'''
+    stats = {}
+    for datatype in ('TMIN', 'TMAX'):
+        values = np.array([r.get('value') for r in records if r.get('datatype') == datatype])
+        stats[datatype] = (float(values.mean()), float(values.std()))
+    return stats
+
+
+def synthetic_records(station, years, stats, seed=0):
+    '''GHCND shaped TMIN / TMAX records for every day of the years
+    before LAST_YEAR + 1. January matches the nome stats and the rest
+    of the year follows a seasonal curve with the same noise.'''
+    rng = np.random.default_rng(seed)
+    days = np.arange(np.datetime64('{}-01-01'.format(LAST_YEAR - years + 1)),
+                     np.datetime64('{}-01-01'.format(LAST_YEAR + 1)))
+    doy = (days - days.astype('datetime64[Y]')).astype(np.int64)
+    # about 40 degrees warmer mid summer, like nome
+    season = 40 * (1 - np.cos(2 * np.pi * doy / 365.25)) / 2
+    tmin = stats['TMIN'][0] + season + rng.normal(0, stats['TMIN'][1], len(days))
+    spread = np.abs(rng.normal(stats['TMAX'][0] - stats['TMIN'][0], stats['TMIN'][1] / 2, len(days)))
+    tmax = tmin + spread
+    records = []
+    for day, lo, hi in zip(days.astype(str), np.round(tmin), np.round(tmax)):
+        date = day + 'T00:00:00'
+        records.append({'date': date, 'datatype': 'TMAX', 'station': 'GHCND:' + station,
+                        'attributes': ',,6,2400', 'value': float(hi)})
+        records.append({'date': date, 'datatype': 'TMIN', 'station': 'GHCND:' + station,
+                        'attributes': ',,6,2400', 'value': float(lo)})
+    return records
+
+
+def synthetic_stations(count, seed=0):
+    rng = np.random.default_rng(seed)
+    lat = rng.uniform(-60, 75, count)
+    lon = rng.uniform(-180, 180, count)
+    return [{'station_id': 'BENCH{:06d}'.format(i), 'name': 'BENCH STATION {}'.format(i),
+             'lat': float(lat[i]), 'lon': float(lon[i]), 'mindate': '1900-01-01', 'maxdate': '2017-12-31',
+             'datacoverage': 1.0} for i in range(count)]
+
+
+
+def time_it(fn, repeat, setup=None):
+    '''Runs fn repeat times (setup before each, not timed) with its
+    printing thrown away. Returns the seconds for each run and fn's last result.'''
+    times = []
+    result = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = fn()
+            times.append(time.perf_counter() - start)
+    return times, result
+
+
+class Benchmark:
+    '''Holds the database handles and collects the results.'''
+    def __init__(self, repeat, only=None, ingest_limit=None, skip_indexes=False):
+        self.repeat = repeat
+        self.only = only
+        self.ingest_limit = ingest_limit
+        self.skip_indexes = skip_indexes
+        self.db_conn = db.WeatherDb()
+        self.results = []
+
+
+    def wanted(self, name):
+        return not self.only or any(name.startswith(prefix) for prefix in self.only)
+
+
+    def record(self, name, scale, records, times, **extra):
+        result = {'name': name, 'scale': scale, 'records': records, 'runs': len(times),
+                  'min': min(times), 'median': statistics.median(times), 'mean': statistics.mean(times),
+                  'records_per_second': records / min(times) if records and min(times) else None}
+        result.update(extra)
+        self.results.append(result)
+        print('{:32}{:>10}{:>10}{:>12.4f}s'.format(name, scale, records, result['median']), file=sys.stderr)
+
+
+    def reset(self, station):
+        '''Drops the station collection and everything kept about it.'''
+        self.db_conn.db.drop_collection(station)
+        self.db_conn.db['collection_stats'].delete_one({'_id': station})
+        self.db_conn.db['rollups'].delete_many({'station': station})
+        if self.skip_indexes:
+            # set_collection / BulkWriter think the index is already there
+            self.db_conn._indexed.add(station)
+        else:
+            self.db_conn._indexed.discard(station)
+
+
+    def load(self, station, records):
+        '''Replaces the station collection with records (not timed).'''
+        self.reset(station)
+        self.db_conn.set_collection(station)
+        self.db_conn.collection.insert_many([dict(rec) for rec in records])
+
+
+    def ingest(self, station, scale, records):
+        if self.ingest_limit is not None:
+            records = records[:self.ingest_limit]
+        reset = lambda: self.reset(station)
+
+        def bulk():
+            writer = self.db_conn.bulk_writer()
+            writer.add(station, records)
+            writer.flush()
+            return writer.counts()
+
+        if self.wanted('ingest.bulk_writer'):
+            times, _ = time_it(bulk, self.repeat, reset)
+            self.record('ingest.bulk_writer', scale, len(records), times)
+
+        if self.wanted('ingest.insert_json'):
+            # the way get_weather.py used to insert: one ncdc page at a time
+            pages = [json.dumps({'results': records[i:i + 1000]}) for i in range(0, len(records), 1000)]
+
+            def pagewise():
+                self.db_conn.set_collection(station)
+                for page in pages:
+                    self.db_conn.insert_json(page)
+            times, _ = time_it(pagewise, self.repeat, reset)
+            self.record('ingest.insert_json', scale, len(records), times, pages=len(pages))
+
+
+    def query(self, station, scale, records):
+        self.load(station, records)
+        first = records[0].get('date')[:10]
+        last = records[-1].get('date')[:10]
+        year = records[len(records) // 2].get('date')[:4]
+        if self.wanted('query.get_records_year'):
+            times, found = time_it(lambda: self.db_conn.get_records(year + '-01-01', year + '-12-31'), self.repeat)
+            self.record('query.get_records_year', scale, len(found or []), times)
+        if self.wanted('query.get_records_all'):
+            times, found = time_it(lambda: self.db_conn.get_records(first, last), self.repeat)
+            self.record('query.get_records_all', scale, len(found or []), times)
+
+
+    def averages(self, station, scale, records):
+        self.load(station, records)
+        for method in METHODS:
+            name = 'averages.' + method
+            if not self.wanted(name):
+                continue
+
+            def build():
+                wa = weather.Averages()
+                wa.set_values(station, '1', None, None)
+                wa.build_averages(method)
+                return wa.year_list
+            if method == 'rollup':
+                # cold builds every rollup, warm just reads them
+                clear = lambda: self.db_conn.db['rollups'].delete_many({'station': station})
+                times, years = time_it(build, self.repeat, clear)
+                self.record(name + '_cold', scale, len(records), times, years=len(years))
+                times, years = time_it(build, self.repeat)
+                self.record(name + '_warm', scale, len(records), times, years=len(years))
+            else:
+                times, years = time_it(build, self.repeat)
+                self.record(name, scale, len(records), times, years=len(years))
+
+
+    def locations(self, count):
+        if not self.wanted('locations'):
+            return
+        collection = self.db_conn.db['stations']
+        collection.delete_many({})
+        collection.insert_many(synthetic_stations(count))
+        stations = db.Stations()
+        times, found = time_it(lambda: stations.get_locations(45, 5, -100, 5), self.repeat)
+        self.record('locations.get_locations', count, len(found or []), times)
+
+
+    def imports(self):
+        '''Import time of each CLI in a new interpreter, so nothing is
+        already loaded. The median is checked against IMPORT_BUDGET_MS.'''
+        if not self.wanted('imports'):
+            return
+        here = os.path.dirname(os.path.abspath(__file__))
+        for module, budget in IMPORT_BUDGET_MS.items():
+            script = IMPORT_SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+            times = []
+            for _ in range(self.repeat):
+                out = subprocess.check_output([sys.executable, '-c', script], cwd=here).decode().split()
+                times.append(float(out[0]))
+            heavy = out[1:]
+            over = statistics.median(times) * 1000 > budget or bool(heavy)
+            self.record('imports.' + module, 'cli', 0, times, budget_ms=budget,
+                        heavy_modules=heavy, over_budget=over)
+            if over:
+                print('> {} is over its import budget of {}ms{}'.format(
+                    module, budget, ', it loads ' + ', '.join(heavy) if heavy else ''), file=sys.stderr)
+
+
+    def fetch(self, station, scale, records):
+        windows = Dates().plan_windows(records[0].get('date')[:10], records[-1].get('date')[:10])
+        with StubNcdcServer(records) as server:
+            if self.wanted('fetch.ncdc_serial'):
+                def serial():
+                    client = NcdcWeather(station, 'benchmark', url=server.url)
+                    for start, end in windows:
+                        client.fetch_min_max_data(start, end)
+                    return client.requests
+                times, requests = time_it(serial, self.repeat)
+                self.record('fetch.ncdc_serial', scale, len(records), times, requests=requests)
+            if self.wanted('fetch.engine'):
+                def engine():
+                    fe = FetchEngine('benchmark', workers=4, per_second=10000, per_day=None, url=server.url)
+                    for result in fe.fetch([(station, s, e) for s, e in windows]):
+                        if result.error:
+                            raise result.error
+                    return fe.stats().get('requests')
+                times, requests = time_it(engine, self.repeat)
+                self.record('fetch.engine', scale, len(records), times, requests=requests, workers=4)
+
+
+    def run_scale(self, station, scale, records):
+        if self.wanted('ingest'):
+            self.ingest(station, scale, records)
+        if self.wanted('query'):
+            self.query(station, scale, records)
+        if self.wanted('averages'):
+            self.averages(station, scale, records)
+        if self.wanted('fetch'):
+            self.fetch(station, scale, records)
+
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('--years', default='10,50,100', help='Years of data per scale, comma delimited.')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Times each benchmark is run.')
+    parser.add_argument('-b', '--bench', help='Only these benchmarks (name prefixes), comma delimited.')
+    parser.add_argument('--stations', type=int, default=10000, help='Stations for the location search.')
+    parser.add_argument('--backend', choices=('auto', 'mongo', 'mongomock'), default='auto')
+    parser.add_argument('--ingest-limit', type=int, help='Most records timed for ingest per scale.')
+    parser.add_argument('--database', default='weather_benchmark', help='Database to use. It is dropped.')
+    parser.add_argument('-o', '--output', help='Write the json here instead of stdout.')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show detailed usage.')
+    args = parser.parse_args()
+
+    if args.verbose:
+        show_usage()
+
+    try:
+        scales = [int(y) for y in args.years.split(',') if y]
+    except ValueError:
+        print('> --years must be comma delimited integers.')
+        exit(1)
+
+    try:
+        backend = connect(args.backend, args.database)
+        db.get_client().drop_database(args.database)
+        mock = backend == 'mongomock'
+        ingest_limit = args.ingest_limit if args.ingest_limit or not mock else 1000
+        bench = Benchmark(args.repeat, args.bench.split(',') if args.bench else None,
+                          ingest_limit=ingest_limit, skip_indexes=mock)
+    except db.MongoDBException as e:
+        print(e.__str__())
+        exit(1)
+
+    nome = load_records(NOME_FILE)
+    stats = nome_stats(nome)
+    print('{:32}{:>10}{:>10}{:>13}'.format('benchmark', 'scale', 'records', 'median'), file=sys.stderr)
+    bench.run_scale('USW00026617', 'nome', nome)
+    for years in scales:
+        bench.run_scale('BENCH{:04d}'.format(years), '{}y'.format(years),
+                        synthetic_records('BENCH{:04d}'.format(years), years, stats))
+    bench.locations(args.stations)
+    bench.imports()
+
+    report = {'meta': {'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+                       'commit': git_commit(), 'backend': backend, 'repeat': args.repeat,
+                       'ingest_limit': ingest_limit, 'indexes': not mock,
+                       'python': platform.python_version(), 'platform': platform.platform(),
+                       'pymongo': pymongo.version, 'numpy': np.__version__},
+              'results': bench.results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    db.get_client().drop_database(args.database)
+    exit(0)
@@ -3,15 +3,20 @@ Main interface to the weather utilities
 Enter "python get_weather.py -v" for details on usage with examples.
 '''
 from utils.date_util import Dates
-from utils.ncdc import NcdcWeather
+from utils.http_cache import ResponseCache
+from utils.export import get_writer, pair_records, ExportException, FORMATS
 import utils.mongodb as db
+from utils import profiling
+import datetime
 import json
+import sys
 
 def show_usage():
     '''Long-winded / detailed usage'''
     print('get_weather.py usage'.center(80,'*'))
-    print('Description: Gets MIN / MAX tempurature data for a given weather station.\n')
+    print('Description: Gets MIN / MAX tempurature data for given weather station(s).\n')
     print('{:21s}=> Required: The station id for the request.'.format('[-i|--id]'))
+    print('\t\t\tSeveral stations can be given, comma delimited with no spaces.')
     print('{:21s}=> Required: The start date for the request. Format = yyyy[-mm-dd]'.format('[-s|--start]'))
     print('\t\t\tIf the format is yyyy, it is set to the beginning of the year')
     print('\t\t\tand loops through the entire year.')
@@ -21,15 +26,40 @@ def show_usage():
     print('{:21s}=> Optional. If the end date is not given, will just get for start date.'.format('[-e|--end]'))
     print('\t\t\tFormat = yyyy-mm[-dd].')
     print('\t\t\tIf format is yyyy-mm, -dd is set to the end of the month.')
-    print('\t\t\t*** yyyy must be the same for start and end dates.')
+    print('\t\t\tIf format is yyyy, it is set to the end of the year.')
+    print('\t\t\tThe range can cross years.')
     print('{:21s}=> Required if not [-d|--database]. The ncdc token to use.'.format('[-t|--token]'))
     print('{:21s}=> Optional. If supplied will make the request to local mongodb.'.format('[-d|--database]'))
     print('\t\t\tOtherwise it will pull from the ncdc weather site.')
     print('{:21s}=> Optional. Only used if you want ncdc data to go to stdout instead of'.format('[-o|--stdout]'))
     print('\t\t\tinserting in the database. Automatically set if [-d|--database].')
+    print('{:21s}=> Optional. Number of parallel requests to the ncdc site. Default is 4.'.format('[-w|--workers]'))
+    print('\t\t\tRequests are kept under the ncdc limits of 5 per second and 10,000 per day.')
+    print('{:21s}=> Optional. Use a different data url, like a local utils.stub_server.'.format('[--url]'))
+    print('{:21s}=> Optional. Keep ncdc responses on disk and answer repeated requests'.format('[--http-cache]'))
+    print('\t\t\tfrom there. Windows within 30 days of today expire after a day.')
+    print('{:21s}=> Optional. Stream the records to a csv, ndjson or parquet file'.format('[-f|--format]'))
+    print('\t\t\tinstead of printing them. One row per station and date with tmin')
+    print('\t\t\tand tmax. Works with [-d|--database] or the ncdc site (nothing is')
+    print('\t\t\tinserted). Parquet needs pyarrow and an [--output] file.')
+    print('{:21s}=> Optional. File for [-f|--format]. Default is stdout.'.format('[--output]'))
+    print('{:21s}=> Optional. Only fetch the dates in the range not already fetched for'.format('[--sync]'))
+    print('\t\t\teach station, from the coverage ledger in mongo. The end date')
+    print('\t\t\tdefaults to today. Every ncdc insert adds to the ledger, including')
+    print('\t\t\tranges that came back empty. The last 30 days are always fetched again.')
+    print('{:21s}=> Records each station\'s first through last date in mongo as fetched'.format('[--seed-coverage]'))
+    print('\t\t\tand exits. For stations loaded before the ledger existed.')
+    print('{:21s}=> Optional. Time the stages (ncdc requests, json decode, mongo reads and'.format('[--profile [MODE]]'))
+    print('\t\t\twrites) and print a breakdown on stderr at the end. MODE is breakdown')
+    print('\t\t\t(default), json or cprofile (breakdown plus a cProfile dump).')
+    print('{:21s}=> Optional. File for the json or cProfile output.'.format('[--profile-output]'))
+    print('{:21s}=> Rebuilds the local cache for the station(s) from mongo and exits.'.format('[--refresh-cache]'))
+    print('\t\t\tData older than 30 days is kept as memory mapped numpy arrays and')
+    print('\t\t\t[-d|--database] and plot_weather.py read from it without mongo.')
     print('\n{:21s}=> If provided, list collections in mongo and exits. No other options needed.'.format('[-l|--list]'))
-    print('\n\t\t\t**NOTE: All requests are broken down to a maximum of 7 days per db or ncdc call.')
-    print('\t\t\tIt will loop through 7 days at a time until the requested days are exhausted.')
+    print('\n\t\t\t**NOTE: Requests to mongo and ncdc are broken down by year.')
+    print('\t\t\tRequests to ncdc are sized to fill a page of 1000 records (up to a full year')
+    print('\t\t\tper call) and any extra pages are followed.')
     print('\nExamples:\n# Get a single day from ncdc and add to mongodb.')
     print('\tpython ./get_weather.py -i STATIONID -s 2016-02-10 -t MYTOKEN')
     print('\n# Get date range from ncdc and print to stdout.')
@@ -38,8 +68,16 @@ def show_usage():
     print('\tpython ./get_weather.py -i STATIONID -s 2016-02 -t MYTOKEN')
     print('\n# Get all of February and March of 2016 (leap year) from mongodb... stdout by default.')
     print('\tpython ./get_weather.py -d -i STATIONID -s 2016-02 -e 2016-03')
+    print('\n# Backfill 1950 through 1979 for two stations from ncdc and insert in mongo.')
+    print('\tpython ./get_weather.py -i STATIONID_1,STATIONID_2 -s 1950 -e 1979 -t MYTOKEN')
+    print('\n# Export 1950 through 2019 from mongodb to a csv file.')
+    print('\tpython ./get_weather.py -d -i STATIONID -s 1950 -e 2019 -f csv --output station.csv')
+    print('\n# Nightly update: fetch whatever is new since the last sync for three stations.')
+    print('\tpython ./get_weather.py -i STATIONID_1,STATIONID_2,STATIONID_3 -s 1950 --sync -t MYTOKEN')
     print('\n# Get minimum and maximum dates from mongodb and exit... stdout by default.')
     print('\tpython ./get_weather.py -i STATIONID -s minmax')
+    print('\n# Cache a station locally so database reads and plots don\'t need mongo.')
+    print('\tpython ./get_weather.py -i STATIONID --refresh-cache')
     print('\n# List current collections in mongo and exit... stdout by default.')
     print('\tpython ./get_weather.py -l')
     print('*' * 80)
@@ -74,16 +112,21 @@ def give_hint_and_exit():
     exit(1)
 
 
-def check_station_id(id):
-    '''Checks that the station id provided is in the weather.stations collection.
+def check_station_ids(ids):
+    '''Checks that the station ids provided are in the weather.stations collection.
     I added this since a call to ncdc with an invalid station just retuns an
-    empty json, which could be confused for no data for the date range given.'''
+    empty json, which could be confused for no data for the date range given.
+    All ids are checked with one query.'''
     try:
         s = db.Stations()
-        return True
+        found = s.get_stations(ids)
+        missing = [id for id in ids if id not in found]
     except db.MongoDBException as e:
         print(e.__str__())
         return False
+    for id in missing:
+        print('> Station {} is not in the stations collection.'.format(id))
+    return not missing
 
 
 def list_stations():
@@ -107,17 +150,60 @@ def send_to_print(data):
             print('{}: Max = {}'.format(rec.get('date').split('T')[0], rec.get('value')))
 
 
-def get_min_and_max_dates(id):
-    '''Show lowest and highest dates in mongo for the given station id'''
+def get_min_and_max_dates(ids):
+    '''Show lowest and highest dates in mongo for the given station ids'''
     try:
         d = db.WeatherDb()
-        d.check_for_collection(id)
-        d.set_collection(id)
-        min = d.get_min_date()
-        max = d.get_max_date()
-        print('{} - Min: {}\tMax: {}'.format(id, min, max))
     except db.MongoDBException as e:
         print(e.__str__())
+        exit(1)
+    for id in ids:
+        try:
+            d.check_for_collection(id)
+            d.set_collection(id)
+            min = d.get_min_date()
+            max = d.get_max_date()
+            print('{} - Min: {}\tMax: {}'.format(id, min, max))
+        except db.MongoDBException as e:
+            print(e.__str__())
+
+    exit(0)
+
+
+def seed_coverage(ids):
+    '''Record the dates already in mongo as fetched for the given station ids'''
+    try:
+        d = db.WeatherDb()
+        coverage = db.Coverage(d)
+        for id in ids:
+            day_range = coverage.seed(id)
+            if day_range is None:
+                print('{} - No data.'.format(id))
+            else:
+                print('{} - Covered {} - {}'.format(id, *day_range))
+    except db.MongoDBException as e:
+        print(e.__str__())
+        exit(1)
+
+    exit(0)
+
+
+def refresh_cache(ids):
+    '''Rebuild the local cache from mongo for the given station ids'''
+    from utils.cache import StationCache, CacheException
+    cache = StationCache()
+    try:
+        d = db.WeatherDb()
+    except db.MongoDBException as e:
+        print(e.__str__())
+        exit(1)
+    for id in ids:
+        try:
+            manifest = cache.refresh(id, d)
+            print('{} - {} records cached for {} - {}'.format(id, manifest.get('records'),
+                                                             *manifest.get('ranges')[0]))
+        except (db.MongoDBException, CacheException) as e:
+            print(e.__str__())
 
     exit(0)
 
@@ -126,13 +212,30 @@ if __name__ == '__main__':
     from argparse import ArgumentParser
 
     parser = ArgumentParser()
-    parser.add_argument('-i', '--id', help='Required. The station_id to use.')
+    parser.add_argument('-i', '--id', help='Required. The station_id to use. Can be several separated by comma, no spaces.')
     parser.add_argument('-d','--database', action='store_true', help='If supplied, will use the mongodb instead of the ncdc site.')
     parser.add_argument('-s', '--start', help='Required. The start date for the query or "min". Use -v for more informtion.')
     parser.add_argument('-e', '--end', help='The end date for the query or "max". If not supplied it will be a request for a single day.')
     parser.add_argument('-t', '--token', help='The token for the ncdc site. Not needed if -d is set.',
                         default='PLACE_YOUR_TOKEN_HERE')
     parser.add_argument('-o', '--stdout', action='store_true', help='Will print to stdout if supplied. If -d is set, it will be automatically set to stdout')
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='Number of parallel requests to the ncdc site. Default is 4.')
+    parser.add_argument('--url', help='Use a different data url. For example a local utils.stub_server.')
+    parser.add_argument('--http-cache', action='store_true',
+                        help='Keep ncdc responses on disk so repeated requests are not sent again.')
+    parser.add_argument('-f', '--format', choices=FORMATS,
+                        help='Stream the records to csv, ndjson or parquet instead of printing them.')
+    parser.add_argument('--output', help='Output file for --format. Default is stdout.')
+    parser.add_argument('--sync', action='store_true',
+                        help='Only fetch the dates not already fetched, from the coverage ledger.')
+    parser.add_argument('--seed-coverage', action='store_true',
+                        help='Records the dates already in mongo as fetched and exits.')
+    parser.add_argument('--profile', nargs='?', const='breakdown', choices=profiling.MODES,
+                        help='Print a per stage timing breakdown at the end (or json / cprofile).')
+    parser.add_argument('--profile-output', help='File for the --profile json or cProfile output.')
+    parser.add_argument('--refresh-cache', action='store_true',
+                        help='Rebuilds the local cache for the station(s) from mongo and exits.')
     parser.add_argument('-l', '--list', action='store_true', help='Prints list of collections and exits.')
     parser.add_argument('-v', '--verbose', action='store_true', help='Show detailed usage.')
     args = parser.parse_args()
@@ -141,6 +244,9 @@ if __name__ == '__main__':
     if args.verbose:
         show_usage()
 
+    if args.profile:
+        profiling.start(args.profile, args.profile_output)
+
     # -l was given. Show the collections in mongo then exit
     if args.list:
         list_stations()
@@ -149,10 +255,16 @@ if __name__ == '__main__':
     if args.id == None:
         print('> Station id is required.')
         give_hint_and_exit()
+    station_list = args.id.split(',')
 
     # We need a token for ncdc if not a db request
     from_database = args.database
     to_stdout = args.stdout
+    # an export never inserts, and keeps stdout for the data
+    export = args.format is not None
+    if export:
+        to_stdout = True
+    out = sys.stderr if export else sys.stdout
     if not from_database:
         # not a db request... need ncdc token
         if args.token == None:
@@ -164,18 +276,31 @@ if __name__ == '__main__':
         # so setting to_stdout
         to_stdout = True
 
+    if args.refresh_cache:
+        refresh_cache(station_list)
+
+    if args.seed_coverage:
+        seed_coverage(station_list)
+
+    if args.sync and to_stdout:
+        print('> --sync inserts into mongo. It can\'t be used with -d, -o or -f.')
+        give_hint_and_exit()
+
     if not args.start:
         print('> A start date is required.')
         give_hint_and_exit()
 
     # added to allow just retrieving the date range for the collection in mongo
     if args.start == 'minmax':
-        get_min_and_max_dates(args.id)
+        get_min_and_max_dates(station_list)
     # not minmax so check
     elif not check_date(args.start):
         give_hint_and_exit()
     start_date = args.start
-    if args.end == None:
+    if args.end == None and args.sync:
+        # sync up to today
+        end_date = datetime.date.today().isoformat()
+    elif args.end == None:
         # end not provided... set to start
         end_date = start_date
     else:
@@ -185,96 +310,192 @@ if __name__ == '__main__':
         # must be good, set the variable
         end_date = args.end
 
-    # Check that if both dates given year is the same
-    if start_date.split('-')[0] != end_date.split('-')[0]:
-        print('> Year must be the same for start and end dates.')
+    d = Dates()
+    # if not yyyy-mm-dd, set to either 01-01 or mm-01 for the start
+    # and 12-31 or the end of the month for the end
+    start_date = d.get_full_date(start_date, 0)
+    end_date = d.get_full_date(end_date, 1)
+    if start_date > end_date:
+        print('> The start date must come before the end date.')
         give_hint_and_exit()
 
-    # makes sure the station is in the stations collection.
-    if not check_station_id(args.id):
+    # makes sure the stations are in the stations collection.
+    if not from_database and not check_station_ids(station_list):
         exit(1)
 
-    # Get a yr variable to use for julian date manipulation
-    yr = int(start_date.split('-')[0])
-    d = Dates()
-    # get julian date for dates.
-    # if not yyyy-mm-dd, set to either 01-01 or mm-01
-    j_start = d.get_julian_date(start_date, 0)
-    j_end = d.get_julian_date(end_date, 1)
-
-    data_conn = None
+    # stations the local cache has the whole range for don't need mongo
+    cache = None
+    cached = []
+    if from_database:
+        # numpy is only loaded for the cache
+        from utils.cache import StationCache
+        cache = StationCache()
+        cached = [station_id for station_id in station_list
+                  if cache.covers(station_id, start_date, end_date)]
+
+    # one connection for all the stations
     db_conn = None
-    if not from_database:
-        # create ncdc instance
-        data_conn = NcdcWeather(args.id, args.token)
     if from_database or not to_stdout:
         try:
             # db connection needed. Either to retrieve or insert data
             db_conn = db.WeatherDb()
-            # If this request is for mongo, we don't want to create
-            # an empty collection.
-            if from_database:
-                # Check that it is an existing collection given that
-                # mongo will create it even without records.
-                db_conn.check_for_collection(args.id)
-            # set the collection to use from mongo.
-            # if this is an ncdc request, will create the collection
-            # if it doesn't already exist.
-            db_conn.set_collection(args.id)
+            for station_id in station_list:
+                if station_id in cached:
+                    continue
+                # If this request is for mongo, we don't want to create
+                # an empty collection.
+                if from_database:
+                    # Check that it is an existing collection given that
+                    # mongo will create it even without records.
+                    db_conn.check_for_collection(station_id)
+                # set the collection to use from mongo.
+                # if this is an ncdc request, will create the collection
+                # if it doesn't already exist.
+                db_conn.set_collection(station_id)
         except db.MongoDBException as e:
             print(e.__str__())
             exit(1)
 
-    # Control the while loop with Julian dates
-    current_j_day = j_start
-    while current_j_day <= j_end:
-        # we keep our request to a maximum of 7 days
-        if j_end - current_j_day > 6:
-            end_j_day = current_j_day + 6
-        else:
-            end_j_day = j_end
-
-        # Get our current yyyy-mm-dd dates converted from the julian dates
-        request_start_date = d.get_date(yr, current_j_day)
-        request_end_date = d.get_date(yr, end_j_day)
-        print('Processing dates: {} - {}'.format(request_start_date, request_end_date))
-        if from_database:
-            # for mongo I need to create a regex style pattern to send.
-            # We have our first and last ones. Get the others to make
-            # a pattern like 'yyyy-mm-dd|yyyy-mm-dd|...'
-            count = current_j_day + 1
-            pat = [request_start_date]
-            while count < end_j_day:
-                real_date = d.get_date(yr, count)
-                pat.append(real_date)
-                count += 1
-            pat.append(request_end_date)
-            return_data = db_conn.get_records('|'.join(x for x in pat))
-            # Was a database request... goes to stdout
-            if not return_data:
+    writer = None
+    if export:
+        try:
+            writer = get_writer(args.format, args.output)
+        except (ExportException, OSError) as e:
+            print(e.__str__())
+            exit(1)
+
+    if from_database:
+        # each window is a single range scan on the date index
+        # or a slice of the memory mapped cache
+        windows = d.plan_windows(start_date, end_date)
+        for station_id in station_list:
+            if station_id in cached:
+                get_records = lambda start, end: cache.get_records(station_id, start, end)
+            else:
+                db_conn.set_collection(station_id)
+                # the export reads the cursor as it writes
+                get_records = db_conn.iter_records if export else db_conn.get_records
+            for request_start_date, request_end_date in windows:
+                print('Processing {} dates: {} - {}'.format(station_id, request_start_date, request_end_date),
+                      file=out)
+                return_data = get_records(request_start_date, request_end_date)
+                if export:
+                    with profiling.timer('export.write'):
+                        writer.write_rows(pair_records(station_id, return_data or []))
+                    continue
+                # Was a database request... goes to stdout
+                if not return_data:
+                    print('No data.')
+                else:
+                    send_to_print(return_data)
+
+        if export:
+            writer.close()
+            print('{} rows exported.'.format(writer.rows), file=out)
+        exit(0)
+
+    # Request goes to the ncdc site. Windows are planned for every station
+    # up front, sized to fill a page. The engine runs them in parallel,
+    # handing each one back as it completes.
+    # requests is only loaded for the ncdc site
+    from utils.fetch import FetchEngine
+    http_cache = ResponseCache() if args.http_cache else None
+    engine = FetchEngine(args.token, workers=args.workers, url=args.url, cache=http_cache)
+    if not to_stdout:
+        # records are buffered across windows and written in large batches
+        writer = db_conn.bulk_writer()
+        coverage = db.Coverage(db_conn)
+    if args.sync:
+        # only the gaps in the ledger
+        try:
+            ledgers = coverage.get_many(station_list)
+        except db.MongoDBException as e:
+            print(e.__str__())
+            exit(1)
+        request_windows = [(station_id, s, e) for station_id in station_list
+                           for gap_start, gap_end in coverage.missing(station_id, start_date, end_date,
+                                                                      ledgers.get(station_id))
+                           for s, e in d.plan_windows(gap_start, gap_end)]
+        print('{} windows to sync for {} stations.'.format(len(request_windows), len(station_list)))
+    else:
+        request_windows = [(station_id, s, e) for station_id in station_list
+                           for s, e in d.plan_windows(start_date, end_date)]
+    failed = []
+    # windows fetched per station, for the coverage ledger
+    fetched = {station_id: [] for station_id in station_list}
+    empty = {station_id: [] for station_id in station_list}
+    # stations with records the BulkWriter couldn't write
+    write_failed = set()
+    # stdout keeps the date order, inserts take them as they come
+    for result in engine.fetch(request_windows, ordered=to_stdout):
+        print('Processing {} dates: {} - {}'.format(result.station, result.start, result.end), file=out)
+        if result.error:
+            print('There was an issue getting the requested data:', result.error, file=out)
+            failed.append(result)
+            continue
+        if export:
+            results = json.loads(result.text).get('results') or []
+            results.sort(key=lambda rec: (rec.get('date'), rec.get('datatype')))
+            with profiling.timer('export.write'):
+                writer.write_rows(pair_records(result.station, results))
+        elif to_stdout:
+            results = json.loads(result.text)
+            if not results.get('results'):
                 print('No data.')
             else:
-                send_to_print(return_data)
-
+                send_to_print(results.get('results'))
         else:
-            # Request goes to the ncdc site
-            return_data = data_conn.get_min_max_data(str(request_start_date), str(request_end_date))
-            if not return_data:
-                print('There was an issue getting the requested data.')
-                exit(1)
-            if to_stdout:
-                results = json.loads(return_data)
-                if not results.get('results'):
+            failed_before = writer.failed
+            try:
+                if writer.add_json(result.station, result.text) == 0:
                     print('No data.')
+                    empty[result.station].append((result.start, result.end))
                 else:
-                    send_to_print(results.get('results'))
-            else:
-                try:
-                    db_conn.insert_json(return_data)
-                except db.MongoDBException as e:
-                    print(e.__str__())
-
-        current_j_day = end_j_day + 1
+                    fetched[result.station].append((result.start, result.end))
+            except db.MongoDBException as e:
+                print(e.__str__())
+            # add_json writes a batch when the buffer fills
+            if writer.failed > failed_before:
+                write_failed.add(result.station)
+
+    if not to_stdout:
+        try:
+            # only once the records are written... and not for stations
+            # where ncdc reported records that weren't retrieved or some
+            # of the records couldn't be written, so a sync fetches again
+            for station_id in station_list:
+                failed_before = writer.failed
+                writer.flush(station_id)
+                if writer.failed > failed_before:
+                    write_failed.add(station_id)
+                if station_id in write_failed:
+                    print('> Some records for {} were not written, not added to the coverage ledger.'.format(
+                        station_id))
+                elif not engine.stats(station_id).get('dropped'):
+                    coverage.record(station_id, fetched[station_id], empty[station_id])
+        except db.MongoDBException as e:
+            print(e.__str__())
+        counts = writer.counts()
+        print('Inserted: {}\tDuplicates: {}\tFailed: {}'.format(
+            counts.get('inserted'), counts.get('duplicates'), counts.get('failed')))
+
+    if export:
+        writer.close()
+        print('{} rows exported.'.format(writer.rows), file=out)
+
+    stats = engine.stats()
+    print('{} requests made for {} windows.'.format(stats.get('requests'), len(request_windows)), file=out)
+    if stats.get('dropped'):
+        print('> {} records reported by ncdc were not retrieved.'.format(stats.get('dropped')), file=out)
+    if http_cache is not None:
+        cache_stats = http_cache.stats()
+        print('Response cache hits: {}\tMisses: {}\tEvictions: {}'.format(
+            cache_stats.get('hits'), cache_stats.get('misses'), cache_stats.get('evictions')), file=out)
+
+    if failed:
+        print('> {} of {} requests failed:'.format(len(failed), len(request_windows)), file=out)
+        for result in failed:
+            print('\t{} {} - {}'.format(result.station, result.start, result.end), file=out)
+        exit(1)
 
     exit(0)
-
@@ -0,0 +1,156 @@
+'''
+migrate.py
+Moves station collections between the records schema (a document per
+value) and the compact daily (a document per day) and monthly (a
+document per month) schemas.
+Enter "python migrate.py -v" for usage with examples.
+
+The station is copied into <station>.migrate a batch at a time, then the
+old collection is renamed to backup.<station> (or dropped) and the copy
+takes its name. Nothing is changed if the copy fails part way.
+'''
+import utils.mongodb as db
+from utils import compact
+import pymongo
+from pymongo.errors import PyMongoError
+
+BATCH_SIZE = 5000
+
+def show_usage():
+    '''Long-winded / detailed usage'''
+    print('migrate.py usage'.center(80,'*'))
+    print('Description: Moves station collections between the storage schemas.\n')
+    print('{:21s}=> Required: Station id(s) to migrate, comma delimited with no spaces.'.format('[-i|--id]'))
+    print('\t\t\tThe text "all" migrates every station collection.')
+    print('{:21s}=> Optional. daily (default), monthly or records.'.format('[--to]'))
+    print('\t\t\tdaily keeps one document per day with tmin / tmax as ints and the')
+    print('\t\t\tattributes packed in ints. monthly keeps the same values in arrays')
+    print('\t\t\twith one document per month, the fastest for plot_weather.py.')
+    print('\t\t\trecords is a document per ncdc value, the way get_weather.py has')
+    print('\t\t\talways inserted them.')
+    print('{:21s}=> Optional. Drop the old collection instead of keeping it as'.format('[--drop-old]'))
+    print('\t\t\tbackup.<station id>.')
+    print('\nNew stations get the schema in WEATHER_MONGO_SCHEMA (records by default).')
+    print('get_weather.py, plot_weather.py and the rest read any of them.')
+    print('\nExamples:\n# Move two stations to the daily schema, keeping backups.')
+    print('\tpython ./migrate.py -i STATIONID_1,STATIONID_2')
+    print('\n# Move a station to monthly documents.')
+    print('\tpython ./migrate.py -i STATIONID_1 --to monthly')
+    print('\n# Move everything back and drop the daily collections.')
+    print('\tpython ./migrate.py -i all --to records --drop-old')
+    print('*' * 80)
+    exit(0)
+
+
+
+def give_hint_and_exit():
+    '''One of the options is missing or incorrect. Show how to get
+    detailed usage.'''
+    print('Enter python migrate.py -v for detailed usage and examples')
+    exit(1)
+
+
+def _batches(items, size=BATCH_SIZE):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _date_batches(records, width, size=BATCH_SIZE):
+    '''Records sorted by date in batches of about size, never splitting
+    a day (width 10) or month (width 7) so each document is written once.'''
+    batch = []
+    for rec in records:
+        if len(batch) >= size and rec.get('date')[:width] != batch[-1].get('date')[:width]:
+            yield batch
+            batch = []
+        batch.append(rec)
+    if batch:
+        yield batch
+
+
+def migrate(db_conn, id, to='daily', drop_old=False):
+    '''Copies the station collection id into the schema to and swaps
+    it in. Returns (documents before, documents after) or None if
+    it is already in that schema.'''
+    if db_conn.schema(id) == to:
+        return None
+    source = db_conn.db[id]
+    target = db_conn.db[id + '.migrate']
+    target.drop()
+    try:
+        if db_conn.schema(id) == 'records':
+            records = (source.find({'datatype': {'$in': list(compact.FIELDS)}}, {'_id': 0})
+                       .sort('date', pymongo.ASCENDING).batch_size(BATCH_SIZE))
+        else:
+            records = compact.decode_docs(source.find().sort('_id', pymongo.ASCENDING).batch_size(BATCH_SIZE), id)
+        if to == 'daily':
+            for batch in _date_batches(records, 10):
+                target.insert_many(compact.encode_days(batch), ordered=False)
+        elif to == 'monthly':
+            for batch in _date_batches(records, 7):
+                target.insert_many(compact.encode_months(batch), ordered=False)
+        else:
+            for batch in _batches(records):
+                target.insert_many(batch, ordered=False)
+            target.create_index([('date', pymongo.ASCENDING), ('datatype', pymongo.ASCENDING)], unique=True)
+        before = source.estimated_document_count()
+        after = target.estimated_document_count()
+
+        if drop_old:
+            source.drop()
+        else:
+            db_conn.db.drop_collection(db.BACKUP_PREFIX + id)
+            source.rename(db.BACKUP_PREFIX + id)
+        target.rename(id)
+        # counted again the next time they are listed
+        db_conn.db['collection_stats'].delete_one({'_id': id})
+    except PyMongoError as e:
+        raise db.MongoDBException('Migrating {} failed: {}'.format(id, e))
+    db_conn._schemas.pop(id, None)
+    db_conn._indexed.discard(id)
+    return before, after
+
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('-i', '--id', help='Station id(s) to migrate, comma delimited with no spaces, or all.')
+    parser.add_argument('--to', choices=compact.SCHEMAS, default='daily', help='The schema to move to.')
+    parser.add_argument('--drop-old', action='store_true', help='Drop the old collection instead of a backup.')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show detailed usage.')
+    args = parser.parse_args()
+
+    if args.verbose:
+        show_usage()
+
+    if not args.id:
+        print('> A station id is required.')
+        give_hint_and_exit()
+
+    try:
+        db_conn = db.WeatherDb()
+        if args.id == 'all':
+            station_list = sorted(id for id in db_conn.db.list_collection_names()
+                                  if id not in db.RESERVED_COLLECTIONS and not id.startswith(db.BACKUP_PREFIX)
+                                  and not id.endswith('.migrate'))
+        else:
+            station_list = args.id.split(',')
+        for station_id in station_list:
+            db_conn.check_for_collection(station_id)
+            counts = migrate(db_conn, station_id, args.to, args.drop_old)
+            if counts is None:
+                print('{}: already {}'.format(station_id, args.to))
+            else:
+                print('{}: {} documents -> {} documents'.format(station_id, *counts))
+    except db.MongoDBException as e:
+        print(e.__str__())
+        exit(1)
+    exit(0)
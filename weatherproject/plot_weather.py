@@ -3,20 +3,58 @@ plot_weather.py
 Main method for interfacing with the weather.Averages class.
 Enter "python plot_weather.py -v" for usage with examples.
 
-Output: A plot of the station(s) and year(s) for a month.
+Output: A plot of the station(s) and year(s) for a month, or with
+--view all the months, the seasons or a heatmap from one read of each
+station (utils.climatology). With --batch, charts for a manifest of
+jobs are saved to files by worker processes (utils.render).
+matplotlib, pandas and the cache are only imported when a plot is made,
+so -v and -l start quickly.
 '''
 
-import matplotlib.pyplot as plt
 import  utils.weather as weather
+import utils.climatology as climatology
+import utils.render as render
+from utils import profiling
 
 def show_usage():
     print('plot_weather.py usage'.center(80,'*'))
     print('Description: Plots average tempurature data for given weather station(s) for given month and years.\n')
     print('{:21s}=> Required: The station id for the request.'.format('station_id(s)'))
     print('\t\t\tYou can provide up to three stations, comma delimited with no spaces.')
-    print('{:21s}=> Required: The month to average.'.format('month'))
+    print('{:21s}=> Required for the month view: The month to average.'.format('[-m|--month]'))
     print('{:21s}=> Optional: The start year for the request. Format = yyyy'.format('[-s|--start]'))
     print('{:21s}=> Optional: The end year for the request. Format = yyyy'.format('[-e|--end]'))
+    print('{:21s}=> Optional: How the averages are built. rollup (default) reads saved'.format('[--method]'))
+    print('\t\t\tmonthly sums, building any that are missing. aggregate has mongo')
+    print('\t\t\tdo the work in one query. numpy pulls the records in one query and')
+    print('\t\t\taverages with numpy. python pulls each year and averages here.')
+    print('\t\t\tGiving a method always reads mongo with it, the local cache is only')
+    print('\t\t\tused without one.')
+    print('{:21s}=> Optional: month (default) plots one month. The others read each'.format('[--view]'))
+    print('\t\t\tstation once and build a year x month table of means:')
+    print('\t\t\tmonths   a plot per month, January through December')
+    print('\t\t\tseasons  a plot per season (DJF, MAM, JJA, SON)')
+    print('\t\t\theatmap  year x month colors, one per station')
+    print('{:21s}=> Optional: Years for the normals, format yyyy-yyyy. Default is'.format('[--baseline]'))
+    print('\t\t\tall the years plotted. Only used with --anomalies.')
+    print('{:21s}=> Optional: For the months, seasons and heatmap views. Plot the'.format('[--anomalies]'))
+    print('\t\t\tdifference from the baseline normals instead of the means.')
+    print('{:21s}=> Optional: Number of stations averaged at the same time. Default is 4.'.format('[-w|--workers]'))
+    print('\t\t\tThe python method also splits each station\'s years over this many')
+    print('\t\t\tthreads. 1 does everything one after the other.')
+    print('{:21s}=> Optional: Always read from mongo. By default a station in the local'.format('[--no-cache]'))
+    print('\t\t\tcache (see get_weather.py --refresh-cache) is read from there.')
+    print('{:21s}=> Optional: Time the stages (mongo reads, averaging, plotting) and print'.format('[--profile [MODE]]'))
+    print('\t\t\ta breakdown on stderr at the end. MODE is breakdown (default), json')
+    print('\t\t\tor cprofile (breakdown plus a cProfile dump).')
+    print('{:21s}=> Optional: File for the json or cProfile output.'.format('[--profile-output]'))
+    print('\n{:21s}=> Render the jobs in a json manifest to files without a window and'.format('[--batch MANIFEST]'))
+    print('\t\t\texit. No other options needed. Each job is an object with stations')
+    print('\t\t\tand optionally month, start, end, view, method, anomalies, baseline')
+    print('\t\t\tand output (a file name). See utils/render.py.')
+    print('{:21s}=> Optional: Directory for the --batch charts. Default is the current one.'.format('[--output-dir]'))
+    print('{:21s}=> Optional: png (default) or svg for --batch.'.format('[--format]'))
+    print('{:21s}=> Optional: Number of --batch worker processes. Default is 4.'.format('[-p|--processes]'))
     print('\n{:21s}=> If provided, list collections in mongo and exits. No other options needed.'.format('[-l|--list]'))
     print('\nIf no start or end dates it will look for the minimum and maximum years in mongo.')
     print('It isn\'t required but if using more than one station,you should use dates.')
@@ -24,6 +62,10 @@ def show_usage():
     print('\tpython ./plot_weather.py -i STATIONID -m 1')
     print('Plot all January data for three stations between 1970 and 1990.')
     print('\tpython ./plot_weather.py -i STATIONID_1,STATIONID_2,STATIONID_3 -m 1 -s 1970 -e 1990')
+    print('Heatmap of the anomalies from the 1951-1980 normals for every month.')
+    print('\tpython ./plot_weather.py -i STATIONID --view heatmap --anomalies --baseline 1951-1980')
+    print('Render the charts in nightly.json to PNG files in charts/ with 8 processes.')
+    print('\tpython ./plot_weather.py --batch nightly.json --output-dir charts -p 8')
     print('\nIf plotting a single station, you get plots for monthly average, straight-line reqression,')
     print('and a moving average. If for more than one station, you only get the monthly averages.')
     print('*' * 80)
@@ -34,7 +76,7 @@ def show_usage():
 def give_hint_and_exit():
     '''One of the options is missing or incorrect. Show how to get
     detailed usage.'''
-    print('Enter python get_weather.py -v for detailed usage and examples')
+    print('Enter python plot_weather.py -v for detailed usage and examples')
     exit(1)
 
 
@@ -48,22 +90,44 @@ def list_stations():
 
     exit(0)
 
+
+def run_batch(args):
+    '''For --batch. Renders the manifest jobs to files and exits,
+    1 if any of them failed.'''
+    try:
+        jobs = render.read_manifest(args.batch)
+    except render.RenderException as e:
+        print(e.__str__())
+        exit(1)
+    from utils.cache import StationCache
+    cache_root = None if args.no_cache else StationCache().root
+    failed = 0
+    seconds = 0.0
+    with profiling.timer('plot.batch'):
+        for result in render.run_batch(jobs, args.output_dir, args.format, args.processes, cache_root):
+            seconds += result.get('seconds')
+            if result.get('error'):
+                failed += 1
+                print('Job {} failed: {}'.format(result.get('index'), result.get('error')))
+            else:
+                rss = result.get('rss_mb')
+                print('{}\t{:.2f}s{}'.format(result.get('path'), result.get('seconds'),
+                                             '\t{:.0f} MB'.format(rss) if rss else ''))
+    print('{} charts, {} failed, {:.2f}s a chart.'.format(len(jobs), failed, seconds / len(jobs) if jobs else 0))
+    exit(1 if failed else 0)
+
+
 if __name__ == '__main__':
     '''
     Sets up the ArgumentParser and validates.
     The station id's provided will be placed in station_list[].
-    After all the house keeping, the main loop iterates through
-    the station_list, saving the id to variable station_id and then
-    using the index of that list element to create an instance of the
-    weather.Averages class and puts the plots together based on the
-    class instance DataFrame.
+    After all the house keeping, weather.build_many builds a
+    weather.Averages for each station in parallel and utils.render
+    draws them. --batch hands a manifest to utils.render.run_batch.
     '''
     from argparse import ArgumentParser
 
     station_list = [] # list to hold the stations
-    # Dict to convert month number for plot title
-    month_names = {1: 'January', 2: 'February', 3: 'March', 4: 'April', 5: 'May', 6: 'June',
-                   7: 'July', 8: 'August', 9: 'September', 10: 'October', 11: 'November', 12: 'December'}
 
     parser = ArgumentParser()
     parser.add_argument('-i', '--id',
@@ -72,6 +136,24 @@ if __name__ == '__main__':
     parser.add_argument('-s', '--start', help='Optional. The start year (yyyy). Will pull lowest from the database if not provided.')
     parser.add_argument('-e', '--end',
                         help='Optional. The end year (yyyy). Will pull highest from the database if not provided.')
+    parser.add_argument('--method', choices=['rollup', 'aggregate', 'numpy', 'python'],
+                        help='How the averages are built. Default is rollup (saved monthly sums), or the cache.')
+    parser.add_argument('--view', default='month', choices=render.VIEWS,
+                        help='month (default), or months / seasons / heatmap from one read of each station.')
+    parser.add_argument('--baseline', help='Years for the normals, yyyy-yyyy. Default is all the years.')
+    parser.add_argument('--anomalies', action='store_true',
+                        help='Plot differences from the baseline normals (months, seasons and heatmap views).')
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='Number of stations averaged at the same time. Default is 4.')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Always read from mongo, even if the local cache has the station.')
+    parser.add_argument('--profile', nargs='?', const='breakdown', choices=profiling.MODES,
+                        help='Print a per stage timing breakdown at the end (or json / cprofile).')
+    parser.add_argument('--profile-output', help='File for the --profile json or cProfile output.')
+    parser.add_argument('--batch', help='Render the jobs in this json manifest to files and exit.')
+    parser.add_argument('--output-dir', default='.', help='Directory for the --batch charts.')
+    parser.add_argument('--format', default='png', choices=render.FORMATS, help='png (default) or svg for --batch.')
+    parser.add_argument('-p', '--processes', type=int, default=4, help='Number of --batch worker processes.')
     parser.add_argument('-l', '--list', action='store_true', help='Prints list of collections and exits.')
     parser.add_argument('-v', '--verbose', action='store_true', help='Show detailed usage.')
     args = parser.parse_args()
@@ -80,10 +162,20 @@ if __name__ == '__main__':
     if args.verbose:
         show_usage()
 
+    if args.profile:
+        profiling.start(args.profile, args.profile_output)
+
     # -l was given. Show the collections in mongo then exit
     if args.list:
         list_stations()
 
+    if args.batch:
+        run_batch(args)
+
+    if not args.id:
+        print('A station id is required.')
+        give_hint_and_exit()
+
     # I put a limit of 5... it is just arbitrary
     # remove it if you want more
     if args.id.count(',') > 5:
@@ -95,14 +187,22 @@ if __name__ == '__main__':
         station_list.append(sid)
 
     # make sure month can be converted to int
-    try:
-        int(args.month)
-    except ValueError:
-        print('Month is not an integer value.')
-        give_hint_and_exit()
+    if args.view == 'month':
+        try:
+            int(args.month)
+        except (TypeError, ValueError):
+            print('Month is not an integer value.')
+            give_hint_and_exit()
 
     month = args.month
 
+    baseline = None
+    if args.baseline:
+        baseline = render.parse_baseline(args.baseline)
+        if baseline is None:
+            print('Baseline must be yyyy-yyyy')
+            give_hint_and_exit()
+
     # check year formats
     start_year = None
     if args.start:
@@ -120,32 +220,51 @@ if __name__ == '__main__':
             print('End year must be 4 integers: yyyy')
             exit(1)
 
+    if start_year is not None and end_year is not None and start_year > end_year:
+        print('Start year must not be after the end year.')
+        give_hint_and_exit()
 
-    try:
-        for idx in range(len(station_list)):
-            # get the station_id before a class object eats it!
-            station_id = station_list[idx]
-            station_list[idx] = weather.Averages()
+    import matplotlib.pyplot as plt
+    from utils.cache import StationCache
 
-            station_list[idx].set_values(station_id, month, start_year, end_year)
+    # an explicit method is what gets timed and compared, so no cache
+    cache = None if args.no_cache or args.method else StationCache()
+    method = args.method or 'rollup'
 
+    if args.view != 'month':
+        try:
+            climates = climatology.build_many(station_list, start_year, end_year, baseline, cache, args.workers)
+        except climatology.ClimatologyException as e:
+            print(e.__str__())
+            exit(1)
+        for clim in climates:
+            print('Station id: {}\tYears: {}-{}'.format(clim.station_id, clim.start_year, clim.end_year))
+        with profiling.timer('plot.render'):
+            fig = plt.figure(figsize=render.figure_size(args.view, len(climates)))
+            render.draw_climate(render.make_axes(fig, args.view, len(climates)), climates,
+                                args.view, args.anomalies)
+            if args.view != 'heatmap':
+                fig.tight_layout()
+            fig.canvas.draw()
+        with profiling.timer('plot.show'):
+            plt.show()
+        exit(0)
+
+    try:
+        averages = weather.build_many(station_list, month, start_year, end_year, method,
+                                      cache, args.workers)
+        for station_id in station_list:
             print('Station id: {}\tMonth: {}'.format(station_id, month))
-            ret = station_list[idx].build_averages()
-            plt.plot(station_list[idx].frame[['year']], station_list[idx].frame[['avg']], label=station_id)
-
-        # if it were only 1, print the regression and ma lines
-        if len(station_list) == 1:
-            plt.plot(station_list[0].year_list, station_list[0].polyvalue,
-                     linestyle='-', color='r', label='SL Regression')
-            plt.plot(station_list[0].frame[['year']], station_list[0].frame[['avg']].rolling(station_list[0].rollingvalue).mean(center=True),
-                 linestyle='-', color='g', label='Moving Avg')
-
-        plt.title('{} Averages'.format(month_names.get(int(month))))
-        plt.xlabel('Year')
-        plt.ylabel('Temp')
-        plt.grid()
-        plt.legend()
-        plt.show()
+
+        with profiling.timer('plot.render'):
+            fig = plt.figure()
+            # if it were only 1, also the regression and ma lines
+            render.draw_month(render.make_axes(fig, 'month'), averages, month)
+            # draw now so the time isn't counted as plot.show
+            fig.canvas.draw()
+        # blocks until the window is closed
+        with profiling.timer('plot.show'):
+            plt.show()
 
     except weather.WeatherException as e:
         print(e.__str__())
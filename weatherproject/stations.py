@@ -1,10 +1,85 @@
+'''
+stations.py
+Tk GUI to search the stations collection by latitude / longitude.
+
+A search runs on a background thread that reads the cursor in chunks
+and puts them on a queue. The Tk loop picks them up with after(), so
+the window keeps responding however many stations match. Starting a
+new search cancels the one running. Only one page of results is in
+the text area at a time, use Prev / Next to move through them.
+'''
+import queue
+import threading
 import tkinter as tk
 from tkinter import Menu
 from tkinter import ttk
 from tkinter import scrolledtext
 from tkinter import messagebox as mBox
+from pymongo.errors import PyMongoError
 from utils.mongodb import Stations
 
+# stations handed to the Tk loop at a time
+CHUNK_SIZE = 500
+# rows shown in the text area at a time
+PAGE_SIZE = 200
+# ms between looks at the queue while a search is running
+POLL_MS = 50
+
+
+def format_row(result):
+    '''One line of the results. A station missing a field gets a blank.'''
+    def number(value):
+        return '{:.3f}'.format(value) if isinstance(value, (int, float)) else ''
+    return '{:20}{:30}{:<15}{:>15}\n'.format(str(result.get('station_id') or ''), str(result.get('name') or ''),
+                                              number(result.get('lat')), number(result.get('lon')))
+
+
+class SearchWorker(threading.Thread):
+    '''Reads the stations for one search and puts (search_id, kind, value)
+    on results: ('chunk', list of stations) as they come, then
+    ('done', None), or ('error', message). cancel() stops it at the
+    next station and nothing more is put.'''
+    def __init__(self, search_id, db_conn, args, results):
+        threading.Thread.__init__(self, daemon=True)
+        self.search_id = search_id
+        self.db_conn = db_conn
+        self.args = args
+        self.results = results
+        self.cancelled = threading.Event()
+
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+    def run(self):
+        try:
+            cursor = self.db_conn.iter_locations(*self.args, batch_size=CHUNK_SIZE)
+            try:
+                chunk = []
+                for rec in cursor:
+                    if self.cancelled.is_set():
+                        return
+                    chunk.append(rec)
+                    if len(chunk) == CHUNK_SIZE:
+                        self.results.put((self.search_id, 'chunk', chunk))
+                        chunk = []
+                if chunk:
+                    self.results.put((self.search_id, 'chunk', chunk))
+            finally:
+                cursor.close()
+        except PyMongoError as e:
+            self.results.put((self.search_id, 'error', e.__str__()))
+            return
+        except Exception as e:
+            # anything else would end the thread with the window still
+            # showing searching...
+            self.results.put((self.search_id, 'error', '{}: {}'.format(type(e).__name__, e)))
+            return
+        self.results.put((self.search_id, 'done', None))
+
+
+
 class OOP():
 
     def __init__(self):
@@ -12,8 +87,16 @@ class OOP():
         self.win.title('NCDC Weather Stations')
         self.createWidgets()
         self.db_conn = Stations()
+        # chunks from the SearchWorker, read on the Tk thread
+        self.queue = queue.Queue()
+        self.worker = None
+        self.searchId = 0
+        self.searching = False
+        self.results = []
+        self.page = 0
 
     def _quit(self):
+        self._cancelSearch()
         self.win.quit()
         self.win.destroy()
         exit()
@@ -68,21 +151,92 @@ class OOP():
                 self.lonValue.set('')
                 return
 
-        # Variables are valid. Clear ScrolledText.
-        self.resultText.delete('1.0', tk.END)
+        # Variables are valid. Stop any search still running and start over.
+        self._cancelSearch()
+        self.searchId += 1
+        self.results = []
+        self.page = 0
+        self.searching = True
+        self._showPage()
 
-        # Send request to the mongo class Stations
-        results = self.db_conn.get_locations(lat, latpm, lon,lonpm)
+        # The mongo class Stations is read on the worker thread
+        self.worker = SearchWorker(self.searchId, self.db_conn, (lat, latpm, lon, lonpm), self.queue)
+        self.worker.start()
+        self.win.after(POLL_MS, self._pollResults)
 
-        # Stations will return None if results were empty.
-        if results == None:
+
+    def _cancelSearch(self):
+        '''Tells the running search to stop. Anything it already queued
+        is dropped by _pollResults since the search id changes.'''
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker = None
+        self.searching = False
+
+
+    def _pollResults(self):
+        '''Takes the queued chunks for the current search and redraws the
+        page if they landed on it. Runs again while the search is going.'''
+        changed = False
+        while True:
+            try:
+                search_id, kind, value = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if search_id != self.searchId:
+                # from a cancelled search
+                continue
+            if kind == 'chunk':
+                self.results.extend(value)
+                changed = True
+            else:
+                self.searching = False
+                self.worker = None
+                changed = True
+                if kind == 'error':
+                    self._searchMsgBox('Search failed: {}'.format(value))
+
+        if changed:
+            self._showPage()
+        if self.searching:
+            self.win.after(POLL_MS, self._pollResults)
+
+
+    def _showPage(self):
+        '''Puts the current page of results in the ScrolledText with one
+        insert and updates the page label and buttons.'''
+        pages = max(1, (len(self.results) + PAGE_SIZE - 1) // PAGE_SIZE)
+        self.page = min(self.page, pages - 1)
+        first = self.page * PAGE_SIZE
+        rows = self.results[first:first + PAGE_SIZE]
+
+        self.resultText.delete('1.0', tk.END)
+        if rows:
+            self.resultText.insert(tk.INSERT, ''.join(format_row(result) for result in rows))
+        elif not self.searching:
             self.resultText.insert(tk.INSERT, 'No results found.')
+
+        if rows:
+            status = 'Stations {}-{} of {}'.format(first + 1, first + len(rows), len(self.results))
         else:
-            for result in results:
-                self.resultText.insert(tk.INSERT, '{:20}{:30}{:<15.3f}{:15.3f}\n'.format(
-                    result.get('station_id'), result.get('name'),
-                    result.get('lat'), result.get('lon'))
-                )
+            status = ''
+        if self.searching:
+            status = (status + ' (searching...)').strip()
+        self.pageLabel.configure(text=status)
+        self.prevBtn.state(['!disabled'] if self.page > 0 else ['disabled'])
+        self.nextBtn.state(['!disabled'] if self.page < pages - 1 else ['disabled'])
+
+
+    def prevBtnClick(self):
+        if self.page > 0:
+            self.page -= 1
+            self._showPage()
+
+
+    def nextBtnClick(self):
+        if (self.page + 1) * PAGE_SIZE < len(self.results):
+            self.page += 1
+            self._showPage()
 
 
 
@@ -149,5 +303,15 @@ class OOP():
         self.resultText = scrolledtext.ScrolledText(self.win, width=80, height=20)
         self.resultText.grid(column=0, columnspan=4, pady=5)
 
+        # paging for the results
+        self.prevBtn = ttk.Button(self.win, text='< Prev', command=self.prevBtnClick)
+        self.prevBtn.grid(column=0, row=5, pady=5, padx=5, sticky='w')
+        self.pageLabel = ttk.Label(self.win, text='')
+        self.pageLabel.grid(column=1, columnspan=2, row=5, pady=5)
+        self.nextBtn = ttk.Button(self.win, text='Next >', command=self.nextBtnClick)
+        self.nextBtn.grid(column=3, row=5, pady=5, padx=5, sticky='e')
+        self.prevBtn.state(['disabled'])
+        self.nextBtn.state(['disabled'])
+
 oop= OOP()
 oop.win.mainloop()
\ No newline at end of file
@@ -0,0 +1,49 @@
+'''
+Shared fixtures. mongo is a mongomock client standing in for the
+server, so the tests run without mongod, an ncdc token or the network.
+Run from the weatherproject directory:
+    python -m pytest -q
+'''
+import os
+import sys
+
+import mongomock
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PROJECT = os.path.dirname(HERE)
+sys.path.insert(0, PROJECT)
+
+import utils.mongodb as db
+from utils.stub_server import StubNcdcServer, load_records
+
+STATION = 'USW00026617'
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    '''Keeps the local caches out of ~/.cache.'''
+    monkeypatch.setenv('WEATHER_CACHE_DIR', str(tmp_path / 'cache'))
+    return tmp_path / 'cache'
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    '''Every WeatherDb made in the test gets the same empty mongomock client.'''
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(db.pymongo, 'MongoClient', lambda *args, **kwargs: client)
+    monkeypatch.setattr(db, '_clients', {})
+    return client
+
+
+@pytest.fixture(scope='session')
+def records():
+    '''The nome january records from the sample export.'''
+    return load_records(os.path.join(PROJECT, 'nome_ak_Jan.json'))
+
+
+@pytest.fixture
+def stub(records):
+    '''A stub ncdc server on a free port.'''
+    with StubNcdcServer(records) as server:
+        yield server
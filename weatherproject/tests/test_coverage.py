@@ -0,0 +1,52 @@
+import utils.mongodb as db
+from utils import jobs
+from utils.fetch import TokenBucket
+
+from conftest import STATION
+
+
+def test_missing_skips_recorded_ranges(mongo):
+    coverage = db.Coverage(db.WeatherDb())
+    coverage.record(STATION, [('1950-01-01', '1950-06-30')], [('1951-01-01', '1951-12-31')])
+    assert coverage.missing(STATION, '1950-01-01', '1952-12-31') == [('1950-07-01', '1950-12-31'),
+                                                                     ('1952-01-01', '1952-12-31')]
+    assert coverage.get(STATION).get('empty') == [('1951-01-01', '1951-12-31')]
+
+
+def test_recent_days_are_not_recorded(mongo):
+    coverage = db.Coverage(db.WeatherDb(), settle_days=30)
+    coverage.record(STATION, [('1950-01-01', '2999-12-31')])
+    fetched = coverage.get(STATION).get('fetched')
+    assert fetched[0][0] == '1950-01-01' and fetched[0][1] < '2999-12-31'
+
+
+def run_one(stub, db_conn, writer):
+    queue = jobs.JobQueue(db_conn, backoff=0)
+    coverage = db.Coverage(db_conn)
+    queue.enqueue([(STATION, '1950-01-01', '1950-12-31')])
+    job = queue.claim('test')
+    done = jobs._run_job(job, queue, {}, writer, coverage, 'token', stub.url, None,
+                         TokenBucket(100), None)
+    return done, queue, coverage
+
+
+def test_window_goes_in_the_ledger(mongo, stub):
+    db_conn = db.WeatherDb()
+    done, queue, coverage = run_one(stub, db_conn, db_conn.bulk_writer())
+    assert done
+    assert queue.counts().get('done') == 1
+    assert coverage.get(STATION).get('fetched') == [('1950-01-01', '1950-12-31')]
+
+
+def test_failed_write_stays_out_of_the_ledger(mongo, stub, monkeypatch):
+    db_conn = db.WeatherDb()
+    writer = db_conn.bulk_writer()
+    def failing(id, records):
+        writer.failed += len(records)
+    monkeypatch.setattr(writer, '_write', failing)
+
+    done, queue, coverage = run_one(stub, db_conn, writer)
+    assert not done
+    assert queue.counts().get('pending') == 1
+    assert coverage.get(STATION).get('fetched') == []
+    assert coverage.missing(STATION, '1950-01-01', '1950-12-31') == [('1950-01-01', '1950-12-31')]
@@ -0,0 +1,46 @@
+from utils.http_cache import ResponseCache
+from utils.ncdc import NcdcWeather
+
+from conftest import STATION
+
+
+def fetch(stub, cache):
+    client = NcdcWeather(STATION, 'token', limit=100, url=stub.url, cache=cache)
+    text = client.fetch_min_max_data('1950-01-01', '1951-12-31')
+    return client, text
+
+
+def test_warm_cache_makes_no_requests(stub, tmp_path):
+    cold, text = fetch(stub, ResponseCache(str(tmp_path / 'http')))
+    assert cold.requests > 1
+    served = stub.request_count
+
+    # a new instance reads what the first one left on disk
+    cache = ResponseCache(str(tmp_path / 'http'))
+    warm, again = fetch(stub, cache)
+    assert again == text
+    assert warm.requests == 0
+    assert stub.request_count == served
+    assert cache.hits == cold.requests
+
+
+def test_other_url_is_a_miss(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'http'))
+    key = cache.key('http://a/data', STATION, 'GHCND', ['TMIN', 'TMAX'], '1950-01-01', '1950-12-31',
+                    'standard', 1000, 1)
+    cache.put(key, '{}')
+    other = cache.key('http://b/data', STATION, 'GHCND', ['TMAX', 'TMIN'], '1950-01-01', '1950-12-31',
+                      'standard', 1000, 1)
+    assert cache.get(key, '1950-12-31') == '{}'
+    assert cache.get(other, '1950-12-31') is None
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'http'), max_bytes=25)
+    cache.put('a.json', 'x' * 10)
+    cache.put('b.json', 'x' * 10)
+    cache.get('a.json', '1950-12-31')
+    cache.put('c.json', 'x' * 10)
+    assert cache.get('b.json', '1950-12-31') is None
+    assert cache.get('a.json', '1950-12-31') is not None
+    assert cache.evictions == 1
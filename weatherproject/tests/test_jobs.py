@@ -0,0 +1,92 @@
+import time
+
+import utils.mongodb as db
+from utils.jobs import JobQueue, PENDING, CLAIMED, DONE, FAILED
+
+WINDOWS = [('A', '1950-01-01', '1950-12-31'), ('A', '1951-01-01', '1951-12-31')]
+
+
+def queue(**kwargs):
+    return JobQueue(db.WeatherDb(), **kwargs)
+
+
+def status(mongo, job):
+    return mongo['weather']['jobs'].find_one({'_id': job.get('_id')})
+
+
+def test_enqueue_keeps_existing_windows(mongo):
+    q = queue()
+    assert q.enqueue(WINDOWS) == 2
+    q.ack(q.claim('w1'), 10)
+    assert q.enqueue(WINDOWS) == 0
+    assert q.counts().get(DONE) == 1 and q.counts().get(PENDING) == 1
+
+
+def test_claim_and_ack(mongo):
+    q = queue()
+    q.enqueue(WINDOWS)
+    first, second = q.claim('w1'), q.claim('w2')
+    assert first.get('_id') != second.get('_id')
+    assert q.claim('w3') is None
+    q.ack(first, 10)
+    assert status(mongo, first).get('status') == DONE
+    assert q.counts().get('records') == 10
+
+
+def test_fail_backs_off_then_gives_up(mongo):
+    q = queue(max_attempts=2, backoff=60)
+    q.enqueue(WINDOWS[:1])
+    job = q.claim('w1')
+    q.fail(job, 'boom')
+    rec = status(mongo, job)
+    assert rec.get('status') == PENDING and rec.get('not_before') > time.time()
+    # still backing off
+    assert q.claim('w1') is None
+    assert 0 < q.next_wait() <= 60
+
+    mongo['weather']['jobs'].update_one({'_id': job.get('_id')}, {'$set': {'not_before': 0}})
+    job = q.claim('w1')
+    assert job.get('attempts') == 2
+    q.fail(job, 'boom again')
+    assert status(mongo, job).get('status') == FAILED
+    assert [rec.get('error') for rec in q.failed()] == ['boom again']
+
+    assert q.retry_failed() == 1
+    assert q.claim('w1').get('attempts') == 1
+
+
+def test_not_retryable_fails_at_once(mongo):
+    q = queue()
+    q.enqueue(WINDOWS[:1])
+    job = q.claim('w1')
+    q.fail(job, 'bad station', retryable=False)
+    assert status(mongo, job).get('status') == FAILED
+
+
+def test_expired_lease_is_claimed_again(mongo):
+    q = queue(lease=60)
+    q.enqueue(WINDOWS[:1])
+    job = q.claim('dead')
+    assert q.claim('w1') is None
+    mongo['weather']['jobs'].update_one({'_id': job.get('_id')}, {'$set': {'lease_until': 0}})
+    again = q.claim('w1')
+    assert again.get('_id') == job.get('_id') and again.get('worker') == 'w1'
+    # the dead worker's late ack doesn't touch it
+    q.ack(job, 10)
+    assert status(mongo, job).get('status') == CLAIMED
+
+
+def test_release_doesnt_count_the_attempt(mongo):
+    q = queue()
+    q.enqueue(WINDOWS[:1])
+    job = q.claim('w1')
+    q.release(job)
+    assert q.claim('w1').get('attempts') == 1
+
+
+def test_requests_today(mongo):
+    q = queue()
+    q.add_requests(3)
+    q.add_requests(0)
+    queue().add_requests(2)
+    assert q.requests_today() == 5
@@ -0,0 +1,71 @@
+import utils.mongodb as db
+
+from conftest import STATION
+
+
+def load(mongo, records):
+    # straight in, mongomock's upserts are slow
+    mongo['weather'][STATION].insert_many([dict(rec) for rec in records])
+    db_conn = db.WeatherDb()
+    db_conn.set_collection(STATION)
+    return db_conn, db.Rollups(db_conn)
+
+
+def test_get_month_builds_and_reuses(mongo, records):
+    db_conn, rollups = load(mongo, records)
+    first = rollups.get_month(STATION, 1, 1950, 1952)
+    assert sorted(first) == [1950, 1951, 1952]
+    assert mongo['weather']['rollups'].count_documents({'stale': False}) == 3
+
+    calls = []
+    real = db_conn.get_month_stats
+    db_conn.get_month_stats = lambda month, years: calls.append(years) or real(month, years)
+    again = rollups.get_month(STATION, 1, 1950, 1952)
+    assert {yr: rec.get('tmin_sum') for yr, rec in again.items()} == \
+        {yr: rec.get('tmin_sum') for yr, rec in first.items()}
+    assert calls == []
+
+
+def test_empty_month_is_not_saved(mongo, records):
+    db_conn, rollups = load(mongo, records)
+    assert rollups.get_month(STATION, 1, 2020, 2020) == {}
+    assert mongo['weather']['rollups'].count_documents({}) == 0
+
+
+def test_new_records_invalidate_and_rebuild(mongo, records):
+    held = [rec for rec in records if rec.get('date').startswith('1950-01-05')]
+    db_conn, rollups = load(mongo, [rec for rec in records if rec not in held])
+    before = rollups.get_month(STATION, 1, 1950, 1950)[1950]
+
+    writer = db_conn.bulk_writer()
+    writer.add(STATION, held)
+    writer.flush()
+    cell = mongo['weather']['rollups'].find_one({'_id': STATION + ':1950-01'})
+    assert cell.get('stale') and cell.get('v') == 1
+
+    after = rollups.get_month(STATION, 1, 1950, 1950)[1950]
+    assert after.get('days') == before.get('days') + 1
+    assert not mongo['weather']['rollups'].find_one({'_id': STATION + ':1950-01'}).get('stale')
+
+
+def test_invalidate_during_rebuild_stays_stale(mongo, records):
+    held = [rec for rec in records if rec.get('date').startswith('1950-01-05')]
+    db_conn, rollups = load(mongo, [rec for rec in records if rec not in held])
+    rollups.get_month(STATION, 1, 1950, 1950)
+    rollups.invalidate(STATION, ['1950-01'])
+
+    real = db_conn.get_month_stats
+    def racing(month, years):
+        stats = real(month, years)
+        writer = db_conn.bulk_writer()
+        writer.add(STATION, held)
+        writer.flush()
+        return stats
+    db_conn.get_month_stats = racing
+    rollups.get_month(STATION, 1, 1950, 1950)
+    db_conn.get_month_stats = real
+
+    # the rebuild read v 1, the insert made it 2
+    assert mongo['weather']['rollups'].find_one({'_id': STATION + ':1950-01'}).get('stale')
+    days = rollups.get_month(STATION, 1, 1950, 1950)[1950].get('days')
+    assert days == len({rec.get('date') for rec in records if rec.get('date').startswith('1950-01')})
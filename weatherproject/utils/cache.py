@@ -0,0 +1,168 @@
+'''
+Local columnar cache of station records.
+
+Data older than a month doesn't change once it is in mongo, so it
+can be kept on disk as NumPy arrays and read back with memory mapping
+instead of going through a pymongo cursor. Each station gets a
+directory under the cache root:
+    day.npy       datetime64[D], sorted
+    datatype.npy  int8 (utils.columnar codes)
+    value.npy     float32
+    manifest.json {"station", "ranges": [[start, end], ...], "records", "built", "stale"}
+The ranges in the manifest are the yyyy-mm-dd date ranges the arrays
+cover. Readers check covers() first and go to mongo if it doesn't.
+utils.mongodb.BulkWriter calls mark_stale when it adds records inside
+a cached range, and a stale station covers nothing until refresh().
+
+The root is $WEATHER_CACHE_DIR or ~/.cache/ncdc_weather.
+'''
+import datetime
+import json
+import os
+import numpy as np
+from utils.columnar import StationFrame, TMIN, TMAX
+from utils import profiling
+
+# days before today that are still treated as changing
+RECENT_DAYS = 30
+DATATYPE_NAMES = {TMIN: 'TMIN', TMAX: 'TMAX'}
+
+
+class CacheException(Exception):
+    pass
+
+
+class StationCache:
+    '''Create an instance with the cache root directory (optional).'''
+    def __init__(self, root=None):
+        if root is None:
+            root = os.environ.get('WEATHER_CACHE_DIR',
+                                  os.path.join(os.path.expanduser('~'), '.cache', 'ncdc_weather'))
+        self.root = root
+
+
+    def path(self, station, name=''):
+        return os.path.join(self.root, station, name)
+
+
+    def manifest(self, station):
+        '''Returns the manifest dict, or None if the station isn't cached.'''
+        try:
+            with open(self.path(station, 'manifest.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+
+    def covers(self, station, start_day, end_day):
+        '''True if one of the cached ranges holds start_day through end_day.'''
+        manifest = self.manifest(station)
+        if manifest is None or manifest.get('stale'):
+            return False
+        for first, last in manifest.get('ranges', []):
+            if first <= start_day and end_day <= last:
+                return True
+        return False
+
+
+    def mark_stale(self, station, dates):
+        '''Marks the station stale if any of the dates (yyyy-mm-dd...)
+        fall in a cached range. Returns True if it was marked.'''
+        manifest = self.manifest(station)
+        if manifest is None or manifest.get('stale'):
+            return False
+        ranges = manifest.get('ranges', [])
+        if not any(first <= date[:10] <= last for date in dates for first, last in ranges):
+            return False
+        manifest['stale'] = True
+        try:
+            self._write_manifest(station, manifest)
+        except OSError as e:
+            raise CacheException('Could not mark {} stale: {}'.format(station, e))
+        return True
+
+
+    def _write_manifest(self, station, manifest):
+        tmp = self.path(station, 'manifest.tmp.json')
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp, self.path(station, 'manifest.json'))
+
+
+    def year_range(self, station):
+        '''Returns (first_year, last_year) of whole years cached, or None.'''
+        manifest = self.manifest(station)
+        if not manifest or not manifest.get('ranges'):
+            return None
+        first, last = manifest.get('ranges')[0]
+        first_year = int(first[:4]) if first[5:] == '01-01' else int(first[:4]) + 1
+        last_year = int(last[:4]) if last[5:] == '12-31' else int(last[:4]) - 1
+        if first_year > last_year:
+            return None
+        return first_year, last_year
+
+
+    def load(self, station, start_day=None, end_day=None):
+        '''Returns a StationFrame over the memory mapped arrays,
+        sliced to start_day through end_day if given.'''
+        profiling.count('cache.loads')
+        try:
+            day = np.load(self.path(station, 'day.npy'), mmap_mode='r')
+            datatype = np.load(self.path(station, 'datatype.npy'), mmap_mode='r')
+            value = np.load(self.path(station, 'value.npy'), mmap_mode='r')
+        except OSError as e:
+            raise CacheException('No cache for {}: {}'.format(station, e))
+
+        lo = 0
+        hi = len(day)
+        # day is sorted so a range is a slice
+        if start_day is not None:
+            lo = np.searchsorted(day, np.datetime64(start_day), side='left')
+        if end_day is not None:
+            hi = np.searchsorted(day, np.datetime64(end_day), side='right')
+        return StationFrame(day[lo:hi], datatype[lo:hi], value[lo:hi])
+
+
+    def get_records(self, station, start_day, end_day=None):
+        '''Same as WeatherDb.get_records but from the cache.
+        Returns a list of date, datatype and value dicts or None.'''
+        if end_day is None:
+            end_day = start_day
+        frame = self.load(station, start_day, end_day)
+        if len(frame) == 0:
+            return None
+        return [{'date': str(day) + 'T00:00:00', 'datatype': DATATYPE_NAMES.get(int(dt)), 'value': float(val)}
+                for day, dt, val in zip(frame.day, frame.datatype, frame.value)]
+
+
+    def refresh(self, station, db_conn, end_day=None):
+        '''Rewrites the cache for the station from mongo, from the first
+        record through end_day (default RECENT_DAYS before today).
+        db_conn is a WeatherDb. Returns the manifest.'''
+        if end_day is None:
+            end_day = (datetime.date.today() - datetime.timedelta(RECENT_DAYS)).isoformat()
+        db_conn.check_for_collection(station)
+        db_conn.set_collection(station)
+        start_day = db_conn.get_min_date()
+        if start_day > end_day:
+            raise CacheException('No data for {} before {}.'.format(station, end_day))
+
+        frame = StationFrame.from_records(db_conn.get_records(start_day, end_day))
+        # get_records sorts by date and datatype
+        os.makedirs(self.path(station), exist_ok=True)
+        # nothing reads the arrays while they are swapped one at a time
+        # (or after a crash part way), the new manifest goes in last
+        old = self.manifest(station)
+        if old is not None and not old.get('stale'):
+            old['stale'] = True
+            self._write_manifest(station, old)
+        names = ('day', 'datatype', 'value')
+        for name, arr in zip(names, (frame.day, frame.datatype, frame.value)):
+            np.save(self.path(station, name + '.tmp.npy'), arr)
+        for name in names:
+            os.replace(self.path(station, name + '.tmp.npy'), self.path(station, name + '.npy'))
+
+        manifest = {'station': station, 'ranges': [[start_day, end_day]], 'records': len(frame),
+                    'built': datetime.datetime.now().isoformat(timespec='seconds')}
+        self._write_manifest(station, manifest)
+        return manifest
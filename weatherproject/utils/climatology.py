@@ -0,0 +1,159 @@
+'''
+Year x month climatology for a station from one read of its records.
+
+weather.Averages works one month at a time, so a twelve month report
+is twelve passes over the same station. Climatology reads the years
+once (from the local cache if it covers them, else one mongo range
+scan), pairs min / max by day with utils.columnar.StationFrame and keeps:
+- avg, tmin, tmax: DataFrames indexed by year with a column per month
+  (1-12) of the paired daily means, NaN where there is no data
+- days: same shape, the number of paired days behind each mean
+- normals: Series by month, the mean of avg over the baseline years
+- anomalies: avg less normals
+Everything else (seasons, a month's series) is worked out from those
+without going back to the database. pandas (and numpy with
+StationFrame) are imported when a Climatology is built.
+'''
+import utils.mongodb as db
+from utils import profiling
+from concurrent.futures import ThreadPoolExecutor
+
+MONTHS = list(range(1, 13))
+# December counts toward the next year's winter
+SEASONS = {'DJF': (12, 1, 2), 'MAM': (3, 4, 5), 'JJA': (6, 7, 8), 'SON': (9, 10, 11)}
+
+
+class ClimatologyException(Exception):
+    pass
+
+
+class Climatology:
+    '''Create an instance, then build(station_id, ...).
+    cache: optional utils.cache.StationCache to read from when it can.
+    '''
+    def __init__(self, cache=None):
+        try:
+            self.db_conn = db.WeatherDb()
+        except db.MongoDBException as e:
+            raise ClimatologyException(e.__str__())
+        self.cache = cache
+        self.station_id = None
+        self.avg = None
+        self.normals = None
+        self.anomalies = None
+
+
+    def build(self, station_id, start_year=None, end_year=None, baseline=None):
+        '''Reads the station once for start_year through end_year (the
+        years in mongo if not given) and builds the matrices.
+        baseline is (first_year, last_year) for the normals, default all
+        the years read.'''
+        self.station_id = station_id
+        frame = self._load(start_year, end_year)
+        with profiling.timer('climatology.matrix'):
+            self._set_matrices(frame.month_year_means())
+            self.set_baseline(baseline)
+        return self
+
+
+    def _load(self, start_year, end_year):
+        '''One StationFrame for the years, from the cache or mongo.'''
+        from utils.columnar import StationFrame
+        years = self.cache.year_range(self.station_id) if self.cache is not None else None
+        if years is not None:
+            first = years[0] if start_year is None else int(start_year)
+            last = years[1] if end_year is None else int(end_year)
+            start_day, end_day = '{}-01-01'.format(first), '{}-12-31'.format(last)
+            if self.cache.covers(self.station_id, start_day, end_day):
+                self.start_year, self.end_year = first, last
+                return self.cache.load(self.station_id, start_day, end_day)
+
+        try:
+            self.db_conn.check_for_collection(self.station_id)
+            self.db_conn.set_collection(self.station_id)
+            self.start_year = int(start_year if start_year is not None else self.db_conn.get_min_date()[:4])
+            self.end_year = int(end_year if end_year is not None else self.db_conn.get_max_date()[:4])
+            records = self.db_conn.iter_records('{}-01-01'.format(self.start_year),
+                                                '{}-12-31'.format(self.end_year))
+            with profiling.timer('mongo.climatology_records'):
+                frame = StationFrame.from_records(records)
+        except db.MongoDBException as e:
+            raise ClimatologyException(e.__str__())
+        profiling.count('mongo.records_read', len(frame))
+        return frame
+
+
+    def _set_matrices(self, means):
+        import pandas as pd
+        years = pd.Index(range(self.start_year, self.end_year + 1), name='year')
+
+        def matrix(column):
+            table = means.pivot(index='year', columns='month', values=column)
+            return table.reindex(index=years, columns=MONTHS)
+
+        self.avg = matrix('avg')
+        self.tmin = matrix('tmin')
+        self.tmax = matrix('tmax')
+        self.days = matrix('days').fillna(0).astype(int)
+
+
+    def set_baseline(self, baseline=None):
+        '''Works out the normals and anomalies for (first_year, last_year),
+        or all the years. Can be called again for a different baseline.'''
+        if baseline is None:
+            baseline = (self.start_year, self.end_year)
+        first, last = int(baseline[0]), int(baseline[1])
+        self.baseline = (first, last)
+        self.normals = self.avg.loc[first:last].mean()
+        self.anomalies = self.avg - self.normals
+
+
+    def month(self, month, anomalies=False):
+        '''Series by year for one month.'''
+        table = self.anomalies if anomalies else self.avg
+        return table[int(month)]
+
+
+    def seasons(self, anomalies=False):
+        '''DataFrame by year with a column per season, the mean of its
+        three monthly means. December is moved to the next year's DJF.
+        A season missing a month is NaN.'''
+        import pandas as pd
+        table = self.anomalies if anomalies else self.avg
+        shifted = table.copy()
+        shifted[12] = table[12].shift(1)
+        return pd.DataFrame({name: shifted[list(months)].mean(axis=1, skipna=False)
+                             for name, months in SEASONS.items()})
+
+
+    def annual(self, anomalies=False):
+        '''Series by year, the mean of the twelve months. NaN if one is missing.'''
+        table = self.anomalies if anomalies else self.avg
+        return table.mean(axis=1, skipna=False)
+
+
+    def long_frame(self):
+        '''One row per year and month with data: station, year, month,
+        tmin, tmax, days, avg and anomaly.'''
+        import pandas as pd
+        stacked = pd.DataFrame({'tmin': self.tmin.stack(), 'tmax': self.tmax.stack(),
+                                'avg': self.avg.stack(), 'anomaly': self.anomalies.stack()}).dropna(subset=['avg'])
+        stacked.index.names = ['year', 'month']
+        stacked = stacked.reset_index()
+        stacked['days'] = self.days.values[stacked['year'] - self.start_year, stacked['month'] - 1]
+        stacked.insert(0, 'station', self.station_id)
+        return stacked[['station', 'year', 'month', 'tmin', 'tmax', 'days', 'avg', 'anomaly']]
+
+
+
+def build_many(station_ids, start_year=None, end_year=None, baseline=None, cache=None, workers=4):
+    '''Same as weather.build_many for Climatology. Returns them in
+    station_ids order.'''
+    def build(station_id):
+        return Climatology(cache).build(station_id, start_year, end_year, baseline)
+
+    if workers <= 1 or len(station_ids) == 1:
+        return [build(station_id) for station_id in station_ids]
+    with ThreadPoolExecutor(max_workers=min(workers, len(station_ids))) as pool:
+        futures = [pool.submit(build, station_id) for station_id in station_ids]
+    return [f.result() for f in futures]
@@ -0,0 +1,106 @@
+'''
+Columnar core for a station's daily records.
+
+StationFrame holds the records as three typed arrays:
+- day: datetime64[D]
+- datatype: int8 code (TMIN = 0, TMAX = 1)
+- value: float32
+Min and max are paired by day with a vectorized join and the means
+are grouped with bincount, so there are no per record python loops
+once the arrays are built. pandas is only imported by the methods
+that hand back a DataFrame.
+'''
+import numpy as np
+
+TMIN = 0
+TMAX = 1
+DATATYPE_CODES = {'TMIN': TMIN, 'TMAX': TMAX}
+
+
+class StationFrame:
+    '''Create an instance from the three arrays, or use from_records.'''
+    def __init__(self, day, datatype, value):
+        self.day = np.asarray(day, dtype='datetime64[D]')
+        self.datatype = np.asarray(datatype, dtype=np.int8)
+        self.value = np.asarray(value, dtype=np.float32)
+
+
+    @classmethod
+    def from_records(cls, records):
+        '''Builds the arrays from records with date, datatype and value
+        like WeatherDb.get_records returns. Datatypes other than TMIN
+        and TMAX are dropped.'''
+        days = []
+        types = []
+        values = []
+        for rec in records or []:
+            code = DATATYPE_CODES.get(rec.get('datatype'))
+            if code is None:
+                continue
+            days.append(rec.get('date')[:10])
+            types.append(code)
+            values.append(rec.get('value'))
+        return cls(np.array(days, dtype='datetime64[D]'), types, values)
+
+
+    def __len__(self):
+        return len(self.day)
+
+
+    def paired(self):
+        '''Returns (day, tmin, tmax) arrays for the days that have both.'''
+        is_min = self.datatype == TMIN
+        is_max = self.datatype == TMAX
+        # each day appears once per datatype (unique index), so a
+        # sorted intersect lines them up
+        days, imin, imax = np.intersect1d(self.day[is_min], self.day[is_max],
+                                          assume_unique=True, return_indices=True)
+        return days, self.value[is_min][imin], self.value[is_max][imax]
+
+
+    def _group_means(self, groups, tmin, tmax):
+        '''Means of tmin and tmax for each distinct value in groups.
+        Returns keys, day counts, tmin means, tmax means.'''
+        keys, inverse = np.unique(groups, return_inverse=True)
+        counts = np.bincount(inverse)
+        tmin_mean = np.bincount(inverse, weights=tmin) / counts
+        tmax_mean = np.bincount(inverse, weights=tmax) / counts
+        return keys, counts, tmin_mean, tmax_mean
+
+
+    def month_year_means(self):
+        '''DataFrame with one row per year and month that has paired days:
+        year, month, tmin, tmax, days and avg ((tmin + tmax) / 2).'''
+        import pandas as pd
+        days, tmin, tmax = self.paired()
+        # months since 1970-01
+        months = days.astype('datetime64[M]').astype(np.int64)
+        keys, counts, tmin_mean, tmax_mean = self._group_means(months, tmin, tmax)
+        return pd.DataFrame({
+            'year': keys // 12 + 1970,
+            'month': keys % 12 + 1,
+            'tmin': tmin_mean,
+            'tmax': tmax_mean,
+            'days': counts,
+            'avg': (tmin_mean + tmax_mean) / 2})
+
+
+    def yearly_means(self):
+        '''Same columns as month_year_means less month, one row per year.'''
+        import pandas as pd
+        days, tmin, tmax = self.paired()
+        years = days.astype('datetime64[Y]').astype(np.int64) + 1970
+        keys, counts, tmin_mean, tmax_mean = self._group_means(years, tmin, tmax)
+        return pd.DataFrame({'year': keys, 'tmin': tmin_mean, 'tmax': tmax_mean,
+                             'days': counts, 'avg': (tmin_mean + tmax_mean) / 2})
+
+
+    def monthly_means(self):
+        '''Same columns as month_year_means less year, one row per
+        month over all the years.'''
+        import pandas as pd
+        days, tmin, tmax = self.paired()
+        months = days.astype('datetime64[M]').astype(np.int64) % 12 + 1
+        keys, counts, tmin_mean, tmax_mean = self._group_means(months, tmin, tmax)
+        return pd.DataFrame({'month': keys, 'tmin': tmin_mean, 'tmax': tmax_mean,
+                             'days': counts, 'avg': (tmin_mean + tmax_mean) / 2})
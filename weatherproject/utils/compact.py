@@ -0,0 +1,231 @@
+'''
+Compact storage for a station's daily observations.
+
+The records schema keeps every ncdc value as its own document:
+    date "1910-01-01T00:00:00", datatype "TMAX", station "GHCND:...",
+    attributes ",,6,2400", value 32.0
+about 170 bytes of bson a value plus the date_1_datatype_1 index.
+The daily schema keeps one document per station day:
+    _id    the day as a native date (midnight UTC), which is also the index
+    tmin   int (a float only if the value isn't whole)
+    tmax   int
+    fmin   the TMIN attributes packed in an int (pack_attributes)
+    fmax   the TMAX attributes packed in an int
+    attrs  {'TMIN': str, 'TMAX': str}, only for attributes that don't pack
+about 58 bytes a day for both values, and no second index.
+A missing value leaves its fields out.
+The monthly schema keeps one document per station month:
+    _id    the first of the month as a native date
+    tmin, tmax, fmin, fmax
+           arrays with an entry per day of the month (day 1 at 0),
+           None for a missing value. Created full size so a value is
+           written with $set on its position ("tmin.4").
+    attrs  {'TMIN': {'4': str}}, only for attributes that don't pack
+so a month for Averages is one document instead of about 62.
+
+utils.mongodb.WeatherDb works out which schema a collection uses and
+its readers hand back the same date / datatype / value records either way.
+migrate.py moves collections between the two.
+'''
+import calendar
+import datetime
+
+SCHEMAS = ('records', 'daily', 'monthly')
+# datatype: (value field, flags field)
+FIELDS = {'TMIN': ('tmin', 'fmin'), 'TMAX': ('tmax', 'fmax')}
+# the flags GHCND uses, ' ' for none. 6 bits each.
+FLAG_CHARS = ' ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+
+
+def pack_attributes(attributes):
+    '''Packs "mflag,qflag,sflag,hhmm" in an int: the three flags in
+    6 bits each and the time + 1 in 12 bits (0 for no time).
+    Returns None if they don't fit, and the string is kept instead.'''
+    parts = (attributes or '').split(',')
+    if len(parts) != 4:
+        return None
+    bits = 0
+    for flag in parts[:3]:
+        code = FLAG_CHARS.find(flag or ' ')
+        if len(flag) > 1 or code < 0:
+            return None
+        bits = bits << 6 | code
+    hhmm = parts[3]
+    if hhmm == '':
+        return bits << 12
+    if len(hhmm) != 4 or not hhmm.isdigit():
+        return None
+    return bits << 12 | (int(hhmm) + 1)
+
+
+def unpack_attributes(bits):
+    '''The attributes string pack_attributes was given.'''
+    hhmm = bits & 0xFFF
+    flags = [FLAG_CHARS[bits >> shift & 0x3F].strip() for shift in (24, 18, 12)]
+    return ','.join(flags + ['{:04d}'.format(hhmm - 1) if hhmm else ''])
+
+
+def to_day(date):
+    '''yyyy-mm-dd[Thh:mm:ss] to the datetime stored as _id.'''
+    return datetime.datetime.strptime(date[:10], '%Y-%m-%d')
+
+
+def day_bounds(start_day, end_day):
+    '''Same as mongodb.date_bounds but on the native _id dates.'''
+    return {'$gte': to_day(start_day), '$lt': to_day(end_day) + datetime.timedelta(1)}
+
+
+def to_month(date):
+    '''yyyy-mm[-dd...] to the datetime stored as a monthly _id.'''
+    return datetime.datetime(int(date[:4]), int(date[5:7]), 1)
+
+
+def month_bounds(start_day, end_day):
+    '''The monthly _id's holding start_day through end_day.'''
+    return {'$gte': to_month(start_day), '$lte': to_month(end_day)}
+
+
+def month_ids(month, years):
+    '''The monthly _id's for the month in each of the years.'''
+    return [datetime.datetime(int(yr), int(month), 1) for yr in years]
+
+
+def empty_month(month):
+    '''The arrays for a new monthly document, month is its _id.'''
+    days = calendar.monthrange(month.year, month.month)[1]
+    return {field: [None] * days for field in ('tmin', 'tmax', 'fmin', 'fmax')}
+
+
+def _number(value):
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+def value_fields(rec):
+    '''Returns {field: value} to $set for one ncdc record,
+    or None if it isn't a TMIN or TMAX.'''
+    fields = FIELDS.get(rec.get('datatype'))
+    if fields is None:
+        return None
+    value_field, flags_field = fields
+    update = {value_field: _number(rec.get('value'))}
+    bits = pack_attributes(rec.get('attributes'))
+    if bits is not None:
+        update[flags_field] = bits
+    elif rec.get('attributes') is not None:
+        update['attrs.' + rec.get('datatype')] = rec.get('attributes')
+    return update
+
+
+def month_fields(rec):
+    '''value_fields with the array position for the record's day,
+    {'tmin.4': -3, 'fmin.4': 94208}, or None.'''
+    update = value_fields(rec)
+    if update is None:
+        return None
+    day = int(rec.get('date')[8:10]) - 1
+    return {'{}.{}'.format(field, day): value for field, value in update.items()}
+
+
+def encode_days(records):
+    '''Day documents for records (any order). Returns a list sorted by day.'''
+    days = {}
+    for rec in records:
+        update = value_fields(rec)
+        if update is None:
+            continue
+        day = to_day(rec.get('date'))
+        doc = days.setdefault(day, {'_id': day})
+        for field, value in update.items():
+            if field.startswith('attrs.'):
+                doc.setdefault('attrs', {})[field[6:]] = value
+            else:
+                doc[field] = value
+    return [days[day] for day in sorted(days)]
+
+
+def encode_months(records):
+    '''Monthly documents for records (any order). Returns a list sorted by month.'''
+    months = {}
+    for rec in records:
+        update = value_fields(rec)
+        if update is None:
+            continue
+        month = to_month(rec.get('date'))
+        doc = months.get(month)
+        if doc is None:
+            doc = months[month] = dict(empty_month(month), _id=month)
+        day = int(rec.get('date')[8:10]) - 1
+        for field, value in update.items():
+            if field.startswith('attrs.'):
+                doc.setdefault('attrs', {}).setdefault(field[6:], {})[str(day)] = value
+            else:
+                doc[field][day] = value
+    return [months[month] for month in sorted(months)]
+
+
+def decode_doc(doc, station=None):
+    '''The records (TMAX then TMIN, like get_records sorts them) in a day
+    document. With station, the records also have station and
+    attributes, the way ncdc sends them.'''
+    date = doc.get('_id').strftime('%Y-%m-%dT00:00:00')
+    records = []
+    for datatype in ('TMAX', 'TMIN'):
+        value_field, flags_field = FIELDS.get(datatype)
+        if value_field not in doc:
+            continue
+        rec = {'date': date, 'datatype': datatype, 'value': float(doc.get(value_field))}
+        if station is not None:
+            rec['station'] = 'GHCND:' + station
+            if flags_field in doc:
+                rec['attributes'] = unpack_attributes(doc.get(flags_field))
+            else:
+                rec['attributes'] = doc.get('attrs', {}).get(datatype, '')
+        records.append(rec)
+    return records
+
+
+def decode_month(doc, station=None):
+    '''Same as decode_doc for a monthly document, in date order.'''
+    month = doc.get('_id')
+    attrs = doc.get('attrs', {})
+    columns = {field: doc.get(field) or [] for field in ('tmin', 'tmax', 'fmin', 'fmax')}
+    records = []
+    for day in range(max(len(columns.get('tmin')), len(columns.get('tmax')))):
+        date = None
+        for datatype in ('TMAX', 'TMIN'):
+            value_field, flags_field = FIELDS.get(datatype)
+            values = columns.get(value_field)
+            if day >= len(values) or values[day] is None:
+                continue
+            if date is None:
+                date = '{:%Y-%m}-{:02d}T00:00:00'.format(month, day + 1)
+            rec = {'date': date, 'datatype': datatype, 'value': float(values[day])}
+            if station is not None:
+                rec['station'] = 'GHCND:' + station
+                flags = columns.get(flags_field)
+                if day < len(flags) and flags[day] is not None:
+                    rec['attributes'] = unpack_attributes(flags[day])
+                else:
+                    rec['attributes'] = attrs.get(datatype, {}).get(str(day), '')
+            records.append(rec)
+    return records
+
+
+def is_month(doc):
+    return isinstance(doc.get('tmin'), list) or isinstance(doc.get('tmax'), list)
+
+
+def decode_docs(docs, station=None, start_day=None, end_day=None):
+    '''Generator over the records in day or monthly documents.
+    start_day / end_day (yyyy-mm-dd) drop the days of a month outside them.'''
+    last = end_day + 'T99' if end_day else None
+    for doc in docs:
+        if not is_month(doc):
+            for rec in decode_doc(doc, station):
+                yield rec
+            continue
+        for rec in decode_month(doc, station):
+            if (start_day and rec.get('date') < start_day) or (last and rec.get('date') > last):
+                continue
+            yield rec
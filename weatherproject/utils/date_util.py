@@ -52,3 +52,69 @@ class Dates:
         return j
 
 
+    def get_full_date(self, dt, val=0):
+        """Returns dt as yyyy-mm-dd.
+            dt = yyyy, yyyy-mm, yyyy-mm-dd
+            val works the same as get_julian_date: 0 for the first
+            day of the month or year, 1 for the last.
+        """
+        ymd = dt.split('-')
+        if len(ymd) == 3:
+            return dt
+        if len(ymd) == 1:
+            return dt + ('-01-01' if val == 0 else '-12-31')
+        if val == 0:
+            return dt + '-01'
+        return dt + '-{:02d}'.format(self.__get_last_day_of_month__(ymd[0], ymd[1]))
+
+
+    def plan_windows(self, start_day, end_day, rows_per_day=2, limit=1000):
+        """Returns a list of (start, end) yyyy-mm-dd tuples covering
+        start_day through end_day, each sized so one ncdc page of
+        limit records holds every row (rows_per_day = number of datatypes).
+        Windows never cross a year boundary since the ncdc site
+        limits daily data requests to a one year range."""
+        days = max(1, limit // rows_per_day)
+        start = datetime.datetime.strptime(start_day, self.fmt)
+        end = datetime.datetime.strptime(end_day, self.fmt)
+        windows = []
+        while start <= end:
+            year_end = datetime.datetime(start.year, 12, 31)
+            window_end = min(start + datetime.timedelta(days - 1), year_end, end)
+            windows.append((start.strftime(self.fmt), window_end.strftime(self.fmt)))
+            start = window_end + datetime.timedelta(1)
+        return windows
+
+
+    def merge_ranges(self, ranges):
+        """Returns the (start, end) yyyy-mm-dd ranges sorted with
+        overlapping and touching ranges joined."""
+        merged = []
+        for start, end in sorted(ranges):
+            if merged:
+                last_end = datetime.datetime.strptime(merged[-1][1], self.fmt)
+                if start <= (last_end + datetime.timedelta(1)).strftime(self.fmt):
+                    merged[-1][1] = max(merged[-1][1], end)
+                    continue
+            merged.append([start, end])
+        return [tuple(r) for r in merged]
+
+
+    def missing_ranges(self, ranges, start_day, end_day):
+        """Returns the (start, end) ranges within start_day through
+        end_day that none of ranges cover."""
+        missing = []
+        day = start_day
+        for start, end in self.merge_ranges(ranges):
+            if end < day:
+                continue
+            if start > end_day:
+                break
+            if start > day:
+                before = datetime.datetime.strptime(start, self.fmt) - datetime.timedelta(1)
+                missing.append((day, before.strftime(self.fmt)))
+            day = (datetime.datetime.strptime(end, self.fmt) + datetime.timedelta(1)).strftime(self.fmt)
+            if day > end_day:
+                return missing
+        missing.append((day, end_day))
+        return missing
@@ -0,0 +1,172 @@
+'''
+Streaming export of min / max records.
+
+Records are read lazily (a mongo cursor, a cache slice or one ncdc
+window at a time), paired into one row per station and date:
+    station, date, tmin, tmax
+and written with a buffered writer, so memory stays flat no matter
+how many years are exported.
+Writers:
+    csv      CsvWriter
+    ndjson   NdjsonWriter
+    parquet  ParquetWriter, one row group per row_group_size rows.
+             Needs pyarrow, which is optional and only imported
+             when a ParquetWriter is made.
+'''
+import csv
+import datetime
+import json
+import sys
+
+# pyarrow modules, set by _load_pyarrow
+pa = None
+pq = None
+
+COLUMNS = ['station', 'date', 'tmin', 'tmax']
+FORMATS = ('csv', 'ndjson', 'parquet')
+
+
+class ExportException(Exception):
+    pass
+
+
+def pair_records(station, records):
+    '''Generator of (station, date, tmin, tmax) from records sorted by date.
+    A missing min or max is None.'''
+    day = None
+    row = None
+    for rec in records:
+        rec_day = rec.get('date')[:10]
+        if rec_day != day:
+            if row is not None:
+                yield tuple(row)
+            day = rec_day
+            row = [station, day, None, None]
+        if rec.get('datatype') == 'TMIN':
+            row[2] = rec.get('value')
+        elif rec.get('datatype') == 'TMAX':
+            row[3] = rec.get('value')
+    if row is not None:
+        yield tuple(row)
+
+
+
+class _TextWriter:
+    '''Opens path for writing with a large buffer, or uses stdout.'''
+    def __init__(self, path=None, buffer_size=1 << 20):
+        if path is None or path == '-':
+            self.f = sys.stdout
+            self.close_file = False
+        else:
+            self.f = open(path, 'w', buffering=buffer_size, newline='')
+            self.close_file = True
+        self.rows = 0
+
+
+    def close(self):
+        self.f.flush()
+        if self.close_file:
+            self.f.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+class CsvWriter(_TextWriter):
+    def __init__(self, path=None):
+        super().__init__(path)
+        self.writer = csv.writer(self.f)
+        self.writer.writerow(COLUMNS)
+
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.writer.writerow(['' if v is None else v for v in row])
+            self.rows += 1
+
+
+
+class NdjsonWriter(_TextWriter):
+    def write_rows(self, rows):
+        for row in rows:
+            self.f.write(json.dumps(dict(zip(COLUMNS, row))))
+            self.f.write('\n')
+            self.rows += 1
+
+
+
+def _load_pyarrow():
+    global pa, pq
+    if pa is None:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ExportException('Parquet export needs pyarrow: pip install pyarrow')
+        pa, pq = pyarrow, pyarrow.parquet
+
+
+
+class ParquetWriter:
+    '''Writes a row group every row_group_size rows. path is required.'''
+    def __init__(self, path, row_group_size=100000):
+        _load_pyarrow()
+        if path is None or path == '-':
+            raise ExportException('Parquet export needs an output file.')
+        self.schema = pa.schema([('station', pa.string()), ('date', pa.date32()),
+                                 ('tmin', pa.float32()), ('tmax', pa.float32())])
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.row_group_size = row_group_size
+        self.buffer = []
+        self.rows = 0
+
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.buffer.append(row)
+            if len(self.buffer) >= self.row_group_size:
+                self._flush()
+
+
+    def _flush(self):
+        if not self.buffer:
+            return
+        columns = list(zip(*self.buffer))
+        dates = [datetime.date.fromisoformat(d) for d in columns[1]]
+        table = pa.Table.from_arrays([pa.array(columns[0], pa.string()), pa.array(dates, pa.date32()),
+                                      pa.array(columns[2], pa.float32()), pa.array(columns[3], pa.float32())],
+                                     schema=self.schema)
+        self.writer.write_table(table)
+        self.rows += len(self.buffer)
+        self.buffer = []
+
+
+    def close(self):
+        self._flush()
+        self.writer.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+def get_writer(fmt, path=None):
+    '''Returns the writer for fmt (one of FORMATS).'''
+    if fmt == 'csv':
+        return CsvWriter(path)
+    if fmt == 'ndjson':
+        return NdjsonWriter(path)
+    if fmt == 'parquet':
+        return ParquetWriter(path)
+    raise ExportException('Unknown export format: {}'.format(fmt))
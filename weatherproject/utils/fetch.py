@@ -0,0 +1,202 @@
+'''
+Concurrent fetch engine for the ncdc site.
+
+FetchEngine runs many (station, start_day, end_day) windows in a
+thread pool. Every NcdcWeather it creates shares the pooled session
+from utils.ncdc.get_session, and every request (each page of a
+window) first takes a token from a TokenBucket so we stay under the
+ncdc quotas:
+    5 requests per second
+    10,000 requests per day
+Retryable failures (timeouts, 429, 5xx) are retried with exponential
+backoff. Results are yielded as they complete so the caller can
+insert them while the rest are still being fetched.
+'''
+import multiprocessing
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from utils.ncdc import NcdcWeather, NcdcException, QuotaException, get_session
+
+# text is the json text from the ncdc site, error the NcdcException
+# if the window failed. One of the two will be None.
+FetchResult = namedtuple('FetchResult', ['station', 'start', 'end', 'text', 'error'])
+
+
+class TokenBucket:
+    '''Thread safe token bucket. rate tokens are added per second
+    up to capacity. If per_day is given, no more than that many
+    tokens are handed out in any 24 hour period.'''
+    def __init__(self, rate, capacity=None, per_day=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.per_day = per_day
+        self.day_count = 0
+        self.day_start = time.time()
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def acquire(self):
+        '''Blocks until a token is available.
+        Raises QuotaException if the daily quota is used up.'''
+        while True:
+            with self.lock:
+                if self.per_day is not None:
+                    if time.time() - self.day_start >= 86400:
+                        self.day_start = time.time()
+                        self.day_count = 0
+                    if self.day_count >= self.per_day:
+                        raise QuotaException('Daily quota of {} requests reached.'.format(self.per_day))
+
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.day_count += 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+
+class SharedTokenBucket:
+    '''Same as TokenBucket, but the state lives in shared memory so
+    worker processes started with it (utils.jobs) draw from one quota.
+    ctx is the multiprocessing context the workers are started from.
+    used is the requests already made in the day that began at
+    day_start (a time.time()), so an earlier run's count carries over.'''
+    def __init__(self, rate, capacity=None, per_day=None, ctx=None, used=0, day_start=None):
+        if ctx is None:
+            ctx = multiprocessing.get_context('spawn')
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.per_day = per_day
+        # tokens, last refill, requests today, start of the day
+        now = time.time()
+        self.state = ctx.Array('d', [self.capacity, now, used, now if day_start is None else day_start])
+
+
+    def acquire(self):
+        '''Blocks until a token is available.
+        Raises QuotaException if the daily quota is used up.'''
+        state = self.state
+        while True:
+            with state.get_lock():
+                now = time.time()
+                if self.per_day is not None:
+                    if now - state[3] >= 86400:
+                        state[3] = now
+                        state[2] = 0
+                    if state[2] >= self.per_day:
+                        raise QuotaException('Daily quota of {} requests reached.'.format(self.per_day))
+
+                state[0] = min(self.capacity, state[0] + max(0, now - state[1]) * self.rate)
+                state[1] = now
+                if state[0] >= 1:
+                    state[0] -= 1
+                    state[2] += 1
+                    return
+                wait = (1 - state[0]) / self.rate
+            time.sleep(wait)
+
+
+
+class FetchEngine:
+    '''
+    Create an instance with the ncdc token. The rest are optional:
+    workers: number of threads making requests
+    per_second / per_day: the ncdc quotas
+    retries / backoff: retry count and first wait in seconds, doubled each retry
+    url / limit / cache: passed on to NcdcWeather
+    '''
+    def __init__(self, token, workers=4, per_second=5, per_day=10000,
+                 retries=3, backoff=1.0, url=None, limit=1000, cache=None):
+        self.token = token
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.url = url
+        self.limit = limit
+        self.cache = cache
+        self.bucket = TokenBucket(per_second, per_day=per_day)
+        self.session = get_session(workers)
+        self._clients = {}
+        self._lock = threading.Lock()
+
+
+    def get_client(self, station):
+        '''One NcdcWeather per station, all on the shared session.'''
+        with self._lock:
+            client = self._clients.get(station)
+            if client is None:
+                client = NcdcWeather(station, self.token, limit=self.limit, url=self.url,
+                                     session=self.session, throttle=self.bucket.acquire,
+                                     cache=self.cache)
+                self._clients[station] = client
+            return client
+
+
+    def fetch_window(self, station, start_day, end_day):
+        '''Fetch a single window, retrying with backoff.
+        Returns the json text or raises NcdcException.'''
+        client = self.get_client(station)
+        attempt = 0
+        while True:
+            try:
+                return client.fetch_min_max_data(start_day, end_day)
+            except NcdcException as e:
+                attempt += 1
+                if not e.retryable or attempt > self.retries:
+                    raise
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+
+
+    def stats(self, station=None):
+        '''Totals over all stations (or just station): requests made and
+        records the ncdc site reported but that were not retrieved.'''
+        with self._lock:
+            clients = [c for id, c in self._clients.items() if station is None or id == station]
+        return {'requests': sum(c.requests for c in clients),
+                'dropped': sum(c.dropped for c in clients)}
+
+
+    def _run(self, window):
+        station, start_day, end_day = window
+        try:
+            text = self.fetch_window(station, start_day, end_day)
+            return FetchResult(station, start_day, end_day, text, None)
+        except NcdcException as e:
+            return FetchResult(station, start_day, end_day, None, e)
+
+
+    def fetch(self, windows, ordered=False):
+        '''Generator over FetchResult for each (station, start_day, end_day)
+        in windows. Results come back as they complete unless ordered
+        is set, in which case they come back in the order given and
+        only a few windows per worker are fetched ahead of the caller,
+        so a slow consumer (like an export) doesn't pile up responses.'''
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        futures = []
+        try:
+            if ordered:
+                pending = deque()
+                for w in windows:
+                    pending.append(pool.submit(self._run, w))
+                    if len(pending) >= self.workers * 2:
+                        yield pending.popleft().result()
+                futures = pending
+                while pending:
+                    yield pending.popleft().result()
+            else:
+                futures = [pool.submit(self._run, w) for w in windows]
+                for f in as_completed(futures):
+                    yield f.result()
+        finally:
+            # caller may stop early... don't keep fetching for nobody
+            for f in futures:
+                f.cancel()
+            pool.shutdown(wait=True)
@@ -0,0 +1,156 @@
+'''
+In process nearest station search.
+
+StationIndex loads the stations collection once into NumPy arrays and
+answers nearest / within searches without going back to mongo. Points
+are kept as unit vectors so straight line (chord) distance orders the
+same as great circle distance, and for the scan, a larger dot product
+means closer. If scipy is installed a cKDTree is built over the
+vectors, otherwise the search is a vectorized dot product scan, which
+is still under a millisecond for the full station list.
+'''
+import numpy as np
+from utils.mongodb import EARTH_RADIUS_KM
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+
+class GeoException(Exception):
+    pass
+
+
+def to_xyz(lat, lon):
+    '''Unit vectors for lat / lon in degrees (scalars or arrays).'''
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+def dot_to_chord(dot):
+    return np.sqrt(np.clip(2 - 2 * dot, 0, 4))
+
+
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(chord / 2, 0, 1))
+
+
+def km_to_chord(km):
+    return 2 * np.sin(min(km / EARTH_RADIUS_KM, np.pi) / 2)
+
+
+def _day(date, missing):
+    '''yyyy-mm-dd part of an ncdc date, or missing if it is None. The
+    sentinels keep a station with unknown dates out of any date filter,
+    the same as the mongo query does.'''
+    return missing if date is None else date[:10]
+
+
+class StationIndex:
+    '''
+    Create an instance with arrays of station ids, names, lat and lon.
+    mindate, maxdate (yyyy-mm-dd strings) and datacoverage are optional
+    and used for the same filters as mongodb.Stations.coverage_query.
+    '''
+    def __init__(self, ids, names, lat, lon, mindate=None, maxdate=None, datacoverage=None):
+        self.ids = np.asarray(ids, dtype=object)
+        self.names = np.asarray(names, dtype=object)
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.mindate = None if mindate is None else np.asarray(mindate, dtype='U10')
+        self.maxdate = None if maxdate is None else np.asarray(maxdate, dtype='U10')
+        self.datacoverage = None if datacoverage is None else np.asarray(datacoverage, dtype=np.float64)
+        self.xyz = np.ascontiguousarray(to_xyz(self.lat, self.lon))
+        self.tree = cKDTree(self.xyz) if cKDTree is not None else None
+
+
+    @classmethod
+    def from_stations(cls, stations):
+        '''Builds the index from a mongodb.Stations instance in one read.'''
+        fields = {'_id': 0, 'station_id': 1, 'name': 1, 'lat': 1, 'lon': 1,
+                  'mindate': 1, 'maxdate': 1, 'datacoverage': 1}
+        recs = [rec for rec in stations.collection.find({}, fields)
+                if rec.get('lat') is not None and rec.get('lon') is not None]
+        has_dates = all('mindate' in rec and 'maxdate' in rec for rec in recs)
+        has_coverage = all('datacoverage' in rec for rec in recs)
+        return cls([rec.get('station_id') for rec in recs],
+                   [rec.get('name') for rec in recs],
+                   [rec.get('lat') for rec in recs],
+                   [rec.get('lon') for rec in recs],
+                   [_day(rec.get('mindate'), '9999-99-99') for rec in recs] if has_dates else None,
+                   [_day(rec.get('maxdate'), '0000-00-00') for rec in recs] if has_dates else None,
+                   [rec.get('datacoverage') for rec in recs] if has_coverage else None)
+
+
+    def __len__(self):
+        return len(self.ids)
+
+
+    def _mask(self, start, end, min_coverage):
+        '''Boolean mask for the coverage filters, or None if there are none.'''
+        mask = None
+        if (start is not None or end is not None) and self.mindate is None:
+            raise GeoException('Stations have no mindate / maxdate to filter on.')
+        if min_coverage is not None and self.datacoverage is None:
+            raise GeoException('Stations have no datacoverage to filter on.')
+        for ok in ((self.mindate <= start) if start is not None else None,
+                   (self.maxdate >= end) if end is not None else None,
+                   (self.datacoverage >= min_coverage) if min_coverage is not None else None):
+            if ok is not None:
+                mask = ok if mask is None else mask & ok
+        return mask
+
+
+    def _result(self, idx, chord):
+        return [{'station_id': self.ids[i], 'name': self.names[i], 'lat': float(self.lat[i]),
+                 'lon': float(self.lon[i]), 'distance': float(km)}
+                for i, km in zip(idx, chord_to_km(chord))]
+
+
+    def nearest(self, lat, lon, k=10, max_km=None, start=None, end=None, min_coverage=None):
+        '''Same as mongodb.Stations.get_nearest.'''
+        point = to_xyz(lat, lon)
+        mask = self._mask(start, end, min_coverage)
+        if mask is None and self.tree is not None:
+            k = min(k, len(self))
+            chord, idx = self.tree.query(point, k=k,
+                                         distance_upper_bound=np.inf if max_km is None else km_to_chord(max_km))
+            chord = np.atleast_1d(chord)
+            idx = np.atleast_1d(idx)
+            found = np.isfinite(chord)
+            return self._result(idx[found], chord[found])
+
+        if mask is None:
+            candidates = np.arange(len(self))
+            dot = self.xyz @ point
+        else:
+            candidates = np.nonzero(mask)[0]
+            dot = self.xyz[candidates] @ point
+        if max_km is not None:
+            keep = dot_to_chord(dot) <= km_to_chord(max_km)
+            candidates = candidates[keep]
+            dot = dot[keep]
+        if len(candidates) > k:
+            top = np.argpartition(dot, -k)[-k:]
+            candidates = candidates[top]
+            dot = dot[top]
+        order = np.argsort(-dot)
+        return self._result(candidates[order], dot_to_chord(dot[order]))
+
+
+    def within(self, lat, lon, radius_km, start=None, end=None, min_coverage=None):
+        '''Same as mongodb.Stations.get_within, but closest first.'''
+        point = to_xyz(lat, lon)
+        limit = km_to_chord(radius_km)
+        if self.tree is not None:
+            idx = np.array(self.tree.query_ball_point(point, limit), dtype=np.int64)
+        else:
+            idx = np.nonzero(dot_to_chord(self.xyz @ point) <= limit)[0]
+        mask = self._mask(start, end, min_coverage)
+        if mask is not None:
+            idx = idx[mask[idx]]
+        dot = self.xyz[idx] @ point
+        order = np.argsort(-dot)
+        return self._result(idx[order], dot_to_chord(dot[order]))
@@ -0,0 +1,131 @@
+'''
+On disk cache of ncdc responses for NcdcWeather.
+
+Re-running a backfill asks for the same historical windows again, and
+each of those calls counts against the daily quota. ResponseCache keeps
+the json text of each page keyed on the normalized query (data url,
+station, dataset, datatypes, dates, units, limit and offset), so a
+stub server's responses are never handed back for the ncdc site.
+- Windows ending more than recent_days ago never change and don't expire.
+- Windows closer to today are only trusted for ttl seconds.
+- The cache is kept under max_bytes by removing the least recently
+  used files. The order is kept in memory, oldest file mtime first at
+  start up (mtime is touched on every hit of an old window).
+hits, misses, stores and evictions are counted for the stats() report.
+
+The root is $WEATHER_CACHE_DIR/http or ~/.cache/ncdc_weather/http.
+'''
+import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    '''Create an instance with the cache root directory (optional),
+    max_bytes, ttl in seconds for recent windows and recent_days.'''
+    def __init__(self, root=None, max_bytes=500 * 1024 * 1024, ttl=86400, recent_days=30):
+        if root is None:
+            root = os.path.join(os.environ.get('WEATHER_CACHE_DIR',
+                                               os.path.join(os.path.expanduser('~'), '.cache', 'ncdc_weather')),
+                                'http')
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.recent_days = recent_days
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        # name: size for everything on disk, least recently used first,
+        # and their total so puts don't rescan or re-sum
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.name.endswith('.json'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        self._sizes = OrderedDict((name, size) for mtime, name, size in sorted(entries))
+        self._bytes = sum(self._sizes.values())
+
+
+    def key(self, url, station, datasetid, datatypes, start_day, end_day, units, limit, offset):
+        '''Returns the file name for the normalized query.'''
+        query = [url, station, datasetid, sorted(datatypes), start_day, end_day, units, int(limit), int(offset)]
+        return hashlib.sha1(json.dumps(query).encode()).hexdigest() + '.json'
+
+
+    def _is_recent(self, end_day):
+        cutoff = datetime.date.today() - datetime.timedelta(self.recent_days)
+        return end_day >= cutoff.isoformat()
+
+
+    def get(self, key, end_day):
+        '''Returns the cached text, or None if missing or expired.'''
+        path = os.path.join(self.root, key)
+        with self._lock:
+            try:
+                mtime = os.path.getmtime(path)
+                if self._is_recent(end_day) and time.time() - mtime > self.ttl:
+                    self._remove(key)
+                    self.misses += 1
+                    return None
+                with open(path) as f:
+                    text = f.read()
+            except OSError:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if key in self._sizes:
+                self._sizes.move_to_end(key)
+            # recent entries keep their write time for the ttl
+            if not self._is_recent(end_day):
+                try:
+                    os.utime(path)
+                except OSError:
+                    # another process evicted it, we already have the text
+                    pass
+        return text
+
+
+    def put(self, key, text):
+        '''Saves text, evicting the least recently used entries
+        if that takes the cache over max_bytes.'''
+        path = os.path.join(self.root, key)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+        with self._lock:
+            self._bytes += len(text.encode()) - self._sizes.pop(key, 0)
+            self._sizes[key] = len(text.encode())
+            self.stores += 1
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+
+    def _remove(self, key):
+        try:
+            os.remove(os.path.join(self.root, key))
+        except OSError:
+            pass
+        self._bytes -= self._sizes.pop(key, 0)
+
+
+    def _evict(self):
+        '''Drop the least recently used files until under max_bytes.
+        Lock is held.'''
+        while self._bytes > self.max_bytes and self._sizes:
+            self._remove(next(iter(self._sizes)))
+            self.evictions += 1
+
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'stores': self.stores,
+                    'evictions': self.evictions, 'entries': len(self._sizes),
+                    'bytes': self._bytes}
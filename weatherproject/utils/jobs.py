@@ -0,0 +1,314 @@
+'''
+Persistent queue of ncdc fetch windows for long backfills.
+
+The windows live in the jobs collection in mongo, one document each:
+    _id: station:start:end
+    station, start, end
+    status: pending, claimed, done or failed
+    attempts, error, records
+    worker, lease_until: who has it claimed and until when
+    not_before: a retried window waits until then
+Workers claim a window with one atomic update, fetch it, write the
+records, add it to the coverage ledger and ack it. A window whose
+worker died is claimed again once its lease runs out, so a crashed run
+picks up where it left off and done windows are never fetched again.
+Retryable failures go back to pending with a backoff, others (or too
+many attempts) are marked failed and left for retry_failed. When the
+daily quota runs out the worker releases its window and stops, so the
+next run picks the window up again.
+
+run_workers starts the worker processes. They share one
+utils.fetch.SharedTokenBucket so adding processes never goes over the
+ncdc quotas, it only keeps more requests waiting on the network.
+The requests made each day are also counted in the quota collection
+({_id: yyyy-mm-dd, requests}) and the bucket starts from that count,
+so a second run (or one after a crash) on the same day doesn't think
+it has the whole quota.
+'''
+import datetime
+import multiprocessing
+import os
+import socket
+import time
+import pymongo
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+import utils.mongodb as db
+from utils.fetch import SharedTokenBucket
+from utils.http_cache import ResponseCache
+from utils.ncdc import NcdcWeather, NcdcException, QuotaException, get_session
+
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DONE = 'done'
+FAILED = 'failed'
+STATUSES = (PENDING, CLAIMED, DONE, FAILED)
+
+
+class JobQueue:
+    '''
+    Create an instance with a WeatherDb. The rest are optional:
+    lease: seconds a claimed window is held before others can take it
+    max_attempts: tries before a window is marked failed
+    backoff: first retry wait in seconds, doubled each attempt
+    '''
+    def __init__(self, db_conn, lease=300, max_attempts=5, backoff=30):
+        self.db_conn = db_conn
+        self.collection = db_conn.db['jobs']
+        self.quota = db_conn.db['quota']
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._indexed = False
+
+
+    def _ensure_index(self):
+        if not self._indexed:
+            self.collection.create_index([('status', pymongo.ASCENDING), ('not_before', pymongo.ASCENDING)])
+            self._indexed = True
+
+
+    def _key(self, station, start_day, end_day):
+        return '{}:{}:{}'.format(station, start_day, end_day)
+
+
+    def enqueue(self, windows):
+        '''Adds (station, start_day, end_day) windows. Windows already
+        queued keep their status, so re-running a backfill doesn't redo
+        finished work. Returns the number added.'''
+        ops = [UpdateOne({'_id': self._key(*w)},
+                         {'$setOnInsert': {'station': w[0], 'start': w[1], 'end': w[2],
+                                           'status': PENDING, 'attempts': 0, 'not_before': 0}},
+                         upsert=True)
+               for w in windows]
+        if not ops:
+            return 0
+        try:
+            self._ensure_index()
+            return self.collection.bulk_write(ops, ordered=False).upserted_count
+        except PyMongoError as e:
+            raise db.MongoDBException('Could not queue the windows: {}'.format(e))
+
+
+    def claim(self, worker):
+        '''Claims the next window that is ready: pending and past its
+        backoff, or claimed with an expired lease.
+        Returns the job document or None.'''
+        now = time.time()
+        try:
+            return self.collection.find_one_and_update(
+                {'$or': [{'status': PENDING, 'not_before': {'$lte': now}},
+                         {'status': CLAIMED, 'lease_until': {'$lt': now}}]},
+                {'$set': {'status': CLAIMED, 'worker': worker, 'lease_until': now + self.lease},
+                 '$inc': {'attempts': 1}},
+                sort=[('not_before', pymongo.ASCENDING)],
+                return_document=pymongo.ReturnDocument.AFTER)
+        except PyMongoError as e:
+            raise db.MongoDBException('Could not claim a window: {}'.format(e))
+
+
+    def ack(self, job, records):
+        '''Marks a claimed window done.'''
+        self.collection.update_one({'_id': job.get('_id'), 'worker': job.get('worker')},
+                                   {'$set': {'status': DONE, 'records': records, 'error': None},
+                                    '$unset': {'lease_until': ''}})
+
+
+    def fail(self, job, error, retryable=True):
+        '''Puts a claimed window back with a backoff, or marks it failed
+        if it isn't retryable or has had max_attempts.'''
+        attempts = job.get('attempts', 1)
+        update = {'error': str(error)}
+        if retryable and attempts < self.max_attempts:
+            update.update({'status': PENDING, 'not_before': time.time() + self.backoff * 2 ** (attempts - 1)})
+        else:
+            update['status'] = FAILED
+        self.collection.update_one({'_id': job.get('_id'), 'worker': job.get('worker')},
+                                   {'$set': update, '$unset': {'lease_until': ''}})
+
+
+    def release(self, job):
+        '''Puts a claimed window back as pending without counting the
+        attempt, for when the worker can't fetch anything (daily quota).'''
+        self.collection.update_one({'_id': job.get('_id'), 'worker': job.get('worker')},
+                                   {'$set': {'status': PENDING, 'not_before': 0},
+                                    '$inc': {'attempts': -1},
+                                    '$unset': {'lease_until': ''}})
+
+
+    def next_wait(self):
+        '''Seconds until a window waiting on backoff or a lease is ready,
+        0 if one is ready now, or None if there is nothing left to do.'''
+        now = time.time()
+        waits = []
+        rec = self.collection.find_one({'status': PENDING}, sort=[('not_before', pymongo.ASCENDING)])
+        if rec is not None:
+            waits.append(rec.get('not_before', 0) - now)
+        rec = self.collection.find_one({'status': CLAIMED}, sort=[('lease_until', pymongo.ASCENDING)])
+        if rec is not None:
+            waits.append(rec.get('lease_until', 0) - now)
+        if not waits:
+            return None
+        return max(0, min(waits))
+
+
+    def retry_failed(self):
+        '''Puts every failed window back as pending. Returns how many.'''
+        return self.collection.update_many({'status': FAILED},
+                                           {'$set': {'status': PENDING, 'attempts': 0, 'not_before': 0}}
+                                           ).modified_count
+
+
+    def clear_done(self):
+        '''Removes the finished windows. Returns how many.'''
+        return self.collection.delete_many({'status': DONE}).deleted_count
+
+
+    def requests_today(self):
+        '''ncdc requests made today by every run.'''
+        rec = self.quota.find_one({'_id': datetime.date.today().isoformat()})
+        return rec.get('requests', 0) if rec else 0
+
+
+    def add_requests(self, count):
+        '''Adds count to today's ncdc requests.'''
+        if count:
+            self.quota.update_one({'_id': datetime.date.today().isoformat()},
+                                  {'$inc': {'requests': count}}, upsert=True)
+
+
+    def counts(self):
+        '''Returns {status: count} plus records for the done windows.'''
+        counts = {status: 0 for status in STATUSES}
+        counts['records'] = 0
+        for rec in self.collection.aggregate([{'$group': {'_id': '$status', 'count': {'$sum': 1},
+                                                          'records': {'$sum': '$records'}}}]):
+            counts[rec.get('_id')] = rec.get('count')
+            counts['records'] += rec.get('records') or 0
+        return counts
+
+
+    def failed(self):
+        '''The failed windows with their last error.'''
+        return list(self.collection.find({'status': FAILED}, {'station': 1, 'start': 1, 'end': 1, 'error': 1})
+                    .sort([('station', pymongo.ASCENDING), ('start', pymongo.ASCENDING)]))
+
+
+
+def work(worker, token, bucket, url=None, http_cache=False, mongo_settings=None, lease=300):
+    '''Worker loop: claim, fetch, insert, ack until the queue is empty.
+    Runs in its own process with its own mongo client and session.
+    http_cache: use a utils.http_cache.ResponseCache (shared on disk).
+    Returns the number of windows done.'''
+    if mongo_settings:
+        db.configure(**mongo_settings)
+    response_cache = ResponseCache() if http_cache else None
+    db_conn = db.WeatherDb()
+    queue = JobQueue(db_conn, lease=lease)
+    coverage = db.Coverage(db_conn)
+    writer = db_conn.bulk_writer()
+    session = get_session()
+    clients = {}
+    done = 0
+    while True:
+        job = queue.claim(worker)
+        if job is None:
+            wait = queue.next_wait()
+            if wait is None:
+                return done
+            # other windows are backing off or held by other workers
+            time.sleep(min(max(wait, 0.1), 5))
+            continue
+
+        try:
+            if _run_job(job, queue, clients, writer, coverage, token, url, session, bucket, response_cache):
+                done += 1
+        except QuotaException:
+            raise
+        except Exception as e:
+            # anything else (the http cache's disk, a connection error
+            # outside NcdcWeather) fails this window, not the worker
+            queue.fail(job, '{}: {}'.format(type(e).__name__, e))
+
+
+
+def _run_job(job, queue, clients, writer, coverage, token, url, session, bucket, response_cache):
+    '''Fetches, writes and acks (or fails) one claimed window for work().
+    Returns True if it was done.'''
+    station = job.get('station')
+    client = clients.get(station)
+    if client is None:
+        client = NcdcWeather(station, token, url=url, session=session,
+                             throttle=bucket.acquire, cache=response_cache)
+        clients[station] = client
+    dropped = client.dropped
+    requests = client.requests
+    try:
+        text = client.fetch_min_max_data(job.get('start'), job.get('end'))
+    except QuotaException:
+        # no point claiming more today, the window waits for the next run
+        queue.release(job)
+        raise
+    except NcdcException as e:
+        queue.fail(job, e, e.retryable)
+        return False
+    finally:
+        queue.add_requests(client.requests - requests)
+
+    failed = writer.failed
+    try:
+        records = writer.add_json(station, text)
+        # written before the ack so an acked window is always in mongo
+        writer.flush()
+        if writer.failed > failed:
+            # not in the ledger, so the retry (or a sync) fetches it again
+            queue.fail(job, '{} records could not be written.'.format(writer.failed - failed))
+            return False
+        if client.dropped == dropped:
+            window = [(job.get('start'), job.get('end'))]
+            coverage.record(station, window if records else [], [] if records else window)
+    except db.MongoDBException as e:
+        queue.fail(job, e)
+        return False
+    queue.ack(job, records)
+    return True
+
+
+
+def _run_worker(worker, token, bucket, url, http_cache, mongo_settings, lease):
+    try:
+        done = work(worker, token, bucket, url, http_cache, mongo_settings, lease)
+        print('{}: {} windows done.'.format(worker, done))
+    except (db.MongoDBException, NcdcException) as e:
+        # daily quota (the window was released), or mongo went away
+        # and claimed windows go back once their lease runs out.
+        print('{}: stopped: {}'.format(worker, e))
+    except Exception as e:
+        # work() fails the window for anything a job raises, so this is
+        # mongo going away mid fail() and the like
+        print('{}: stopped: {}: {}'.format(worker, type(e).__name__, e))
+    except KeyboardInterrupt:
+        pass
+
+
+
+def run_workers(token, processes=4, per_second=5, per_day=10000, url=None, http_cache=False, lease=300):
+    '''Starts processes workers on the queue and waits for them.'''
+    ctx = multiprocessing.get_context('spawn')
+    # today's requests from earlier runs count against the quota
+    used = JobQueue(db.WeatherDb()).requests_today()
+    midnight = datetime.datetime.combine(datetime.date.today(), datetime.time()).timestamp()
+    bucket = SharedTokenBucket(per_second, per_day=per_day, ctx=ctx, used=used, day_start=midnight)
+    host = '{}:{}'.format(socket.gethostname(), os.getpid())
+    workers = [ctx.Process(target=_run_worker,
+                           args=('{}:{}'.format(host, i), token, bucket, url, http_cache,
+                                 db.settings(), lease))
+               for i in range(processes)]
+    for p in workers:
+        p.start()
+    try:
+        for p in workers:
+            p.join()
+    except KeyboardInterrupt:
+        for p in workers:
+            p.join()
@@ -1,23 +1,143 @@
 '''
 Classes to be used with the local mongo database.
 class WeatherDb:
-    Is for the collections named after the ncdc station id's.
+    Is for the collections named after the ncdc station id's. A station
+    collection is one document per value (records schema), per day (daily)
+    or per month (monthly, see utils/compact.py) and the readers handle all three.
+class BulkWriter:
+    Buffers records for the station collections and writes them
+    in large unordered batches.
+class Rollups:
+    Is for the collection named rollups which has per station / year / month
+    sums and counts used for the averages.
+class Coverage:
+    Is for the collection named coverage, the ranges of dates already
+    fetched from ncdc for each station (with or without records).
+The jobs collection is the backfill queue, see utils/jobs.py.
+The collection_stats collection caches each station collection's record
+count and first / last dates for list_collections.
 class Stations:
     Is for the collection named stations which has:
         station_id
         name
         lat
         lont
+    and location, a GeoJSON point added for the 2dsphere index.
+
+All the classes share one MongoClient per process (get_client) so they
+share its connection pool and monitor threads. The settings come from
+the environment, or configure() before the first connection:
+    WEATHER_MONGO_URI              mongodb:// uri, used instead of host / port
+    WEATHER_MONGO_HOST             default localhost
+    WEATHER_MONGO_PORT             default 27017
+    WEATHER_MONGO_DB               default weather
+    WEATHER_MONGO_POOL_SIZE        default 100
+    WEATHER_MONGO_READ_PREFERENCE  default primary
+    WEATHER_MONGO_TIMEOUT_MS       server selection timeout, default 30000
+    WEATHER_MONGO_SCHEMA           schema for new station collections, records
+                                   (default), daily or monthly
 '''
 
 import pymongo
+from pymongo import DeleteOne, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError
+from collections import defaultdict
+from utils.date_util import Dates
+from utils import compact, profiling
+import calendar
+import datetime
 import json
-import re
+import os
+import threading
 
 class MongoDBException(Exception):
     pass
 
 
+_config = {
+    'uri': os.environ.get('WEATHER_MONGO_URI'),
+    'host': os.environ.get('WEATHER_MONGO_HOST', 'localhost'),
+    'port': int(os.environ.get('WEATHER_MONGO_PORT', 27017)),
+    'database': os.environ.get('WEATHER_MONGO_DB', 'weather'),
+    'pool_size': int(os.environ.get('WEATHER_MONGO_POOL_SIZE', 100)),
+    'read_preference': os.environ.get('WEATHER_MONGO_READ_PREFERENCE', 'primary'),
+    'timeout_ms': int(os.environ.get('WEATHER_MONGO_TIMEOUT_MS', 30000)),
+    'schema': os.environ.get('WEATHER_MONGO_SCHEMA', 'records'),
+}
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def configure(**settings):
+    '''Changes the connection settings (same names as _config).
+    Clients already handed out keep their settings.'''
+    for name in settings:
+        if name not in _config:
+            raise MongoDBException('Unknown setting: {}'.format(name))
+    if settings.get('schema', compact.SCHEMAS[0]) not in compact.SCHEMAS:
+        raise MongoDBException('Unknown schema: {}'.format(settings.get('schema')))
+    _config.update(settings)
+
+
+def settings():
+    '''Returns a copy of the current connection settings, in the form
+    configure() takes (e.g. to hand them to a worker process).'''
+    return dict(_config)
+
+
+def get_client():
+    '''Returns the shared MongoClient for the current settings,
+    creating it on first use.'''
+    # the schema doesn't change the connection
+    key = tuple(sorted((name, value) for name, value in _config.items() if name != 'schema'))
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            options = {'maxPoolSize': _config['pool_size'],
+                       'readPreference': _config['read_preference'],
+                       'serverSelectionTimeoutMS': _config['timeout_ms']}
+            try:
+                if _config['uri']:
+                    client = pymongo.MongoClient(_config['uri'], **options)
+                else:
+                    client = pymongo.MongoClient(_config['host'], _config['port'], **options)
+            except PyMongoError as e:
+                raise MongoDBException('Could not connect to the database: {}'.format(e))
+            _clients[key] = client
+        return client
+
+
+def get_database():
+    '''Returns the weather database on the shared client.'''
+    return get_client()[_config['database']]
+
+
+# collections in the weather database that are not stations
+RESERVED_COLLECTIONS = ('stations', 'rollups', 'collection_stats', 'coverage', 'jobs', 'quota')
+# migrate.py keeps the old collection as backup.<station id>
+BACKUP_PREFIX = 'backup.'
+
+EARTH_RADIUS_KM = 6378.1
+
+# only the fields the readers use come back from get_records
+RECORD_FIELDS = {'_id': 0, 'date': 1, 'datatype': 1, 'value': 1}
+
+
+def date_bounds(start_day, end_day):
+    '''Returns the $gte / $lt query on date for the yyyy-mm-dd days
+    start_day through end_day. Dates are stored as yyyy-mm-ddT00:00:00
+    strings so a string range works and uses the date index.'''
+    end = datetime.datetime.strptime(end_day, '%Y-%m-%d') + datetime.timedelta(1)
+    return {'$gte': start_day, '$lt': end.strftime('%Y-%m-%d')}
+
+
+
+def _date_string(date):
+    if isinstance(date, datetime.datetime):
+        return date.strftime('%Y-%m-%dT%H:%M:%S')
+    return date
+
+
 
 class WeatherDb:
     '''
@@ -26,66 +146,253 @@ class WeatherDb:
     '''
     def __init__(self):
         try:
-            self.client = pymongo.MongoClient('localhost', 27017)
-            self.db = self.client['weather']
+            self.client = get_client()
+            self.db = get_database()
             self.collection_set = False
+            # schema of the current collection
+            self.layout = 'records'
+            # collections we have already checked the index on
+            self._indexed = set()
+            # id: schema, from the first document
+            self._schemas = {}
         except:
             raise MongoDBException('Could not connect to the database.')
 
 
 
     def set_collection(self, id):
+        '''Sets the collection to use. Switching between collections
+        is cheap so one instance can be shared by many stations.'''
         self.collection = self.db[id]
-        # index needed to keep dups from being inserted for date and datatype (min / max)
-        if 'date_1_datatype_1' not in self.collection.index_information():
-            self.collection.create_index([('date', pymongo.ASCENDING), ('datatype', pymongo.ASCENDING)],
-                                         unique=True)
+        self.layout = self.schema(id)
+        self.ensure_index(id)
 
         # boolean used to check if we have a collection set
         # before making any calls in other methods
         self.collection_set = True
 
 
+    def schema(self, id):
+        '''records, daily or monthly, from a look at one document. An empty
+        collection gets the configured schema for new collections.'''
+        schema = self._schemas.get(id)
+        if schema is None:
+            doc = self.db[id].find_one({}, {'_id': 1, 'datatype': 1, 'tmin': 1, 'tmax': 1})
+            if doc is None:
+                return _config['schema']
+            if not isinstance(doc.get('_id'), datetime.datetime):
+                schema = 'records'
+            elif compact.is_month(doc):
+                schema = 'monthly'
+            else:
+                schema = 'daily'
+            self._schemas[id] = schema
+        return schema
+
+
+    def ensure_index(self, id):
+        '''index needed to keep dups from being inserted for date and datatype (min / max).
+        daily and monthly collections are keyed on the date _id and don't need it.'''
+        if id not in self._indexed:
+            collection = self.db[id]
+            if self.schema(id) != 'records':
+                self._indexed.add(id)
+                return
+            if 'date_1_datatype_1' not in collection.index_information():
+                collection.create_index([('date', pymongo.ASCENDING), ('datatype', pymongo.ASCENDING)],
+                                        unique=True)
+            self._indexed.add(id)
+
+
+    def bulk_writer(self, batch_size=5000, cache=None):
+        '''Returns a BulkWriter using this connection.'''
+        return BulkWriter(self, batch_size, cache)
+
+
     def check_for_collection(self, id):
         if id not in self.db.list_collection_names():
             raise MongoDBException('Collection {} Not Found.'.format(id))
 
 
 
-    def get_records(self, pat):
-        '''Retrieves and returns data for the station id given
-        the regex pattern sent.
-        Checks if connected to a collection first.'''
+    def iter_records(self, start_day, end_day=None, batch_size=5000):
+        '''Same query as get_records but returns the cursor itself,
+        so records are pulled from mongo batch_size at a time as the
+        caller iterates. Used by the streaming export.'''
         if self.collection_set == False:
             raise MongoDBException('Not connected to a collection.')
 
-        results = self.collection.find({'date': re.compile(pat)})
-        if results.count() == 0:
+        if end_day is None:
+            end_day = start_day
+        if self.layout == 'daily':
+            cursor = (self.collection.find({'_id': compact.day_bounds(start_day, end_day)})
+                      .sort('_id', pymongo.ASCENDING).batch_size(batch_size))
+            return compact.decode_docs(cursor)
+        if self.layout == 'monthly':
+            cursor = self.collection.find({'_id': compact.month_bounds(start_day, end_day)}).sort('_id', pymongo.ASCENDING)
+            return compact.decode_docs(cursor, start_day=start_day, end_day=end_day)
+        return (self.collection.find({'date': date_bounds(start_day, end_day)}, RECORD_FIELDS)
+                .sort([('date', pymongo.ASCENDING), ('datatype', pymongo.ASCENDING)])
+                .batch_size(batch_size))
+
+
+    def get_records(self, start_day, end_day=None):
+        '''Retrieves and returns data for the station id from start_day
+        through end_day (yyyy-mm-dd, end_day defaults to start_day) as a
+        list of date, datatype and value in date order.
+        This is a range scan on the date_1_datatype_1 index.
+        Returns None if there is no data.
+        Checks if connected to a collection first.'''
+        with profiling.timer('mongo.get_records'):
+            results = list(self.iter_records(start_day, end_day))
+        profiling.count('mongo.records_read', len(results))
+        if not results:
             return None
         return results
 
 
 
+    def _month_query(self, month, years):
+        '''TMIN / TMAX for the month in each of the years. One index range per year.'''
+        month = int(month)
+        ranges = []
+        for yr in years:
+            yr = int(yr)
+            first = '{}-{:02d}-01'.format(yr, month)
+            last = '{}-{:02d}-{:02d}'.format(yr, month, calendar.monthrange(yr, month)[1])
+            if self.layout == 'daily':
+                ranges.append({'_id': compact.day_bounds(first, last)})
+            else:
+                ranges.append({'date': date_bounds(first, last)})
+        if self.layout == 'monthly':
+            # one document per year
+            return {'_id': {'$in': compact.month_ids(month, years)}}
+        if self.layout == 'daily':
+            return {'$or': ranges}
+        return {'$or': ranges, 'datatype': {'$in': ['TMIN', 'TMAX']}}
+
+
+    def get_month_records(self, month, start_year, end_year):
+        '''Returns a cursor over date, datatype and value for the month
+        in every year from start_year to end_year, in one query.
+        Checks if connected to a collection first.'''
+        if self.collection_set == False:
+            raise MongoDBException('Not connected to a collection.')
+
+        years = range(int(start_year), int(end_year) + 1)
+        if self.layout != 'records':
+            return compact.decode_docs(self.collection.find(self._month_query(month, years)))
+        return self.collection.find(self._month_query(month, years), RECORD_FIELDS)
+
+
+    def get_month_stats(self, month, years):
+        '''Returns {year: stats} for the month in each of the years,
+        worked out by the server in one aggregation. stats has:
+            tmin_sum, tmin_count, tmax_sum, tmax_count: all values
+            days, paired_tmin_sum, paired_tmax_sum: days with both a TMIN and a TMAX
+        Years with no data are left out.
+        Checks if connected to a collection first.'''
+        if self.collection_set == False:
+            raise MongoDBException('Not connected to a collection.')
+
+        if self.layout == 'monthly':
+            return self._bucket_month_stats(month, years)
+        # a missing field (daily schema) counts as None too
+        has_min = {'$ne': [{'$ifNull': ['$tmin', None]}, None]}
+        has_max = {'$ne': [{'$ifNull': ['$tmax', None]}, None]}
+        paired = {'$and': [has_min, has_max]}
+        if self.layout == 'daily':
+            # already one document per day
+            pipeline = [{'$match': self._month_query(month, years)}]
+            year = {'$year': '$_id'}
+        else:
+            pipeline = [
+                {'$match': self._month_query(month, years)},
+                # pair up min and max by day
+                {'$group': {'_id': {'$substr': ['$date', 0, 10]},
+                            'tmin': {'$max': {'$cond': [{'$eq': ['$datatype', 'TMIN']}, '$value', None]}},
+                            'tmax': {'$max': {'$cond': [{'$eq': ['$datatype', 'TMAX']}, '$value', None]}}}}]
+            year = {'$substr': ['$_id', 0, 4]}
+        pipeline += [
+            {'$group': {'_id': year,
+                        'tmin_sum': {'$sum': {'$cond': [has_min, '$tmin', 0]}},
+                        'tmin_count': {'$sum': {'$cond': [has_min, 1, 0]}},
+                        'tmax_sum': {'$sum': {'$cond': [has_max, '$tmax', 0]}},
+                        'tmax_count': {'$sum': {'$cond': [has_max, 1, 0]}},
+                        'days': {'$sum': {'$cond': [paired, 1, 0]}},
+                        'paired_tmin_sum': {'$sum': {'$cond': [paired, '$tmin', 0]}},
+                        'paired_tmax_sum': {'$sum': {'$cond': [paired, '$tmax', 0]}}}},
+        ]
+        try:
+            with profiling.timer('mongo.month_stats'):
+                results = self.collection.aggregate(pipeline)
+                return {int(rec.pop('_id')): rec for rec in results}
+        except OperationFailure as e:
+            raise MongoDBException('Aggregation failed: {}'.format(e))
+
+
+    def _bucket_month_stats(self, month, years):
+        '''get_month_stats for the monthly schema. The month is one
+        document per year so the sums are done here as they are read.'''
+        stats = {}
+        with profiling.timer('mongo.month_stats'):
+            try:
+                docs = list(self.collection.find(self._month_query(month, years), {'tmin': 1, 'tmax': 1}))
+            except PyMongoError as e:
+                raise MongoDBException('Month query failed: {}'.format(e))
+            for doc in docs:
+                rec = dict.fromkeys(('tmin_sum', 'tmin_count', 'tmax_sum', 'tmax_count',
+                                     'days', 'paired_tmin_sum', 'paired_tmax_sum'), 0)
+                for tmin, tmax in zip(doc.get('tmin'), doc.get('tmax')):
+                    if tmin is not None:
+                        rec['tmin_sum'] += tmin
+                        rec['tmin_count'] += 1
+                    if tmax is not None:
+                        rec['tmax_sum'] += tmax
+                        rec['tmax_count'] += 1
+                    if tmin is not None and tmax is not None:
+                        rec['days'] += 1
+                        rec['paired_tmin_sum'] += tmin
+                        rec['paired_tmax_sum'] += tmax
+                if rec.get('tmin_count') or rec.get('tmax_count'):
+                    stats[doc.get('_id').year] = rec
+        return stats
+
+
+    def get_monthly_means(self, month, start_year, end_year):
+        '''Returns {year: (tmin_mean, tmax_mean, days)} for the month over
+        the years, from get_month_stats.
+        Only days with both a TMIN and a TMAX are counted, the same as
+        weather.Averages does in python. Years with no such days are left out.'''
+        stats = self.get_month_stats(month, range(int(start_year), int(end_year) + 1))
+        return {yr: (rec.get('paired_tmin_sum') / rec.get('days'),
+                     rec.get('paired_tmax_sum') / rec.get('days'), rec.get('days'))
+                for yr, rec in stats.items() if rec.get('days')}
+
+
     def insert_json(self, rec):
         '''Attempts to insert the data rec provided in to the mongo collection.
-        Checks if connected to a collection first.'''
+        Checks if connected to a collection first.
+        Records already in the collection are skipped rather than
+        stopping the insert. Returns the BulkWriter counts.
+        For many pages use a bulk_writer instead.'''
         if self.collection_set == False:
             raise MongoDBException('Not connected to a collection.')
 
         try:
             json_rec = json.loads(rec)
             json_rec = json_rec['results']
-            try:
-                self.collection.insert(json_rec)
-            except Exception as e:
-                print('Exception received:', e.__str__())
-            return True
         except ValueError as e:
             raise MongoDBException('JSON ValueError:', e.__str__())
         except KeyError:
             # if I get a key error, the results were empty
             raise MongoDBException('No records.')
 
+        writer = self.bulk_writer()
+        writer.add(self.collection.name, json_rec)
+        writer.flush()
+        return writer.counts()
+
 
 
     def get_min_date(self):
@@ -93,11 +400,7 @@ class WeatherDb:
         if self.collection_set == False:
             raise MongoDBException('Not connected to a collection.')
 
-        result = self.collection.find().sort('date', 1).limit(1)
-        try:
-            return result.__getitem__(0).get('date').split('T')[0]
-        except IndexError:
-            raise MongoDBException('No data available for this collection.')
+        return self._end_day(pymongo.ASCENDING)
 
 
     def get_max_date(self):
@@ -105,53 +408,639 @@ class WeatherDb:
         if self.collection_set == False:
             raise MongoDBException('Not connected to a collection.')
 
-        result = self.collection.find().sort('date', -1).limit(1)
-        try:
-            return result.__getitem__(0).get('date').split('T')[0]
-        except IndexError:
+        return self._end_day(pymongo.DESCENDING)
+
+
+    def _end_day(self, direction):
+        date = self._end_date(self.collection.name, direction)
+        if date is None:
             raise MongoDBException('No data available for this collection.')
+        return date.split('T')[0]
+
+
+    def _end_date(self, id, direction):
+        '''First or last date in collection id as yyyy-mm-ddThh:mm:ss,
+        for any schema. None if it is empty.'''
+        collection = self.db[id]
+        schema = self.schema(id)
+        if schema == 'records':
+            doc = collection.find_one({}, {'date': 1}, sort=[('date', direction)])
+            return doc.get('date') if doc else None
+        doc = collection.find_one({}, sort=[('_id', direction)])
+        if doc is None:
+            return None
+        if schema == 'daily':
+            return _date_string(doc.get('_id'))
+        records = compact.decode_month(doc)
+        if not records:
+            return None
+        return records[0 if direction == pymongo.ASCENDING else -1].get('date')
+
+
+    def get_collection_stats(self, ids):
+        '''Returns {id: {count, min_date, max_date}} from the cached
+        collection_stats, in one query. Stations not cached yet are
+        worked out once (count plus an index seek at each end) and saved.
+        BulkWriter keeps them up to date after that.'''
+        stats = self.db['collection_stats']
+        found = {rec.pop('_id'): rec for rec in stats.find({'_id': {'$in': list(ids)}})}
+        for id in ids:
+            if id in found:
+                continue
+            rec = {'count': self.db[id].estimated_document_count(),
+                   'min_date': self._end_date(id, pymongo.ASCENDING),
+                   'max_date': self._end_date(id, pymongo.DESCENDING)}
+            stats.replace_one({'_id': id}, rec, upsert=True)
+            found[id] = rec
+        return found
+
+
+    def update_collection_stats(self, id, added, dates):
+        '''Adds added records with the given dates to the cached stats for id.
+        Leaves stations that aren't cached for get_collection_stats to work out.'''
+        if dates:
+            self.db['collection_stats'].update_one(
+                {'_id': id}, {'$inc': {'count': added},
+                              '$min': {'min_date': min(dates)}, '$max': {'max_date': max(dates)}})
 
 
     def list_collections(self):
-        '''Print station information for available collections'''
+        '''Print station information for available collections.
+        Station names come from one $in query and the counts and
+        dates from the cached collection_stats.'''
         try:
             s = Stations()
-            id_list =  self.db.list_collection_names()
-            print('\n{:20}{:30}{:15}{:15}'.format('Station ID', 'Station Name', 'Lat', 'Lon'))
-            print('{:20}{:30}{:15}{:15}'.format('-' * 12, '-' * 25, '-' * 10, '-' * 10))
-            for id in id_list:
-                if id != 'stations':
-                    station_info = s.get_station_name(id)
-                    print('{:20}{:30}{:<15}{:<15}'.format(id, station_info.get('name'),
-                                    station_info.get('lat'), station_info.get('lon')))
-        except MongoDBException as e:
+            id_list = [id for id in self.db.list_collection_names()
+                       if id not in RESERVED_COLLECTIONS and not id.startswith(BACKUP_PREFIX)]
+            names = s.get_station_names(id_list)
+            stats = self.get_collection_stats(id_list)
+            print('\n{:20}{:30}{:15}{:15}{:10}{:12}{:12}'.format('Station ID', 'Station Name', 'Lat', 'Lon',
+                                                             'Records', 'First', 'Last'))
+            print('{:20}{:30}{:15}{:15}{:10}{:12}{:12}'.format('-' * 12, '-' * 25, '-' * 10, '-' * 10,
+                                                           '-' * 8, '-' * 10, '-' * 10))
+            for id in sorted(id_list):
+                station_info = names.get(id, {})
+                stat = stats.get(id, {})
+                print('{:20}{:30}{:<15}{:<15}{:<10}{:12}{:12}'.format(id, str(station_info.get('name')),
+                                str(station_info.get('lat')), str(station_info.get('lon')),
+                                stat.get('count', 0), (stat.get('min_date') or '')[:10],
+                                (stat.get('max_date') or '')[:10]))
+        except (MongoDBException, PyMongoError) as e:
             print('Mongo Exception Caught:', e.__str__())
 
 
 
 
+class BulkWriter:
+    '''
+    Buffers records for one or more station collections and writes
+    them as unordered bulk upserts keyed on (date, datatype).
+    A record already in the collection is counted as a duplicate
+    and left alone, so re-running an overlapping backfill is cheap
+    and nothing after a duplicate is lost.
+    Get one from WeatherDb.bulk_writer() and call flush() when done.
+    New records in a range of the local utils.cache.StationCache (cache,
+    or the default one) mark that station stale there.
+    '''
+    def __init__(self, db_conn, batch_size=5000, cache=None):
+        self.db_conn = db_conn
+        self.batch_size = batch_size
+        self.rollups = Rollups(db_conn)
+        self.cache = cache
+        self.buffers = defaultdict(list)
+        self.inserted = 0
+        self.duplicates = 0
+        self.failed = 0
+
+
+    def add(self, id, records):
+        '''Buffers records for collection id, writing a batch
+        whenever the buffer reaches batch_size.'''
+        buffer = self.buffers[id]
+        buffer.extend(records)
+        if len(buffer) >= self.batch_size:
+            self.flush(id)
+
+
+    def add_json(self, id, text):
+        '''Buffers the results from an ncdc json response.
+        Returns the number of records added, 0 if it was empty.'''
+        try:
+            with profiling.timer('ingest.json_decode'):
+                records = json.loads(text).get('results', [])
+        except ValueError as e:
+            raise MongoDBException('JSON ValueError: {}'.format(e))
+        self.add(id, records)
+        return len(records)
+
+
+    def flush(self, id=None):
+        '''Writes the buffer for id, or all buffers if id is None.'''
+        ids = [id] if id is not None else list(self.buffers.keys())
+        for id in ids:
+            records = self.buffers.pop(id, [])
+            if records:
+                self._write(id, records)
+
+
+    def _write(self, id, records):
+        self.db_conn.ensure_index(id)
+        schema = self.db_conn.schema(id)
+        if schema == 'daily':
+            return self._write_days(id, records)
+        if schema == 'monthly':
+            return self._write_months(id, records)
+        ops = [UpdateOne({'date': rec.get('date'), 'datatype': rec.get('datatype')},
+                         {'$setOnInsert': rec}, upsert=True) for rec in records]
+        profiling.count('mongo.records_written', len(records))
+        try:
+            with profiling.timer('mongo.bulk_write'):
+                result = self.db_conn.db[id].bulk_write(ops, ordered=False)
+            self.inserted += result.upserted_count
+            self.duplicates += result.matched_count
+            upserted = result.upserted_ids.keys()
+        except BulkWriteError as e:
+            details = e.details
+            self.inserted += details.get('nUpserted', 0)
+            self.duplicates += details.get('nMatched', 0)
+            upserted = [rec.get('index') for rec in details.get('upserted', [])]
+            for error in details.get('writeErrors', []):
+                # two upserts racing on the unique index... still a duplicate
+                if error.get('code') == 11000:
+                    self.duplicates += 1
+                else:
+                    self.failed += 1
+        except PyMongoError as e:
+            self.failed += len(records)
+            raise MongoDBException('Bulk write to {} failed: {}'.format(id, e))
+
+        # only the months that got new records need their rollups redone
+        dates = [records[i].get('date') for i in upserted]
+        months = set(date[:7] for date in dates)
+        with profiling.timer('mongo.bulk_write_bookkeeping'):
+            if months:
+                self.rollups.invalidate(id, months)
+                self._stale_cache(id, dates)
+            self.db_conn.update_collection_stats(id, len(dates), dates)
+
+
+    def _write_days(self, id, records):
+        '''daily schema: each record $sets its fields on the day document
+        unless the day already has that value. The filter doesn't match
+        a day that has it, so the upsert runs into the _id index and the
+        record is counted as a duplicate.'''
+        ops, dates = [], []
+        for rec in records:
+            fields = compact.value_fields(rec)
+            if fields is None:
+                continue
+            value_field = compact.FIELDS.get(rec.get('datatype'))[0]
+            ops.append(UpdateOne({'_id': compact.to_day(rec.get('date')), value_field: {'$exists': False}},
+                                 {'$set': fields}, upsert=True))
+            dates.append(rec.get('date'))
+        if not ops:
+            return
+        profiling.count('mongo.records_written', len(ops))
+        errors = set()
+        try:
+            with profiling.timer('mongo.bulk_write'):
+                result = self.db_conn.db[id].bulk_write(ops, ordered=False)
+            upserted, modified = result.upserted_count, result.modified_count
+        except BulkWriteError as e:
+            details = e.details
+            upserted, modified = details.get('nUpserted', 0), details.get('nModified', 0)
+            for error in details.get('writeErrors', []):
+                errors.add(error.get('index'))
+                if error.get('code') == 11000:
+                    self.duplicates += 1
+                else:
+                    self.failed += 1
+        except PyMongoError as e:
+            self.failed += len(ops)
+            raise MongoDBException('Bulk write to {} failed: {}'.format(id, e))
+        self.inserted += upserted + modified
+
+        # every op that didn't error added a value to its day
+        dates = [date for i, date in enumerate(dates) if i not in errors]
+        months = set(date[:7] for date in dates)
+        with profiling.timer('mongo.bulk_write_bookkeeping'):
+            if months:
+                self.rollups.invalidate(id, months)
+                self._stale_cache(id, dates)
+            # the stats count documents, which are the new days
+            self.db_conn.update_collection_stats(id, upserted, dates)
+
+
+    def _write_months(self, id, records):
+        '''monthly schema: makes sure the batch's month documents exist
+        (full size arrays, $setOnInsert) and then $sets each record's
+        array positions where they are still None. A record whose
+        position is already set doesn't match and is a duplicate.'''
+        ops, dates = [], []
+        for rec in records:
+            fields = compact.month_fields(rec)
+            if fields is None:
+                continue
+            value_field = compact.FIELDS.get(rec.get('datatype'))[0]
+            position = '{}.{}'.format(value_field, int(rec.get('date')[8:10]) - 1)
+            ops.append(UpdateOne({'_id': compact.to_month(rec.get('date')), position: None}, {'$set': fields}))
+            dates.append(rec.get('date'))
+        if not ops:
+            return
+        months = sorted(set(compact.to_month(date) for date in dates))
+        profiling.count('mongo.records_written', len(ops))
+        collection = self.db_conn.db[id]
+        created = matched = modified = errors = 0
+        try:
+            with profiling.timer('mongo.bulk_write'):
+                # two bulk writes as an unordered one doesn't promise the
+                # documents are made before the $sets run
+                created = collection.bulk_write(
+                    [UpdateOne({'_id': month}, {'$setOnInsert': compact.empty_month(month)}, upsert=True)
+                     for month in months], ordered=False).upserted_count
+        except BulkWriteError as e:
+            details = e.details
+            created = details.get('nUpserted', 0)
+            # a racing upsert (11000) still leaves the month there
+            missing = set(months[error.get('index')] for error in details.get('writeErrors', [])
+                          if error.get('code') != 11000)
+            if missing:
+                # no document to $set into, those records failed
+                keep = [i for i, date in enumerate(dates) if compact.to_month(date) not in missing]
+                self.failed += len(ops) - len(keep)
+                ops = [ops[i] for i in keep]
+                dates = [dates[i] for i in keep]
+        except PyMongoError as e:
+            self.failed += len(ops)
+            raise MongoDBException('Bulk write to {} failed: {}'.format(id, e))
+
+        try:
+            if ops:
+                with profiling.timer('mongo.bulk_write'):
+                    result = collection.bulk_write(ops, ordered=False)
+                matched, modified = result.matched_count, result.modified_count
+        except BulkWriteError as e:
+            details = e.details
+            matched, modified = details.get('nMatched', 0), details.get('nModified', 0)
+            errors = len(details.get('writeErrors', []))
+            self.failed += errors
+        except PyMongoError as e:
+            self.failed += len(ops)
+            raise MongoDBException('Bulk write to {} failed: {}'.format(id, e))
+        self.inserted += modified
+        self.duplicates += len(ops) - matched - errors
+
+        # which $sets matched isn't reported, so every month in the
+        # batch is redone if any of them added something
+        with profiling.timer('mongo.bulk_write_bookkeeping'):
+            if modified:
+                self.rollups.invalidate(id, set(date[:7] for date in dates))
+                self._stale_cache(id, dates)
+                self.db_conn.update_collection_stats(id, created, dates)
+
+
+    def _stale_cache(self, id, dates):
+        '''The cached arrays for id no longer match mongo if dates are
+        in them, so readers are sent back to mongo until a refresh.'''
+        from utils.cache import StationCache, CacheException
+        if self.cache is None:
+            self.cache = StationCache()
+        try:
+            self.cache.mark_stale(id, dates)
+        except CacheException as e:
+            print('{}... run get_weather.py --refresh-cache -i {}'.format(e, id))
+
+
+    def counts(self):
+        return {'inserted': self.inserted, 'duplicates': self.duplicates, 'failed': self.failed}
+
+
+
+class Rollups:
+    '''
+    Per station / year / month sums and counts kept in the rollups
+    collection so the averages don't have to be worked out from the
+    daily records every time. Each document has:
+        station, year, month
+        tmin_sum, tmin_count, tmax_sum, tmax_count
+        days, paired_tmin_sum, paired_tmax_sum (days with both)
+        stale: True when records were added since it was built
+        v: bumped by every invalidate
+    A month with no records isn't saved, so records that arrive some
+    other way (mongoimport) are still found. BulkWriter marks the months
+    it touches as stale and get_month rebuilds only the stale or missing
+    ones. A rebuild only replaces a cell still at the v it read, so an
+    invalidate that lands while it aggregates isn't lost.
+    '''
+    def __init__(self, db_conn):
+        self.db_conn = db_conn
+        self.collection = db_conn.db['rollups']
+        self._indexed = False
+
+
+    def _key(self, station, year_month):
+        return '{}:{}'.format(station, year_month)
+
+
+    def _ensure_index(self):
+        if not self._indexed:
+            self.collection.create_index([('station', pymongo.ASCENDING), ('month', pymongo.ASCENDING),
+                                          ('year', pymongo.ASCENDING)])
+            self._indexed = True
+
+
+    def invalidate(self, station, year_months):
+        '''Marks the rollups for the station's yyyy-mm year_months as stale.'''
+        keys = [self._key(station, ym) for ym in year_months]
+        self.collection.update_many({'_id': {'$in': keys}}, {'$set': {'stale': True}, '$inc': {'v': 1}})
+
+
+    def get_month(self, station, month, start_year, end_year):
+        '''Returns {year: rollup} for the month from start_year to end_year,
+        leaving out years with no paired days. Stale and missing years
+        are rebuilt from the station collection in one aggregation first.
+        station must be the collection set on db_conn.'''
+        month = int(month)
+        years = range(int(start_year), int(end_year) + 1)
+        if not years:
+            raise MongoDBException('Start year {} is after end year {}.'.format(start_year, end_year))
+        cells = {}
+        # year: v of the stale cells, for the conditional replace
+        versions = {}
+        try:
+            self._ensure_index()
+            for rec in self.collection.find({'station': station, 'month': month,
+                                             'year': {'$gte': years[0], '$lte': years[-1]}}):
+                if rec.get('stale'):
+                    # None for cells from before v was kept
+                    versions[rec.get('year')] = rec.get('v')
+                else:
+                    cells[rec.get('year')] = rec
+
+            missing = [yr for yr in years if yr not in cells]
+            profiling.count('rollups.hits', len(years) - len(missing))
+            profiling.count('rollups.rebuilt', len(missing))
+            if missing:
+                with profiling.timer('rollups.rebuild'):
+                    cells.update(self.rebuild(station, month, missing, versions))
+        except PyMongoError as e:
+            raise MongoDBException('Rollups failed: {}'.format(e))
+        return {yr: rec for yr, rec in cells.items() if rec.get('days')}
+
+
+    def rebuild(self, station, month, years, versions=None):
+        '''Works out and saves the rollups for the month in each of the years.
+        versions is {year: v} of the stale cells read, a year not in it
+        had no cell. A cell invalidated (or made) since then is left for
+        the next call to rebuild. Returns {year: rollup}.'''
+        versions = versions or {}
+        stats = self.db_conn.get_month_stats(month, years)
+        cells = {}
+        ops = []
+        for yr in years:
+            rec = {'tmin_sum': 0, 'tmin_count': 0, 'tmax_sum': 0, 'tmax_count': 0,
+                   'days': 0, 'paired_tmin_sum': 0, 'paired_tmax_sum': 0}
+            rec.update(stats.get(yr, {}))
+            cells[yr] = rec
+            key = self._key(station, '{}-{:02d}'.format(yr, month))
+            if not rec.get('tmin_count') and not rec.get('tmax_count'):
+                # nothing to save, and a stale empty cell goes away
+                if yr in versions:
+                    ops.append(DeleteOne({'_id': key, 'v': versions.get(yr)}))
+                continue
+            rec.update({'station': station, 'year': yr, 'month': month, 'stale': False,
+                        'v': versions.get(yr) or 0})
+            if yr in versions:
+                ops.append(ReplaceOne({'_id': key, 'v': versions.get(yr)}, rec))
+            else:
+                # an upsert that runs into a cell made since is a duplicate key
+                ops.append(ReplaceOne({'_id': key, 'v': {'$exists': False}}, rec, upsert=True))
+        if ops:
+            try:
+                self.collection.bulk_write(ops, ordered=False)
+            except BulkWriteError as e:
+                if any(error.get('code') != 11000 for error in e.details.get('writeErrors', [])):
+                    raise
+        return cells
+
+
+
+class Coverage:
+    '''
+    Ledger of the date ranges fetched from ncdc for each station, so a
+    sync only asks for what is missing instead of re-fetching everything
+    and letting the unique index throw away the duplicates. One
+    document per station:
+        _id: station id
+        fetched: [[start, end], ...] yyyy-mm-dd, sorted and merged
+        empty: [[start, end], ...] the fetched ranges ncdc had no records for
+        v: bumped on every write so concurrent records don't lose ranges
+    Days within settle_days of today are never recorded since ncdc
+    can still add to them, so they are fetched again on the next sync.
+    '''
+    def __init__(self, db_conn, settle_days=30):
+        self.db_conn = db_conn
+        self.collection = db_conn.db['coverage']
+        self.settle_days = settle_days
+        self.dates = Dates()
+
+
+    def get(self, station):
+        '''Returns {fetched, empty} lists of (start, end) for the station.'''
+        rec = self.collection.find_one({'_id': station}) or {}
+        return {'fetched': [tuple(r) for r in rec.get('fetched', [])],
+                'empty': [tuple(r) for r in rec.get('empty', [])]}
+
+
+    def get_many(self, stations):
+        '''Same as get for several stations in one query. Returns {station: {fetched, empty}}.'''
+        found = {station: {'fetched': [], 'empty': []} for station in stations}
+        try:
+            for rec in self.collection.find({'_id': {'$in': list(stations)}}):
+                found[rec.get('_id')] = {'fetched': [tuple(r) for r in rec.get('fetched', [])],
+                                         'empty': [tuple(r) for r in rec.get('empty', [])]}
+        except PyMongoError as e:
+            raise MongoDBException('Could not read the coverage ledger: {}'.format(e))
+        return found
+
+
+    def missing(self, station, start_day, end_day, ledger=None):
+        '''Returns the (start, end) ranges from start_day through end_day
+        that haven't been fetched for the station. ledger is the
+        entry from get / get_many if it was already read.'''
+        if ledger is None:
+            ledger = self.get(station)
+        return self.dates.missing_ranges(ledger.get('fetched'), start_day, end_day)
+
+
+    def record(self, station, ranges, empty=()):
+        '''Adds the (start, end) ranges to the station's fetched ranges,
+        and the ones in empty to its empty ranges too.
+        Anything after the settle date is left off.'''
+        settled = (datetime.date.today() - datetime.timedelta(self.settle_days)).isoformat()
+        ranges = [(start, min(end, settled)) for start, end in ranges if start <= settled]
+        empty = [(start, min(end, settled)) for start, end in empty if start <= settled]
+        if not ranges and not empty:
+            return
+        try:
+            # backfill workers record the same station at the same time, so
+            # the replace only goes through if nobody else wrote since the
+            # read (v), otherwise it is read and merged again
+            while True:
+                rec = self.collection.find_one({'_id': station}) or {}
+                fetched = self.dates.merge_ranges([tuple(r) for r in rec.get('fetched', [])] + ranges + empty)
+                merged = self.dates.merge_ranges([tuple(r) for r in rec.get('empty', [])] + empty)
+                doc = {'fetched': [list(r) for r in fetched], 'empty': [list(r) for r in merged],
+                       'v': rec.get('v', 0) + 1}
+                if rec:
+                    if self.collection.replace_one({'_id': station, 'v': rec.get('v')}, doc).matched_count:
+                        return
+                else:
+                    try:
+                        self.collection.insert_one(dict(doc, _id=station))
+                        return
+                    except DuplicateKeyError:
+                        pass
+        except PyMongoError as e:
+            raise MongoDBException('Coverage update for {} failed: {}'.format(station, e))
+
+
+    def seed(self, station):
+        '''Records the station collection's first through last date as
+        fetched. For collections loaded before the ledger existed. This
+        trusts there are no gaps in between. Returns the range or None.'''
+        stats = self.db_conn.get_collection_stats([station]).get(station, {})
+        if not stats.get('min_date'):
+            return None
+        day_range = (stats.get('min_date')[:10], stats.get('max_date')[:10])
+        self.record(station, [day_range])
+        return day_range
+
+
+
 class Stations:
     '''Class for working with the stations collection.'''
     def __init__(self):
         try:
-            self.client = pymongo.MongoClient('localhost', 27017, connect=True)
-            self.db = self.client['weather']
+            self.client = get_client()
+            self.db = get_database()
             self.collection = self.db['stations']
+            self._geo_indexed = False
+            self._box_indexed = False
+            self._id_indexed = False
         except:
             raise MongoDBException('Could not connect to the database.')
 
 
+    def ensure_geo_index(self):
+        '''Adds a GeoJSON location to every station missing one and the
+        2dsphere index on it. Only does the work the first time.
+        Stations without a usable lat / lon get no location (the index
+        build fails on one) and are left out of the geo searches.'''
+        if self._geo_indexed:
+            return
+        if 'location_2dsphere' not in self.collection.index_information():
+            # from before the lat / lon were checked
+            self.collection.update_many({'location.coordinates': None}, {'$unset': {'location': ''}})
+            ops = [UpdateOne({'_id': rec.get('_id')},
+                             {'$set': {'location': {'type': 'Point',
+                                                    'coordinates': [rec.get('lon'), rec.get('lat')]}}})
+                   for rec in self.collection.find({'location': {'$exists': False}},
+                                                   {'_id': 1, 'lat': 1, 'lon': 1})
+                   if self._valid_point(rec.get('lat'), rec.get('lon'))]
+            if ops:
+                self.collection.bulk_write(ops, ordered=False)
+            self.collection.create_index([('location', pymongo.GEOSPHERE)])
+        self._geo_indexed = True
+
+
+    def _valid_point(self, lat, lon):
+        numbers = all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in (lat, lon))
+        return numbers and -90 <= lat <= 90 and -180 <= lon <= 180
+
+
+    def coverage_query(self, start=None, end=None, min_coverage=None):
+        '''Query for stations with data from start through end (yyyy-mm-dd)
+        and a datacoverage of at least min_coverage (0 - 1). Uses the
+        mindate, maxdate and datacoverage fields from the ncdc stations list.'''
+        query = {}
+        if start is not None:
+            query['mindate'] = {'$lte': start}
+        if end is not None:
+            query['maxdate'] = {'$gte': end}
+        if min_coverage is not None:
+            query['datacoverage'] = {'$gte': min_coverage}
+        return query
+
+
+    def get_nearest(self, lat, lon, k=10, max_km=None, start=None, end=None, min_coverage=None):
+        '''Returns a list of the k stations nearest lat / lon, closest first,
+        each with a distance in km. max_km and the coverage_query filters
+        are optional.'''
+        self.ensure_geo_index()
+        near = {'near': {'type': 'Point', 'coordinates': [lon, lat]},
+                'distanceField': 'distance', 'spherical': True,
+                'query': self.coverage_query(start, end, min_coverage)}
+        if max_km is not None:
+            near['maxDistance'] = max_km * 1000
+        results = self.collection.aggregate([
+            {'$geoNear': near},
+            {'$limit': k},
+            {'$project': {'_id': 0, 'location': 0}}])
+        stations = list(results)
+        for rec in stations:
+            rec['distance'] = rec.get('distance') / 1000
+        return stations
+
+
+    def get_within(self, lat, lon, radius_km, start=None, end=None, min_coverage=None):
+        '''Returns a cursor over the stations within radius_km of lat / lon.
+        The coverage_query filters are optional.'''
+        self.ensure_geo_index()
+        query = self.coverage_query(start, end, min_coverage)
+        query['location'] = {'$geoWithin': {'$centerSphere': [[lon, lat], radius_km / EARTH_RADIUS_KM]}}
+        return self.collection.find(query, {'_id': 0, 'location': 0})
+
+
     def get_station(self, id):
         # validates that the station_id is valid from our local
         # stations collection
         return self.collection.find_one({"station_id" : id })
 
 
+    def get_stations(self, ids):
+        '''Returns the set of ids from the list that are in the
+        stations collection. One query for the whole list.'''
+        self.ensure_id_index()
+        found = self.collection.find({'station_id': {'$in': list(ids)}}, {'_id': 0, 'station_id': 1})
+        return set(rec.get('station_id') for rec in found)
+
+
     def get_station_name(self, id):
         '''For print information about the station id provided'''
         return self.collection.find_one({'station_id': id},{'_id':0, 'name':1, 'lat': 1, 'lon': 1})
 
 
+    def ensure_id_index(self):
+        '''Unique index on station_id for the lookups by id.'''
+        if self._id_indexed:
+            return
+        try:
+            self.collection.create_index([('station_id', pymongo.ASCENDING)], unique=True)
+        except OperationFailure:
+            # the import has duplicate ids... a plain index still helps
+            self.collection.create_index([('station_id', pymongo.ASCENDING)], name='station_id_dups')
+        self._id_indexed = True
+
+
+    def get_station_names(self, ids):
+        '''Returns {id: {name, lat, lon}} for the ids in one $in query.'''
+        self.ensure_id_index()
+        found = self.collection.find({'station_id': {'$in': list(ids)}},
+                                     {'_id': 0, 'station_id': 1, 'name': 1, 'lat': 1, 'lon': 1})
+        return {rec.pop('station_id'): rec for rec in found}
+
+
     def get_upper(self, coordinate, coordinate_range):
         '''return the upper search limit based on conditions.'''
         if coordinate_range == 0 and coordinate >= 0:
@@ -208,6 +1097,17 @@ class Stations:
     def get_locations(self, lat, latpm, lon, lonpm):
         '''Check which args are not empty, set the ranges,
         build the monog request and get the results.'''
+        # a list, since cursor.count() is gone in newer pymongo
+        results = list(self.iter_locations(lat, latpm, lon, lonpm))
+        if not results:
+            return None
+        return results
+
+
+    def iter_locations(self, lat, latpm, lon, lonpm, batch_size=500):
+        '''Same search as get_locations but returns the cursor, so the
+        caller can take the stations a batch at a time (or stop early
+        and close it) instead of waiting for the whole list.'''
         qdict = {}
         if lat != '':
             lat_lower = self.get_lower(lat, latpm)
@@ -221,8 +1121,9 @@ class Stations:
             qdict['lon_upper'] = lon_upper
 
         qstr = self.build_query(qdict)
-        results = self.collection.find(qstr, {'_id': 0})
-        if results.count() == 0:
-            return None
-        return results
+        if not self._box_indexed:
+            # so the lat / lon bounds are an index scan
+            self.collection.create_index([('lat', pymongo.ASCENDING), ('lon', pymongo.ASCENDING)])
+            self._box_indexed = True
+        return self.collection.find(qstr, {'_id': 0, 'location': 0}, batch_size=batch_size)
             
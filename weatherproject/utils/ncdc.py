@@ -5,44 +5,194 @@ Pass:
 
 Build the query_string to send to the ncdc site and return
 results.
+
+All instances share one pooled requests Session (see get_session)
+so repeated calls reuse the same connections to the ncdc site.
+requests is imported by get_session, so importing this module (the
+CLIs do for -v and --status) doesn't load it.
 '''
-import requests
+import json
+import threading
+from utils import profiling
+
+
+class NcdcException(Exception):
+    '''Raised by NcdcWeather.fetch_min_max_data. retryable is set
+    for the responses worth trying again: timeouts, connection
+    errors, 429 (too many requests) and 5xx.'''
+    def __init__(self, msg, status_code=None, retryable=False):
+        super().__init__(msg)
+        self.status_code = status_code
+        self.retryable = retryable
+
+
+class QuotaException(NcdcException):
+    '''Raised by the utils.fetch token buckets when the daily quota is
+    used up. Nothing is wrong with the window, it just has to wait.'''
+    pass
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session(pool_size=10):
+    '''Returns the process wide requests Session. The first call
+    sets the size of the connection pool.'''
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
 
 
 class NcdcWeather:
     '''
     Create an instance of the class with the station id,
-    ncdc token, and optional record limit.
+    ncdc token, and optional record limit (records per page).
+    url can be given to point at something other than the ncdc
+    site, like utils.stub_server.
+    follow_pages: request the rest of a truncated result set using
+        metadata.resultset. If off, records past the first page are
+        dropped but counted in self.dropped and reported.
+    throttle: optional callable run before every request, used by
+        utils.fetch to keep pages under the rate limit.
+    cache: optional utils.http_cache.ResponseCache. Pages found there
+        don't make a request at all.
     '''
     url = 'https://www.ncdc.noaa.gov/cdo-web/api/v2/data'
+    # the most records the ncdc site returns in one page
+    max_limit = 1000
+    datasetid = 'GHCND'
+    datatypes = ('TMIN', 'TMAX')
+    units = 'standard'
 
-    def __init__(self, station, token, limit=14):
+    def __init__(self, station, token, limit=1000, url=None, session=None,
+                 follow_pages=True, throttle=None, cache=None):
         self.station = station
         self.token = token
-        self.limit = limit
+        self.limit = min(limit, self.max_limit)
+        if url is not None:
+            self.url = url
+        self.session = session if session is not None else get_session()
+        self.follow_pages = follow_pages
+        self.throttle = throttle
+        self.cache = cache
+        # counters for the life of the instance
+        self.requests = 0
+        self.dropped = 0
+        # FetchEngine threads share an instance per station
+        self._count_lock = threading.Lock()
 
 
     def get_min_max_data(self, start_day, end_day):
-        '''Gets the query string built and calls the ncdc site'''
-        query_string =  self.__build_min_max_querystring(start_day, end_day)
+        '''Gets the query string built and calls the ncdc site.
+        Returns False if the request failed.'''
         try:
-            headers = {'token': self.token}
-            response = requests.get(query_string, headers=headers, timeout=15)
+            return self.fetch_min_max_data(start_day, end_day)
+        except NcdcException as e:
+            print("Request failed: %s" % (e))
+            return False
+
+
+    def fetch_min_max_data(self, start_day, end_day):
+        '''Same as get_min_max_data but raises NcdcException
+        instead of printing and returning False.
+        If the result set is larger than one page the remaining pages
+        are requested and the results joined, so the text returned
+        always looks like a single ncdc response.'''
+        # the whole window, pages, throttle waits and all
+        with profiling.timer('ncdc.fetch'):
+            text = self._get_page(start_day, end_day, 1)
+            page = self._parse(text)
+            resultset = page.get('metadata', {}).get('resultset')
+            if not resultset:
+                # empty response {}... nothing more to get
+                return text
 
-            if self._check_status_code(response.status_code) == False:
-                return False
+            results = page.get('results', [])
+            count = resultset.get('count', len(results))
+            offset = 1 + len(results)
+            pages = 1
+            while offset <= count and self.follow_pages:
+                more = self._parse(self._get_page(start_day, end_day, offset)).get('results')
+                if not more:
+                    break
+                results.extend(more)
+                offset += len(more)
+                pages += 1
 
-            return response.text
+            if len(results) < count:
+                with self._count_lock:
+                    self.dropped += count - len(results)
+                print('Warning: {} of {} records for {} {} - {} were not retrieved.'.format(
+                    count - len(results), count, self.station, start_day, end_day))
+
+            if pages == 1:
+                return text
+            resultset['limit'] = len(results)
+            return json.dumps({'metadata': page['metadata'], 'results': results})
+
+
+    def _parse(self, text):
+        try:
+            with profiling.timer('ncdc.json_decode'):
+                return json.loads(text)
+        except ValueError as e:
+            raise NcdcException('Response was not json: {}'.format(e))
+
+
+    def _get_page(self, start_day, end_day, offset):
+        '''Makes a single request. offset is 1 based like the ncdc site.'''
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(self.url, self.station, self.datasetid, self.datatypes, start_day, end_day,
+                                 self.units, self.limit, offset)
+            text = self.cache.get(key, end_day)
+            if text is not None:
+                profiling.count('ncdc.cache_hits')
+                return text
+
+        query_string =  self.__build_min_max_querystring(start_day, end_day, offset)
+        if self.throttle is not None:
+            with profiling.timer('ncdc.throttle_wait'):
+                self.throttle()
+        with self._count_lock:
+            self.requests += 1
+        profiling.count('ncdc.requests')
+        # already loaded by get_session
+        import requests
+        try:
+            headers = {'token': self.token}
+            with profiling.timer('ncdc.request'):
+                response = self.session.get(query_string, headers=headers, timeout=15)
         except requests.exceptions.RequestException as e:
-            print("Request failed: %s" % (e))
-            return False
+            raise NcdcException(str(e), retryable=True)
+        profiling.count('ncdc.bytes', len(response.content))
 
+        if self._check_status_code(response.status_code) == False:
+            code = response.status_code
+            raise NcdcException('Status code {} for {} - {}'.format(code, start_day, end_day),
+                                status_code=code, retryable=(code == 429 or code >= 500))
 
-    def __build_min_max_querystring(self,start_day,end_day):
+        if key is not None:
+            self.cache.put(key, response.text)
+        return response.text
+
+
+    def __build_min_max_querystring(self, start_day, end_day, offset=1):
         '''Builds the querstring to send to ncdc site'''
-        return (self.url + '?datasetid=GHCND&stationid=GHCND:' + self.station 
-            + '&startdate=' + start_day + '&enddate=' + end_day + 
-            '&datatypeid=TMIN&datatypeid=TMAX&units=standard&limit=' + str(self.limit))
+        query = (self.url + '?datasetid=' + self.datasetid + '&stationid=GHCND:' + self.station
+            + '&startdate=' + start_day + '&enddate=' + end_day + ''.join(
+            '&datatypeid=' + t for t in self.datatypes) + '&units=' + self.units + '&limit=' + str(self.limit))
+        if offset > 1:
+            query += '&offset=' + str(offset)
+        return query
 
 
 
@@ -52,4 +202,4 @@ class NcdcWeather:
         if code == 200:
             return True
         else:
-            return False
\ No newline at end of file
+            return False
@@ -0,0 +1,162 @@
+'''
+Stage timers and counters for the hot paths.
+
+The utils modules wrap their slow parts:
+    with profiling.timer('mongo.get_records'):
+        ...
+    profiling.count('ncdc.requests')
+and the scripts turn collection on with --profile. While it is off,
+timer() hands back one shared do-nothing context manager and count()
+returns straight away, so the calls cost next to nothing.
+
+Stages nest (ncdc.fetch holds ncdc.request and ncdc.json_decode) and
+the fetch threads time in parallel, so the stage seconds can add up to
+more than the wall time.
+
+start(mode, output) is what the scripts call:
+    breakdown  table of stages and counters on stderr when the script exits
+    json       the same as json, to output or stderr
+    cprofile   breakdown plus a cProfile dump to output (default <script>.prof)
+'''
+import atexit
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+MODES = ('breakdown', 'json', 'cprofile')
+
+enabled = False
+_lock = threading.Lock()
+# name: [calls, seconds]
+_stages = defaultdict(lambda: [0, 0.0])
+_counters = defaultdict(int)
+_started = None
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+
+def timer(name):
+    '''Context manager timing the stage name, if collection is on.'''
+    if not enabled:
+        return _NULL_TIMER
+    return _Timer(name)
+
+
+def add_time(name, seconds, calls=1):
+    with _lock:
+        stage = _stages[name]
+        stage[0] += calls
+        stage[1] += seconds
+
+
+def count(name, n=1):
+    '''Adds n to the counter name, if collection is on.'''
+    if enabled:
+        with _lock:
+            _counters[name] += n
+
+
+def enable():
+    global enabled, _started
+    _started = time.perf_counter()
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    global _started
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+    _started = time.perf_counter()
+
+
+def snapshot():
+    '''Returns {wall, stages: {name: {calls, seconds}}, counters}.'''
+    with _lock:
+        return {'wall': time.perf_counter() - _started if _started is not None else 0.0,
+                'stages': {name: {'calls': calls, 'seconds': seconds}
+                           for name, (calls, seconds) in sorted(_stages.items())},
+                'counters': dict(sorted(_counters.items()))}
+
+
+def report(file=None):
+    '''Prints the stages, slowest first, and the counters.'''
+    file = file or sys.stderr
+    snap = snapshot()
+    wall = snap.get('wall') or 0.0
+    print('Profile'.center(64, '-'), file=file)
+    print('{:34}{:>8}{:>12}{:>8}'.format('stage', 'calls', 'seconds', '% wall'), file=file)
+    for name, stage in sorted(snap.get('stages').items(), key=lambda s: -s[1].get('seconds')):
+        pct = 100 * stage.get('seconds') / wall if wall else 0
+        print('{:34}{:>8}{:>12.4f}{:>7.1f}%'.format(name, stage.get('calls'), stage.get('seconds'), pct),
+              file=file)
+    for name, value in snap.get('counters').items():
+        print('{:34}{:>8}'.format(name, value), file=file)
+    print('{:34}{:>20.4f}'.format('wall', wall), file=file)
+
+
+
+def start(mode='breakdown', output=None):
+    '''Turns collection on and has the results written when the
+    process exits (the scripts leave through exit()).'''
+    if mode not in MODES:
+        raise ValueError('Unknown profile mode: {}'.format(mode))
+    enable()
+    profiler = None
+    if mode == 'cprofile':
+        profiler = cProfile.Profile()
+        if output is None:
+            output = os.path.splitext(os.path.basename(sys.argv[0]))[0] + '.prof'
+        profiler.enable()
+
+    def finish():
+        disable()
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(output)
+        if mode == 'json':
+            text = json.dumps(snapshot(), indent=2)
+            if output:
+                with open(output, 'w') as f:
+                    f.write(text)
+            else:
+                print(text, file=sys.stderr)
+        else:
+            report()
+        if profiler is not None:
+            print('cProfile stats written to {} (python -m pstats {})'.format(output, output), file=sys.stderr)
+
+    atexit.register(finish)
@@ -0,0 +1,313 @@
+'''
+Drawing for plot_weather.py and its headless batch mode.
+
+The draw functions work on axes they are given instead of the pyplot
+state machine, so the same code draws the interactive window
+(plt.figure()) and the batch charts (a plain Agg Figure).
+make_axes lays out the axes for a view:
+    month    one axes, the yearly averages for one month
+    months   3 x 4 grid, a plot per month
+    seasons  2 x 2 grid, a plot per season
+    heatmap  a row per station, each with a colorbar axes
+
+Batch mode reads a manifest of jobs, json (a list) or one json object
+per line:
+    {"stations": "ID_1,ID_2", "month": 1, "start": 1950, "end": 1990,
+     "view": "month", "method": "rollup", "anomalies": false,
+     "baseline": "1951-1980", "output": "nome_jan.png"}
+only stations (and month for the month view) are required. A job
+with a method reads mongo with it instead of the local cache. The jobs
+are spread over worker processes and each worker keeps one Figure per
+layout, clearing and redrawing its axes for every chart, so render
+time and memory stay flat however many charts it draws.
+matplotlib is imported by whoever makes the figure (plot_weather.py or
+BatchRenderer), not here.
+'''
+import json
+import multiprocessing
+import os
+import time
+from pymongo.errors import PyMongoError
+import utils.weather as weather
+import utils.climatology as climatology
+import utils.mongodb as db
+
+try:
+    import resource
+except ImportError:
+    # windows has no resource module, rss just isn't reported
+    resource = None
+
+MONTH_NAMES = {1: 'January', 2: 'February', 3: 'March', 4: 'April', 5: 'May', 6: 'June',
+               7: 'July', 8: 'August', 9: 'September', 10: 'October', 11: 'November', 12: 'December'}
+VIEWS = ('month', 'months', 'seasons', 'heatmap')
+FORMATS = ('png', 'svg')
+
+
+class RenderException(Exception):
+    pass
+
+
+
+def figure_size(view, stations=1):
+    return {'month': (10, 6), 'months': (16, 9), 'seasons': (12, 8)}.get(view, (12, 3 + 2 * stations))
+
+
+def make_axes(fig, view, stations=1):
+    '''Adds the axes for view to fig. Returns the single axes for
+    month, an array of axes for months and seasons, or a list of
+    (axes, colorbar axes) per station for heatmap.'''
+    if view == 'month':
+        return fig.add_subplot(1, 1, 1)
+    if view == 'months':
+        return fig.subplots(3, 4, sharex=True)
+    if view == 'seasons':
+        return fig.subplots(2, 2, sharex=True)
+    grid = fig.add_gridspec(stations, 2, width_ratios=[40, 1])
+    return [(fig.add_subplot(grid[i, 0]), fig.add_subplot(grid[i, 1])) for i in range(stations)]
+
+
+def draw_month(ax, averages, month):
+    '''Yearly averages for the month, a line per station. One station
+    also gets the straight line regression and moving average.'''
+    for wa in averages:
+        ax.plot(wa.frame['year'], wa.frame['avg'], label=wa.station_id)
+
+    if len(averages) == 1:
+        wa = averages[0]
+        ax.plot(wa.year_list, wa.polyvalue, linestyle='-', color='r', label='SL Regression')
+        ax.plot(wa.frame['year'], wa.frame['avg'].rolling(max(wa.rollingvalue, 1), center=True).mean(),
+                linestyle='-', color='g', label='Moving Avg')
+
+    ax.set_title('{} Averages'.format(MONTH_NAMES.get(int(month))))
+    ax.set_xlabel('Year')
+    ax.set_ylabel('Temp')
+    ax.grid()
+    ax.legend()
+
+
+def draw_climate(axes, climates, view, anomalies=False):
+    '''The months, seasons or heatmap view of built
+    utils.climatology.Climatology on axes from make_axes.'''
+    label = 'Anomaly' if anomalies else 'Temp'
+    if view == 'heatmap':
+        for (ax, cax), clim in zip(axes, climates):
+            table = (clim.anomalies if anomalies else clim.avg).T
+            extent = (clim.start_year - 0.5, clim.end_year + 0.5, 12.5, 0.5)
+            if anomalies:
+                # centered on 0 so warm and cold get the same scale
+                limit = max(abs(table.min().min()), abs(table.max().max())) or 1
+                image = ax.imshow(table, aspect='auto', cmap='coolwarm', vmin=-limit, vmax=limit, extent=extent)
+            else:
+                image = ax.imshow(table, aspect='auto', cmap='viridis', extent=extent)
+            ax.set_yticks(range(1, 13))
+            ax.set_yticklabels([MONTH_NAMES.get(m)[:3] for m in range(1, 13)])
+            ax.set_title(clim.station_id)
+            ax.figure.colorbar(image, cax=cax, label=label)
+        axes[-1][0].set_xlabel('Year')
+        return
+
+    if view == 'months':
+        panels = [(MONTH_NAMES.get(m), lambda clim, m=m: clim.month(m, anomalies)) for m in range(1, 13)]
+    else:
+        panels = [(name, lambda clim, name=name: clim.seasons(anomalies)[name]) for name in climatology.SEASONS]
+    for ax, (title, series) in zip(axes.flat, panels):
+        for clim in climates:
+            values = series(clim)
+            ax.plot(values.index, values.values, label=clim.station_id)
+        ax.set_title(title)
+        ax.grid()
+    for ax in axes[:, 0]:
+        ax.set_ylabel(label)
+    for ax in axes[-1, :]:
+        ax.set_xlabel('Year')
+    axes.flat[0].legend()
+
+
+def parse_baseline(text):
+    '''yyyy-yyyy to (first, last) or None if it isn't one.'''
+    try:
+        first, last = (int(year) for year in text.split('-'))
+    except (AttributeError, ValueError):
+        return None
+    return (first, last) if first <= last else None
+
+
+
+def read_manifest(path):
+    '''Returns the list of jobs in a json or json lines manifest.'''
+    try:
+        with open(path) as f:
+            text = f.read()
+    except OSError as e:
+        raise RenderException('Could not read {}: {}'.format(path, e))
+    try:
+        jobs = json.loads(text)
+    except ValueError:
+        try:
+            jobs = [json.loads(line) for line in text.splitlines() if line.strip()]
+        except ValueError as e:
+            raise RenderException('{} is not json or json lines: {}'.format(path, e))
+    if isinstance(jobs, dict):
+        jobs = [jobs]
+    return jobs
+
+
+def check_job(job):
+    '''Normalizes a manifest job. Returns it with stations as a list
+    and the defaults filled in. Raises RenderException if it is wrong.'''
+    if not isinstance(job, dict):
+        raise RenderException('A job must be an object: {}'.format(job))
+    job = dict(job)
+    stations = job.get('stations') or job.get('id')
+    if isinstance(stations, str):
+        stations = stations.split(',')
+    if not stations:
+        raise RenderException('No stations in job {}'.format(job))
+    job['stations'] = list(stations)
+    job.setdefault('view', 'month')
+    if job.get('view') not in VIEWS:
+        raise RenderException('Unknown view {}'.format(job.get('view')))
+    if job.get('view') == 'month':
+        try:
+            if not 1 <= int(job.get('month')) <= 12:
+                raise ValueError
+        except (TypeError, ValueError):
+            raise RenderException('The month view needs a month 1-12: {}'.format(job))
+    for name in ('start', 'end'):
+        if job.get(name) is not None:
+            try:
+                job[name] = int(job.get(name))
+            except (TypeError, ValueError):
+                raise RenderException('{} must be a year: {}'.format(name.capitalize(), job))
+    if job.get('start') is not None and job.get('end') is not None and job.get('start') > job.get('end'):
+        raise RenderException('Start year is after the end year: {}'.format(job))
+    if job.get('baseline') and not isinstance(job.get('baseline'), (list, tuple)):
+        baseline = parse_baseline(job.get('baseline'))
+        if baseline is None:
+            raise RenderException('Baseline must be yyyy-yyyy: {}'.format(job))
+        job['baseline'] = baseline
+    return job
+
+
+def output_name(job, fmt):
+    '''The file name for a job without an output.'''
+    years = '{}-{}'.format(job.get('start') or 'first', job.get('end') or 'last')
+    view = 'm{:02d}'.format(int(job.get('month'))) if job.get('view') == 'month' else job.get('view')
+    return '{}_{}_{}.{}'.format('+'.join(job.get('stations')), view, years, fmt)
+
+
+
+class BatchRenderer:
+    '''
+    Draws jobs to files with the Agg canvas, no pyplot.
+    One Figure per layout (view and station count) is made the first
+    time it is needed and its axes are cleared and drawn on again after.
+    output_dir: where the charts go
+    fmt: png or svg, used when a job's output has no extension
+    '''
+    def __init__(self, output_dir='.', fmt='png', cache=None, dpi=100):
+        self.output_dir = output_dir
+        self.fmt = fmt
+        self.cache = cache
+        self.dpi = dpi
+        # (view, stations): (figure, axes)
+        self.layouts = {}
+
+
+    def _layout(self, view, stations):
+        key = (view, stations if view == 'heatmap' else 1)
+        layout = self.layouts.get(key)
+        if layout is None:
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            from matplotlib.figure import Figure
+            fig = Figure(figsize=figure_size(view, stations))
+            FigureCanvasAgg(fig)
+            layout = self.layouts[key] = (fig, make_axes(fig, view, stations))
+        else:
+            fig, axes = layout
+            for ax in fig.axes:
+                ax.clear()
+        return layout
+
+
+    def render(self, job):
+        '''Builds the data for a job and saves its chart. Returns the path.'''
+        job = check_job(job)
+        view = job.get('view')
+        stations = job.get('stations')
+        if view == 'month':
+            # same as plot_weather.py, a job with a method doesn't use the cache
+            cache = None if job.get('method') else self.cache
+            averages = weather.build_many(stations, str(job.get('month')), job.get('start'), job.get('end'),
+                                          job.get('method') or 'rollup', cache, workers=1)
+        else:
+            climates = climatology.build_many(stations, job.get('start'), job.get('end'),
+                                              job.get('baseline'), self.cache, workers=1)
+
+        fig, axes = self._layout(view, len(stations))
+        if view == 'month':
+            draw_month(axes, averages, job.get('month'))
+        else:
+            draw_climate(axes, climates, view, job.get('anomalies', False))
+            if view != 'heatmap':
+                fig.tight_layout()
+
+        path = os.path.join(self.output_dir, job.get('output') or output_name(job, self.fmt))
+        if not os.path.splitext(path)[1]:
+            path += '.' + self.fmt
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        fig.savefig(path, dpi=self.dpi)
+        return path
+
+
+
+# the worker process's renderer, set by _init_worker
+_renderer = None
+
+
+def _init_worker(output_dir, fmt, cache_root, mongo_settings):
+    global _renderer
+    from utils.cache import StationCache
+    db.configure(**mongo_settings)
+    cache = StationCache(cache_root) if cache_root else None
+    _renderer = BatchRenderer(output_dir, fmt, cache)
+
+
+def _rss_mb():
+    if resource is None:
+        return None
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _render_job(item):
+    index, job = item
+    start = time.perf_counter()
+    try:
+        path, error = _renderer.render(job), None
+    except (RenderException, weather.WeatherException, climatology.ClimatologyException,
+            db.MongoDBException, PyMongoError) as e:
+        path, error = None, e.__str__()
+    except Exception as e:
+        # one bad manifest row doesn't stop the batch, whatever it raises
+        path, error = None, '{}: {}'.format(type(e).__name__, e)
+    return {'index': index, 'path': path, 'error': error, 'pid': os.getpid(),
+            'seconds': time.perf_counter() - start, 'rss_mb': _rss_mb()}
+
+
+def run_batch(jobs, output_dir='.', fmt='png', processes=4, cache_root=None):
+    '''Renders the jobs on processes workers. Yields a result dict per
+    job as they finish: index, path, error, pid, seconds, rss_mb
+    (the worker's peak resident memory so far).'''
+    args = (output_dir, fmt, cache_root, db.settings())
+    items = list(enumerate(jobs))
+    if processes <= 1:
+        _init_worker(*args)
+        for item in items:
+            yield _render_job(item)
+        return
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(processes, initializer=_init_worker, initargs=args) as pool:
+        for result in pool.imap_unordered(_render_job, items):
+            yield result
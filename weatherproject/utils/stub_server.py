@@ -0,0 +1,156 @@
+'''
+A local stand in for the ncdc data api so the fetch code can be
+run and tested without a token or using up the daily quota.
+
+It answers GET /cdo-web/api/v2/data the way the ncdc site does:
+    - stationid, startdate, enddate, datatypeid, limit and offset are honored
+    - the response has metadata.resultset {offset, count, limit} and results
+    - an empty query returns {}
+    - a missing token header returns 400
+
+Records come from a mongoexport style json file like nome_ak_Jan.json.
+Run from the weatherproject directory:
+    python -m utils.stub_server nome_ak_Jan.json [port]
+then point get_weather.py at it with --url.
+'''
+import bisect
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+DATA_PATH = '/cdo-web/api/v2/data'
+
+
+def load_records(path):
+    '''Reads one json record per line, dropping the mongo _id.
+    Lines that don't parse (like a truncated last line) are skipped.'''
+    records = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            rec.pop('_id', None)
+            records.append(rec)
+    records.sort(key=lambda r: (r.get('date'), r.get('datatype')))
+    return records
+
+
+
+class StubNcdcServer:
+    '''
+    Create an instance with the records to serve, then start().
+    fail_every: if set, every Nth request gets a 503 to exercise retries.
+    delay: seconds to sleep before answering, to mimic network latency.
+    '''
+    def __init__(self, records, host='127.0.0.1', port=0, fail_every=None, delay=0):
+        # sorted by date so a query is a bisect, not a scan
+        self.records = sorted(records, key=lambda r: (r.get('date'), r.get('datatype')))
+        self._dates = [r.get('date') for r in self.records]
+        self.fail_every = fail_every
+        self.delay = delay
+        self.request_count = 0
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://{}:{}{}'.format(host, port, DATA_PATH)
+
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+    def __enter__(self):
+        return self.start()
+
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+    def query(self, params):
+        '''Returns the response dict for the parsed query string.'''
+        station = params.get('stationid', [''])[0]
+        start = params.get('startdate', [''])[0]
+        end = params.get('enddate', [''])[0] + 'T99'
+        types = set(params.get('datatypeid', []))
+        limit = int(params.get('limit', ['25'])[0])
+        offset = int(params.get('offset', ['1'])[0])
+
+        lo = bisect.bisect_left(self._dates, start)
+        hi = bisect.bisect_right(self._dates, end)
+        matches = [r for r in self.records[lo:hi]
+                   if r.get('station') == station
+                   and (not types or r.get('datatype') in types)]
+        if not matches:
+            return {}
+        return {'metadata': {'resultset': {'offset': offset, 'count': len(matches), 'limit': limit}},
+                'results': matches[offset - 1:offset - 1 + limit]}
+
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with stub._lock:
+                    stub.request_count += 1
+                    count = stub.request_count
+                if stub.delay:
+                    time.sleep(stub.delay)
+
+                parsed = urlparse(self.path)
+                if parsed.path != DATA_PATH:
+                    return self._send(404, {'message': 'Not found'})
+                if not self.headers.get('token'):
+                    return self._send(400, {'message': 'Token parameter is required.'})
+                if stub.fail_every and count % stub.fail_every == 0:
+                    return self._send(503, {'message': 'Service unavailable'})
+                self._send(200, stub.query(parse_qs(parsed.query)))
+
+            def _send(self, code, body):
+                data = json.dumps(body).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) < 2:
+        print('usage: python -m utils.stub_server RECORDS.json [port]')
+        exit(1)
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8000
+    server = StubNcdcServer(load_records(sys.argv[1]), port=port)
+    print('Serving {} records at {}'.format(len(server.records), server.url))
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
@@ -1,14 +1,23 @@
 '''
 Class to build data of yearly averages for a given month.
+If given a utils.cache.StationCache that covers the station and years,
+the averages come from the memory mapped cache and mongo isn't used.
 Items for use in class instances are:
 - frame: A pandas DataFrame of the averages with columns "year" and "avg"
 - year_list: A list of the years processed
 - avg_list: A list of the averages processed
+
+build_many runs Averages for several stations at once on a thread pool
+(the time goes to mongo, which releases the GIL) and combine puts the
+frames together with a station column.
+numpy and pandas are imported where they are used, so listing the
+stations (plot_weather.py -l) doesn't load them.
 '''
 import utils.mongodb as db
+from utils.date_util import Dates
+from utils import profiling
 from collections import defaultdict
-import pandas as pd
-import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 class WeatherException(Exception):
     pass
@@ -17,13 +26,18 @@ class WeatherException(Exception):
 class Averages:
     '''Set up the database connection
     and the year and averages lists.
+    cache: optional utils.cache.StationCache to read from when it can.
+    workers: threads for the python method's per year queries.
     '''
-    def __init__(self):
+    def __init__(self, cache=None, workers=1):
         try:
             self.db_conn = db.WeatherDb()
         except db.MongoDBException as e:
             raise WeatherException(e.__str__())
 
+        self.cache = cache
+        self.workers = workers
+        self.use_cache = False
         # frame will be set to pandas DataFrame later
         self.frame = None
         self.year_list = []
@@ -31,28 +45,57 @@ class Averages:
 
 
     def set_values(self, station_id, month, start_year, end_year):
-        '''Make sure the collection exist before trying to set.'''
-        try:
-            self.db_conn.check_for_collection(station_id)
-        except db.MongoDBException as e:
-            raise WeatherException(e.__str__())
+        '''Make sure the collection exist before trying to set.
+        If the cache covers the years (all cached years if not provided)
+        mongo isn't touched.'''
+        with profiling.timer('averages.set_values'):
+            self.station_id = station_id
+            self.month = month
+            if self._set_from_cache(start_year, end_year):
+                return
 
+            try:
+                self.db_conn.check_for_collection(station_id)
+            except db.MongoDBException as e:
+                raise WeatherException(e.__str__())
 
-        self.db_conn.set_collection(station_id)
-        self.month = month
 
-        # if years not provided, get from the database
-        if start_year == None:
-            self.start_year = self.db_conn.get_min_date()
-            self.start_year = self.start_year.split('-')[0]
-        else:
-            self.start_year = start_year
+            self.db_conn.set_collection(station_id)
 
-        if end_year == None:
-            self.end_year = self.db_conn.get_max_date()
-            self.end_year = self.end_year.split('-')[0]
-        else:
-            self.end_year = end_year
+            # if years not provided, get from the database
+            if start_year == None:
+                self.start_year = self.db_conn.get_min_date()
+                self.start_year = self.start_year.split('-')[0]
+            else:
+                self.start_year = start_year
+
+            if end_year == None:
+                self.end_year = self.db_conn.get_max_date()
+                self.end_year = self.end_year.split('-')[0]
+            else:
+                self.end_year = end_year
+
+            if int(self.start_year) > int(self.end_year):
+                raise WeatherException('Start year {} is after end year {} for {}.'.format(
+                    self.start_year, self.end_year, station_id))
+
+
+    def _set_from_cache(self, start_year, end_year):
+        '''Sets the years and use_cache if the cache covers them.'''
+        if self.cache is None:
+            return False
+        years = self.cache.year_range(self.station_id)
+        if years is None:
+            return False
+        start_year = years[0] if start_year == None else int(start_year)
+        end_year = years[1] if end_year == None else int(end_year)
+        # backwards years are reported by the mongo path
+        if start_year > end_year or not self.cache.covers(self.station_id, '{}-01-01'.format(start_year), '{}-12-31'.format(end_year)):
+            return False
+        self.start_year = start_year
+        self.end_year = end_year
+        self.use_cache = True
+        return True
 
 
     def _get_average(self, d):
@@ -76,6 +119,9 @@ class Averages:
                 tmin.append(entries[1][1])
 
                 # both should be the same length.
+        if not tmin:
+            # no day had both... nothing to average
+            return None
         return ((sum(tmin) / len(tmin)) + (sum(tmax) / len(tmax))) / 2
 
 
@@ -94,35 +140,199 @@ class Averages:
         return mydict
 
 
-    def build_averages(self):
-        '''Loops thru the years getting records for the month suppled.
+    def build_averages(self, method='rollup'):
+        '''Builds the yearly averages for the month supplied.
+        method is one of:
+            rollup: reads the saved per month sums in the rollups collection,
+                rebuilding any that are missing or stale.
+                Falls back to python if that fails.
+            aggregate: the database works out the averages in one query.
+                Falls back to python if the aggregation fails.
+            numpy: pulls the month for all years in one query and averages
+                with the vectorized utils.columnar.StationFrame.
+            python: loops thru the years getting records and averaging here.
+        If set_values found the years in the cache, method is ignored
+        and the cache is used, so leave the cache out when the method
+        matters (plot_weather.py does when --method is given).
         Ends up with pandas DataFrame self.frame, and two lists:
         self.year_list and self.avg_list'''
+        stage = 'cache' if self.use_cache else method
+        with profiling.timer('averages.' + stage):
+            if self.use_cache:
+                avgdict = self._cache_averages()
+            elif method == 'rollup':
+                try:
+                    avgdict = self._rollup_averages()
+                except WeatherException as e:
+                    print('{}... using python averaging.'.format(e))
+                    avgdict = self._python_averages()
+            elif method == 'aggregate':
+                try:
+                    avgdict = self._aggregate_averages()
+                except WeatherException as e:
+                    print('{}... using python averaging.'.format(e))
+                    avgdict = self._python_averages()
+            elif method == 'numpy':
+                avgdict = self._numpy_averages()
+            elif method == 'python':
+                avgdict = self._python_averages()
+            else:
+                raise WeatherException('Unknown averaging method: {}'.format(method))
+
+        import numpy as np
+        import pandas as pd
+        with profiling.timer('averages.frame'):
+            for k in sorted(avgdict.keys()):
+                self.year_list.append(k)
+                self.avg_list.append(avgdict.get(k))
+
+            self.frame = pd.DataFrame({
+                'year': self.year_list,
+                'avg': self.avg_list})
+
+            self.polyvalue = np.poly1d(np.polyfit(self.year_list, self.avg_list, 1))(self.year_list)
+            self.rollingvalue = round(len(self.year_list) / 10)
+        return
+
+
+    def _python_averages(self):
+        '''Loops thru the years getting records for the month suppled.
+        Returns dict of year: average'''
         avgdict = dict()
-        for yr in range(int(self.start_year), int(self.end_year) + 1):
-            #print('Checking {}-{:02d}'.format(yr, int(self.month)))
-            records = self.db_conn.get_records('{}-{}'.format(yr, self.month.zfill(2)))
+        d = Dates()
+        years = range(int(self.start_year), int(self.end_year) + 1)
+
+        def get_year(yr):
+            year_month = '{}-{}'.format(yr, self.month.zfill(2))
+            return self.db_conn.get_records(d.get_full_date(year_month, 0), d.get_full_date(year_month, 1))
+
+        if self.workers > 1:
+            # the years are independent queries, map keeps them in order
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                year_records = list(pool.map(get_year, years))
+        else:
+            year_records = map(get_year, years)
+        for yr, records in zip(years, year_records):
             if records == None:
                 print('No data for {}-{}... skipping.'.format(yr, self.month.zfill(2)))
                 continue
             mydict = self._build_dict(records)
             avg_temp = self._get_average(mydict)
+            if avg_temp is None:
+                print('No paired min / max for {}-{}... skipping.'.format(yr, self.month.zfill(2)))
+                continue
             avgdict[yr] = avg_temp
+        return avgdict
+
 
-        for k in sorted(avgdict.keys()):
-            self.year_list.append(k)
-            self.avg_list.append(avgdict.get(k))
+    def _numpy_averages(self):
+        '''One query for all the years, averaged with StationFrame.
+        Returns dict of year: average, same as _python_averages'''
+        from utils.columnar import StationFrame
+        try:
+            records = self.db_conn.get_month_records(self.month, self.start_year, self.end_year)
+            with profiling.timer('mongo.month_records'):
+                frame = StationFrame.from_records(records)
+        except db.MongoDBException as e:
+            raise WeatherException(e.__str__())
+        profiling.count('mongo.records_read', len(frame))
+        return self._frame_averages(frame)
 
-        self.frame = pd.DataFrame({
-            'year': self.year_list,
-            'avg': self.avg_list})
 
-        self.polyvalue = np.poly1d(np.polyfit(self.year_list, self.avg_list, 1))(self.year_list)
-        self.rollingvalue = round(len(self.year_list) / 10)
-        return
+    def _cache_averages(self):
+        '''Same as _numpy_averages but from the memory mapped cache.'''
+        import numpy as np
+        from utils.columnar import StationFrame
+        frame = self.cache.load(self.station_id, '{}-01-01'.format(self.start_year),
+                                '{}-12-31'.format(self.end_year))
+        months = frame.day.astype('datetime64[M]').astype(np.int64) % 12 + 1
+        keep = months == int(self.month)
+        return self._frame_averages(StationFrame(frame.day[keep], frame.datatype[keep], frame.value[keep]))
+
+
+    def _frame_averages(self, frame):
+        '''Returns dict of year: average from a StationFrame holding the month.'''
+        means = frame.month_year_means()
+        found = dict(zip(means['year'].tolist(), means['avg'].tolist()))
+
+        avgdict = dict()
+        for yr in range(int(self.start_year), int(self.end_year) + 1):
+            if yr not in found:
+                print('No data for {}-{}... skipping.'.format(yr, self.month.zfill(2)))
+                continue
+            avgdict[yr] = found.get(yr)
+        return avgdict
+
+
+    def _rollup_averages(self):
+        '''Reads the rollups for the years, rebuilding only missing or stale ones.
+        Returns dict of year: average, same as _python_averages'''
+        try:
+            cells = db.Rollups(self.db_conn).get_month(self.station_id, self.month,
+                                                       self.start_year, self.end_year)
+        except db.MongoDBException as e:
+            raise WeatherException(e.__str__())
+
+        avgdict = dict()
+        for yr in range(int(self.start_year), int(self.end_year) + 1):
+            if yr not in cells:
+                print('No data for {}-{}... skipping.'.format(yr, self.month.zfill(2)))
+                continue
+            rec = cells.get(yr)
+            avgdict[yr] = (rec.get('paired_tmin_sum') + rec.get('paired_tmax_sum')) / (2 * rec.get('days'))
+        return avgdict
+
+
+    def _aggregate_averages(self):
+        '''One aggregation for all the years.
+        Returns dict of year: average, same as _python_averages'''
+        try:
+            means = self.db_conn.get_monthly_means(self.month, self.start_year, self.end_year)
+        except db.MongoDBException as e:
+            raise WeatherException(e.__str__())
+
+        avgdict = dict()
+        for yr in range(int(self.start_year), int(self.end_year) + 1):
+            if yr not in means:
+                print('No data for {}-{}... skipping.'.format(yr, self.month.zfill(2)))
+                continue
+            tmin, tmax, days = means.get(yr)
+            avgdict[yr] = (tmin + tmax) / 2
+        return avgdict
 
 
 
     def show_stations(self):
         '''Print station information for available collections'''
         self.db_conn.list_collections()
+
+
+
+def build_many(station_ids, month, start_year=None, end_year=None, method='rollup', cache=None, workers=4):
+    '''Builds an Averages for each station, workers stations at a time.
+    Each gets its own WeatherDb on the shared client, and the python
+    method's years are split over the same number of threads.
+    Returns the Averages in station_ids order. The first station to
+    fail raises its WeatherException once the others are done.'''
+    def build(station_id):
+        wa = Averages(cache, workers=workers)
+        wa.set_values(station_id, month, start_year, end_year)
+        wa.build_averages(method)
+        return wa
+
+    if workers <= 1 or len(station_ids) == 1:
+        return [build(station_id) for station_id in station_ids]
+    with ThreadPoolExecutor(max_workers=min(workers, len(station_ids))) as pool:
+        futures = [pool.submit(build, station_id) for station_id in station_ids]
+    return [f.result() for f in futures]
+
+
+
+def combine(averages):
+    '''One DataFrame with columns station, year and avg from a list of
+    built Averages, in the same order.'''
+    import pandas as pd
+    frames = [wa.frame.assign(station=wa.station_id) for wa in averages]
+    if not frames:
+        return pd.DataFrame(columns=['station', 'year', 'avg'])
+    return pd.concat(frames, ignore_index=True)[['station', 'year', 'avg']]